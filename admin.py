@@ -1,9 +1,30 @@
 # admin.py
+import logging
+
 from sqladmin import Admin, ModelView, action
+from sqlalchemy import false, select
+from starlette.requests import Request
+from starlette.responses import RedirectResponse
 from wtforms import PasswordField
-from models import User, PostbackLog
-from database import engine, SessionLocal
-from auth import hash_password, ensure_unique_click_id, attach_pending_postbacks  # используем твои функции
+from models import User, PostbackLog, DailyStat, FxRate
+from database import engine, AsyncSessionLocal, write_session
+from auth import ensure_unique_click_id  # используем твои функции
+from reconcile import ReconcileStats, apply_logs
+from passwords import hash_password_async
+from user_cache import user_cache
+
+log = logging.getLogger("admin")
+
+def _process_selected(db, ids: list[int], stats: ReconcileStats) -> int:
+    # пользователей для всех выбранных логов ищем одним запросом (см. reconcile.apply_logs)
+    logs = db.execute(
+        select(PostbackLog.id, PostbackLog.event, PostbackLog.click_id,
+               PostbackLog.trader_id, PostbackLog.amount, PostbackLog.currency,
+               PostbackLog.amount_base, PostbackLog.created_at)
+        .where(PostbackLog.id.in_(ids), PostbackLog.processed == false())
+        .order_by(PostbackLog.id)
+    ).all()
+    return apply_logs(db, logs, stats)
 
 class UserAdmin(ModelView, model=User):
     name = "User"
@@ -11,7 +32,7 @@ class UserAdmin(ModelView, model=User):
 
     column_list = [
         User.id, User.login, User.email, User.trader_id,
-        User.first_deposit, User.total_deposit, User.deposit_verified,
+        User.first_deposit, User.total_deposit, User.deposit_verified, User.funnel_state,
         User.created_at, User.updated_at
     ]
     column_searchable_list = [User.login, User.email, User.trader_id]
@@ -19,7 +40,7 @@ class UserAdmin(ModelView, model=User):
 
     # пароль не показываем как колонку/поле
     column_details_exclude_list = [User.password]
-    form_excluded_columns = [User.password, User.created_at, User.updated_at]
+    form_excluded_columns = [User.password, User.funnel_state, User.created_at, User.updated_at]
 
     # добавляем поле для ввода нового пароля
     form_extra_fields = {
@@ -29,16 +50,23 @@ class UserAdmin(ModelView, model=User):
     # опционально запретить удаление (чтобы случайно не унесли юзера с логами)
     # can_delete = False
 
-    def on_model_change(self, form, model, is_created):
-        # захэшовать пароль, если ввели
-        pwd = form.data.get("new_password")
+    async def on_model_change(self, data, model, is_created, request):
+        # захэшовать пароль, если ввели (в пуле bcrypt, не блокируя event loop);
+        # в data sqladmin кладёт только колонки модели — поле берём из формы запроса
+        pwd = (await request.form()).get("new_password")
         if pwd:
-            model.password = hash_password(pwd)
+            model.password = await hash_password_async(pwd)
 
         # выдать click_id если пусто (для новых)
         if is_created and not model.click_id:
-            with SessionLocal() as db:
-                model.click_id = ensure_unique_click_id(db, None)
+            async with AsyncSessionLocal() as db:
+                model.click_id = await db.run_sync(ensure_unique_click_id, None)
+
+    async def after_model_change(self, data, model, is_created, request):
+        user_cache.invalidate(model.id)
+
+    async def after_model_delete(self, model, request):
+        user_cache.invalidate(model.id)
 
 class PostbackAdmin(ModelView, model=PostbackLog):
     name = "Postback"
@@ -46,7 +74,7 @@ class PostbackAdmin(ModelView, model=PostbackLog):
 
     column_list = [
         PostbackLog.id, PostbackLog.event, PostbackLog.click_id, PostbackLog.trader_id,
-        PostbackLog.amount, PostbackLog.currency, PostbackLog.processed,
+        PostbackLog.amount, PostbackLog.currency, PostbackLog.amount_base, PostbackLog.processed,
         PostbackLog.created_at, PostbackLog.processed_at, PostbackLog.user_id
     ]
     column_searchable_list = [PostbackLog.event, PostbackLog.click_id, PostbackLog.trader_id]
@@ -58,24 +86,42 @@ class PostbackAdmin(ModelView, model=PostbackLog):
         label="Attach & process",
         confirmation_message="Привязать выбранные логи к пользователям и обновить депозиты?"
     )
-    def process_logs(self, ids):
-        with SessionLocal() as db:
-            logs = db.query(PostbackLog).filter(PostbackLog.id.in_(ids)).all()
-            affected = set()
-            for pb in logs:
-                # находим юзера по click_id или trader_id
-                user = None
-                if pb.click_id:
-                    user = db.query(User).filter(User.click_id == pb.click_id).first()
-                if not user and pb.trader_id:
-                    user = db.query(User).filter(User.trader_id == pb.trader_id).first()
-                if user:
-                    # твоя функция подтягивает все pending-постбэки и обновляет суммы
-                    attach_pending_postbacks(db, user)
-                    affected.add(user.id)
-            return f"Processed for users: {len(affected)}"
+    async def process_logs(self, request: Request):
+        ids = [int(pk) for pk in request.query_params.get("pks", "").split(",") if pk.strip().isdigit()]
+        if ids:
+            stats = ReconcileStats()
+            async with write_session() as db:  # запись — под single_writer, как у reconcile
+                attached = await db.run_sync(_process_selected, ids, stats)
+            log.info("ADMIN_PROCESS_LOGS selected=%d attached=%d users=%d", len(ids), attached, len(stats.users))
+        return RedirectResponse(request.url_for("admin:list", identity=self.identity), status_code=302)
+
+class DailyStatAdmin(ModelView, model=DailyStat):
+    """Только чтение: агрегаты ведёт rollups.py."""
+    name = "Daily stat"
+    name_plural = "Daily stats"
+
+    can_create = False
+    can_edit = False
+    can_delete = False
+
+    column_list = [
+        DailyStat.day, DailyStat.currency, DailyStat.registrations, DailyStat.trader_linked,
+        DailyStat.ftd_count, DailyStat.ftd_volume, DailyStat.deposit_count, DailyStat.deposit_volume
+    ]
+    column_sortable_list = [DailyStat.day, DailyStat.deposit_volume, DailyStat.ftd_count]
+    column_default_sort = [(DailyStat.day, True)]
+
+class FxRateAdmin(ModelView, model=FxRate):
+    """Курсы к базовой валюте; приложение перечитывает их раз в FX_REFRESH_INTERVAL."""
+    name = "FX rate"
+    name_plural = "FX rates"
+
+    column_list = [FxRate.currency, FxRate.rate, FxRate.updated_at]
+    form_excluded_columns = [FxRate.updated_at]
 
 def init_admin(app):
     admin = Admin(app, engine, base_url="/admin")
     admin.add_view(UserAdmin)
     admin.add_view(PostbackAdmin)
+    admin.add_view(DailyStatAdmin)
+    admin.add_view(FxRateAdmin)
@@ -1,28 +1,35 @@
 # auth.py
-from fastapi import APIRouter, Request, Form
+from fastapi import APIRouter, Request, Form, Depends
 from fastapi.responses import JSONResponse
-from fastapi.templating import Jinja2Templates
 from datetime import datetime
-from passlib.context import CryptContext
 from typing import Optional
 import secrets
 import os
 
-from sqlalchemy import exists
-from database import SessionLocal
-from models import User, PostbackLog  # для attach_pending_postbacks
+from sqlalchemy import exists, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import get_db, single_writer
+from models import User
+from utils import attach_pending_postbacks
+from user_cache import user_cache
+from sessions import revoke, set_session_cookie
+from passwords import hash_password_async, verify_password_async, PasswordHasherBusy
+from ratelimit import rate_limit, sliding_window, token_bucket
+from templating import templates
 
 router = APIRouter()
-templates = Jinja2Templates(directory="templates")
 
-# === Пароли ===
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# === Пароли (bcrypt — в отдельном пуле, см. passwords.py) ===
+BUSY_RESPONSE = {"success": False, "message": "Сервер перегружен, попробуйте ещё раз через пару секунд."}
 
-def hash_password(password: str) -> str:
-    return pwd_context.hash(password)
+# === Лимиты попыток (ratelimit.py): отказ — до запросов к БД и bcrypt ===
+AUTH_IP_LIMIT = token_bucket("auth_ip", os.getenv("RATELIMIT_AUTH_IP", "30/60"))
+AUTH_LOGIN_LIMIT = sliding_window("auth_login", os.getenv("RATELIMIT_AUTH_LOGIN", "10/900"))
+TOO_MANY_ATTEMPTS = "Слишком много попыток, попробуйте через {retry} сек."
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+async def _login_key(request: Request) -> Optional[str]:
+    form = await request.form()  # уже разобрана FastAPI для обработчика — берётся из кэша
+    return (form.get("login") or "").strip().lower() or None
 
 # === Куки ===
 IS_SECURE_COOKIES = os.getenv("ENV", "dev") != "dev"  # True в проде
@@ -44,42 +51,16 @@ def ensure_unique_click_id(db, cid: Optional[str]) -> str:
         cid = secrets.token_urlsafe(8)
     return cid
 
-def attach_pending_postbacks(db, user: User):
-    q = db.query(PostbackLog).filter(PostbackLog.processed == False)
-    if user.click_id:
-        q = q.filter(PostbackLog.click_id == user.click_id)
-    elif user.trader_id:
-        q = q.filter(PostbackLog.trader_id == user.trader_id)
-    else:
-        return
-
-    logs = q.all()
-    if not logs:
-        return
-
-    for pb in logs:
-        if pb.event == "deposit" and (pb.amount or 0) > 0:
-            if user.first_deposit is None:
-                user.first_deposit = pb.amount
-            user.total_deposit = (user.total_deposit or 0.0) + (pb.amount or 0.0)
-
-        if pb.trader_id and not user.trader_id:
-            user.trader_id = pb.trader_id
-
-        pb.user_id = user.id
-        pb.processed = True
-        pb.processed_at = datetime.utcnow()
-
-    user.updated_at = datetime.utcnow()
-    db.commit()
-
 # === Рендер формы ===
 @router.get("/auth")
 async def auth_form(request: Request):
     return templates.TemplateResponse("auth.html", {"request": request})
 
 # === Регистрация/логин ===
-@router.post("/auth")
+@router.post("/auth", dependencies=[
+    Depends(rate_limit(AUTH_IP_LIMIT, detail=TOO_MANY_ATTEMPTS)),
+    Depends(rate_limit(AUTH_LOGIN_LIMIT, _login_key, TOO_MANY_ATTEMPTS)),
+])
 async def handle_auth(
     request: Request,
     login: str = Form(...),
@@ -87,84 +68,89 @@ async def handle_auth(
     password: str = Form(...),
     action: str = Form(...),               # "register" | "login"
     remember: Optional[str] = Form(None),  # "true" | None
+    db: AsyncSession = Depends(get_db),
 ):
-    db = SessionLocal()
-    try:
-        remember_bool = (remember == "true")
-        max_age = 60 * 60 * 24 * 30 if remember_bool else None
-
-        raw_click_id = _ensure_click_id_in_cookie(request)
-
-        if action == "register":
-            # базовая валидация
-            if not email:
-                return JSONResponse({"success": False, "message": "Укажите email."}, status_code=400)
-
-            if db.query(User).filter(User.login == login).first():
-                return JSONResponse({"success": False, "message": "Этот логин уже занят."}, status_code=409)
-            if db.query(User).filter(User.email == email).first():
-                return JSONResponse({"success": False, "message": "Этот email уже занят."}, status_code=409)
-
-            click_id_cookie = ensure_unique_click_id(db, raw_click_id)
-            hashed_pw = hash_password(password)
-
-            new_user = User(
-                login=login,
-                email=email,
-                password=hashed_pw,
-                click_id=click_id_cookie,
-                created_at=datetime.utcnow(),
-                updated_at=datetime.utcnow(),
-            )
+    remember_bool = (remember == "true")
+    max_age = 60 * 60 * 24 * 30 if remember_bool else None
+
+    raw_click_id = _ensure_click_id_in_cookie(request)
+
+    if action == "register":
+        # базовая валидация
+        if not email:
+            return JSONResponse({"success": False, "message": "Укажите email."}, status_code=400)
+
+        if await db.scalar(select(User.id).where(User.login == login)):
+            return JSONResponse({"success": False, "message": "Этот логин уже занят."}, status_code=409)
+        if await db.scalar(select(User.id).where(User.email == email)):
+            return JSONResponse({"success": False, "message": "Этот email уже занят."}, status_code=409)
+
+        click_id_cookie = await db.run_sync(ensure_unique_click_id, raw_click_id)
+        try:
+            hashed_pw = await hash_password_async(password)
+        except PasswordHasherBusy:
+            return JSONResponse(BUSY_RESPONSE, status_code=503, headers={"Retry-After": "2"})
+
+        new_user = User(
+            login=login,
+            email=email,
+            password=hashed_pw,
+            click_id=click_id_cookie,
+            created_at=datetime.utcnow(),
+            updated_at=datetime.utcnow(),
+        )
+        async with single_writer():
             db.add(new_user)
-            db.commit()
-            db.refresh(new_user)
+            await db.commit()
+            await db.refresh(new_user)
 
-            attach_pending_postbacks(db, new_user)
+            await db.run_sync(attach_pending_postbacks, new_user)
 
-            resp = JSONResponse({"success": True, "click_id": click_id_cookie})
-            resp.set_cookie("user_id", str(new_user.id), httponly=True, max_age=max_age,
+        resp = JSONResponse({"success": True, "click_id": click_id_cookie})
+        set_session_cookie(resp, new_user, remember_bool)
+        if new_user.email:
+            resp.set_cookie("user_email", new_user.email, max_age=max_age,
                             secure=IS_SECURE_COOKIES, samesite=SAMESITE_POLICY, path="/")
-            if new_user.email:
-                resp.set_cookie("user_email", new_user.email, max_age=max_age,
-                                secure=IS_SECURE_COOKIES, samesite=SAMESITE_POLICY, path="/")
-            resp.set_cookie("click_id", click_id_cookie, max_age=60*60*24*30,
-                            secure=IS_SECURE_COOKIES, samesite=SAMESITE_POLICY, path="/")
-            return resp
+        resp.set_cookie("click_id", click_id_cookie, max_age=60*60*24*30,
+                        secure=IS_SECURE_COOKIES, samesite=SAMESITE_POLICY, path="/")
+        return resp
 
-        elif action == "login":
-            user = db.query(User).filter(User.login == login).first()
-            if not user or not verify_password(password, user.password):
-                return JSONResponse({"success": False, "message": "Неверный логин или пароль."}, status_code=401)
+    elif action == "login":
+        user = await db.scalar(select(User).where(User.login == login))
+        try:
+            password_ok = bool(user) and await verify_password_async(password, user.password)
+        except PasswordHasherBusy:
+            return JSONResponse(BUSY_RESPONSE, status_code=503, headers={"Retry-After": "2"})
+        if not password_ok:
+            return JSONResponse({"success": False, "message": "Неверный логин или пароль."}, status_code=401)
 
-            click_id_cookie = raw_click_id
+        click_id_cookie = raw_click_id
 
+        async with single_writer():
             if not user.click_id:
-                safe_cid = ensure_unique_click_id(db, click_id_cookie)
+                safe_cid = await db.run_sync(ensure_unique_click_id, click_id_cookie)
                 if safe_cid != click_id_cookie:
                     click_id_cookie = safe_cid
                 user.click_id = safe_cid
                 user.updated_at = datetime.utcnow()
-                db.commit()
-                db.refresh(user)
+                await db.commit()
+                await db.refresh(user)
+                user_cache.invalidate(user.id)
 
-            attach_pending_postbacks(db, user)
+            await db.run_sync(attach_pending_postbacks, user)
 
-            resp = JSONResponse({"success": True, "click_id": user.click_id or click_id_cookie})
-            resp.set_cookie("user_id", str(user.id), httponly=True, max_age=max_age,
+        resp = JSONResponse({"success": True, "click_id": user.click_id or click_id_cookie})
+        set_session_cookie(resp, user, remember_bool)
+        if user.email:
+            resp.set_cookie("user_email", user.email, max_age=max_age,
                             secure=IS_SECURE_COOKIES, samesite=SAMESITE_POLICY, path="/")
-            if user.email:
-                resp.set_cookie("user_email", user.email, max_age=max_age,
-                                secure=IS_SECURE_COOKIES, samesite=SAMESITE_POLICY, path="/")
-            resp.set_cookie("click_id", user.click_id or click_id_cookie, max_age=60*60*24*30,
-                            secure=IS_SECURE_COOKIES, samesite=SAMESITE_POLICY, path="/")
-            return resp
+        resp.set_cookie("click_id", user.click_id or click_id_cookie, max_age=60*60*24*30,
+                        secure=IS_SECURE_COOKIES, samesite=SAMESITE_POLICY, path="/")
+        return resp
 
-        else:
-            return JSONResponse({"success": False, "message": "Неверное действие."}, status_code=400)
+    else:
+        return JSONResponse({"success": False, "message": "Неверное действие."}, status_code=400)
 
-    finally:
-        db.close()
 
 # === Сброс пароля (применение нового) ===
 @router.post("/password-reset")
@@ -172,6 +158,7 @@ async def password_reset(
     request: Request,
     token_form: Optional[str] = Form(None),
     new_password_form: Optional[str] = Form(None),
+    db: AsyncSession = Depends(get_db),
 ):
     # 1) сначала пробуем form
     token = token_form
@@ -193,17 +180,19 @@ async def password_reset(
         return JSONResponse({"success": False, "message": "Пароль слишком короткий (мин. 6 символов)."}, status_code=400)
 
     # 4) ищем по токену и обновляем пароль
-    db = SessionLocal()
+    user = await db.scalar(select(User).where(User.reset_token == token))
+    if not user:
+        return JSONResponse({"success": False, "message": "Неверный или устаревший токен."}, status_code=400)
+
     try:
-        user = db.query(User).filter(User.reset_token == token).first()
-        if not user:
-            return JSONResponse({"success": False, "message": "Неверный или устаревший токен."}, status_code=400)
-
-        user.password = hash_password(new_password)
-        user.reset_token = None
-        user.updated_at = datetime.utcnow()
-        db.commit()
-
-        return JSONResponse({"success": True, "message": "Пароль успешно изменён."})
-    finally:
-        db.close()
+        user.password = await hash_password_async(new_password)
+    except PasswordHasherBusy:
+        return JSONResponse(BUSY_RESPONSE, status_code=503, headers={"Retry-After": "2"})
+    user.reset_token = None
+    user.updated_at = datetime.utcnow()
+    async with single_writer():
+        await db.commit()
+    # старый пароль мог утечь — выходим из всех сессий, выданных до смены
+    await revoke(user_id=user.id)
+
+    return JSONResponse({"success": True, "message": "Пароль успешно изменён."})
@@ -0,0 +1,54 @@
+# bench/common.py
+"""Общие помощники бенчмарков (нужен httpx)."""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def temp_db_url(tmpdir: str, name: str = "bench.db") -> str:
+    return f"sqlite:///{os.path.join(tmpdir, name)}"
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    lo, hi = int(k), min(int(k) + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def latency_summary(latencies: list[float], elapsed: float) -> dict:
+    """latencies — в секундах; в отчёт — мс."""
+    return {
+        "requests": len(latencies),
+        "rps": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+    }
+
+
+def asgi_client(app):
+    import httpx
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench")
+
+
+def run_isolated(module: str, env: dict, args: list[str] | None = None) -> dict:
+    """Запускает `python -m <module>` с env поверх текущего окружения и ждёт JSON в последней строке stdout."""
+    with tempfile.TemporaryDirectory() as tmp:
+        full_env = {**os.environ, "PYTHONPATH": str(ROOT), **env}
+        full_env.setdefault("DATABASE_URL", temp_db_url(tmp))
+        full_env.setdefault("RATELIMIT_ENABLED", "0")  # нагрузка идёт с одного IP — лимиты мерить не дают
+        # cwd — корень репозитория: приложение ищет templates/ и static/ относительно него
+        out = subprocess.run([sys.executable, "-m", module, *(args or [])], cwd=ROOT, env=full_env,
+                             capture_output=True, text=True)
+    if out.returncode != 0:
+        sys.stderr.write(out.stderr)
+        raise RuntimeError(f"{module} {' '.join(args or [])} failed with code {out.returncode}")
+    return json.loads(out.stdout.strip().splitlines()[-1])
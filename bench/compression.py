@@ -0,0 +1,67 @@
+# bench/compression.py
+"""python -m bench.compression --requests 200 --users 2000"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+from bench.common import asgi_client, run_isolated
+
+PAGES = ["/", "/dashboard", "/terms.html", "/signals", "/users"]
+ENCODINGS = ["identity", "gzip", "br"]
+
+
+async def _measure(client, path: str, encoding: str, requests: int) -> dict:
+    headers = {"Accept-Encoding": encoding}
+    r = await client.get(path, headers=headers)
+    wire = len(r.content) if r.headers.get("content-encoding") is None else int(r.headers["content-length"])
+    cpu0, t0 = time.process_time(), time.perf_counter()
+    for _ in range(requests):
+        await client.get(path, headers=headers)
+    return {
+        "encoding": r.headers.get("content-encoding", "identity"),
+        "bytes": wire,
+        "cpu_ms": round((time.process_time() - cpu0) / requests * 1000, 3),
+        "wall_ms": round((time.perf_counter() - t0) / requests * 1000, 3),
+    }
+
+
+async def _worker_run(args) -> dict:
+    from bench.funnel import seed
+    from main import app
+
+    seed(args.users, 0)
+    results = {}
+    async with asgi_client(app) as client:
+        for path in PAGES:
+            results[path] = {enc: await _measure(client, path, enc, args.requests) for enc in ENCODINGS}
+    return results
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--requests", type=int, default=200, help="запросов на страницу и кодировку")
+    ap.add_argument("--users", type=int, default=2000, help="пользователей в /users")
+    ap.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.worker:
+        print(json.dumps(asyncio.run(_worker_run(args))))
+        return
+
+    results = run_isolated("bench.compression", {},
+                           ["--worker", "--requests", str(args.requests), "--users", str(args.users)])
+    for path, by_enc in results.items():
+        plain = by_enc["identity"]
+        for enc in ENCODINGS:
+            r = by_enc[enc]
+            saved = 100 * (1 - r["bytes"] / plain["bytes"]) if plain["bytes"] else 0.0
+            print(f"{path:>12} {enc:>8} ({r['encoding']:>8}): {r['bytes']:>8} B  saved={saved:5.1f}%  "
+                  f"cpu={r['cpu_ms']}ms (+{r['cpu_ms'] - plain['cpu_ms']:.3f})  wall={r['wall_ms']}ms",
+                  file=sys.stderr)
+    print(json.dumps(results))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+# bench/funnel.py
+"""python -m bench.funnel --users 10000 --logs 1000000 [--save-baseline | --tolerance 0.2]"""
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+from bench.common import ROOT, asgi_client, latency_summary, run_isolated
+
+BASELINE_PATH = ROOT / "bench" / "baseline.json"
+RESULTS_DIR = ROOT / "bench" / "results"
+PASSWORD = "bench_password"
+SEED_CHUNK = 50_000
+
+# логин — это bcrypt на каждый запрос, его гоняем меньше
+SLOW_SCENARIOS = {"auth_register": 0.1, "auth_login": 0.1}
+
+
+def seed(users: int, logs: int):
+    """Быстрый засев через executemany; у всех пользователей один и тот же хэш пароля."""
+    from sqlalchemy import insert
+    from database import engine
+    from models import PostbackLog, User
+    from passwords import hash_password
+
+    pw_hash = hash_password(PASSWORD)
+    now = datetime.utcnow()
+    with engine.begin() as conn:
+        for start in range(0, users, SEED_CHUNK):
+            conn.execute(insert(User), [{
+                "id": i + 1, "login": f"user{i}", "email": f"user{i}@bench.local", "password": pw_hash,
+                "click_id": f"click{i}", "trader_id": str(1_000_000 + i) if i % 2 == 0 else None,
+                "first_deposit": 100.0 if i % 4 == 0 else None,
+                "total_deposit": 100.0 if i % 4 == 0 else 0.0,
+                "created_at": now, "updated_at": now,
+            } for i in range(start, min(start + SEED_CHUNK, users))])
+        for start in range(0, logs, SEED_CHUNK):
+            rows = []
+            for i in range(start, min(start + SEED_CHUNK, logs)):
+                u = i % (users * 2)  # половина логов — на несуществующих пользователей
+                attached = u < users
+                rows.append({
+                    "event": "deposit" if i % 3 == 0 else "registration",
+                    "click_id": f"click{u}", "trader_id": str(1_000_000 + u),
+                    "amount": 25.0 if i % 3 == 0 else 0.0, "currency": "USD", "raw": "{}",
+                    "processed": attached, "user_id": u + 1 if attached else None,
+                    "created_at": now, "processed_at": now if attached else None,
+                })
+            conn.execute(insert(PostbackLog), rows)
+
+
+def scenarios(users: int, secret: str) -> dict:
+    """Имя -> функция(i) -> (method, url, kwargs)."""
+    from sessions import SESSION_COOKIE, issue
+
+    rnd = random.Random(42)
+
+    def any_user():
+        return rnd.randrange(users)
+
+    def trader_user():
+        return rnd.randrange(0, users, 2)
+
+    def auth_cookies(u: int) -> dict:
+        # токен сессии под засев: trader_id у чётных, депозит 100 у каждого четвёртого
+        token = issue(u + 1, has_trader=u % 2 == 0, verified=u % 4 == 0, remember=True)
+        return {"Cookie": f"{SESSION_COOKIE}={token}; click_id=click{u}"}
+
+    return {
+        "postback_get": lambda i: ("GET", "/postback", {"params": {
+            "token": secret, "event": "deposit", "click_id": f"click{any_user()}",
+            "amount": "10", "currency": "USD", "transaction_id": f"get-{i}"}}),
+        "postback_post": lambda i: ("POST", "/postback", {"json": {
+            "token": secret, "event": "deposit", "click_id": f"click{any_user()}",
+            "amount": "10", "currency": "USD", "transaction_id": f"post-{i}"}}),
+        "auth_register": lambda i: ("POST", "/auth", {"data": {
+            "login": f"new{i}", "email": f"new{i}@bench.local", "password": PASSWORD, "action": "register"}}),
+        "auth_login": lambda i: ("POST", "/auth", {"data": {
+            "login": f"user{any_user()}", "password": PASSWORD, "action": "login"}}),
+        "check_get": lambda i: ("GET", "/check", {"headers": auth_cookies(any_user())}),
+        "check_post": lambda i: (lambda u: ("POST", "/check", {
+            "data": {"trader_id": str(1_000_000 + u)}, "headers": auth_cookies(u)}))(trader_user()),
+        "deposit_check": lambda i: ("GET", "/deposit-check", {"params": {"trader_id": str(1_000_000 + trader_user())}}),
+        "profile": lambda i: ("GET", "/profile", {"headers": auth_cookies(any_user())}),
+        "go_to_signals": lambda i: ("GET", "/go-to-signals", {"headers": auth_cookies(any_user())}),
+    }
+
+
+async def _drive(client, make_request, requests: int, concurrency: int) -> dict:
+    latencies, errors = [], 0
+    counter = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for i in counter:
+            method, url, kwargs = make_request(i)
+            t0 = time.perf_counter()
+            r = await client.request(method, url, **kwargs)
+            latencies.append(time.perf_counter() - t0)
+            if r.status_code >= 400:
+                errors += 1
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return {**latency_summary(latencies, time.perf_counter() - t0), "errors": errors}
+
+
+async def _worker_run(args) -> dict:
+    from main import app
+    from postback import POSTBACK_SECRET
+
+    t0 = time.perf_counter()
+    seed(args.users, args.logs)
+    seed_s = time.perf_counter() - t0
+
+    results = {}
+    async with asgi_client(app) as client:
+        for name, make_request in scenarios(args.users, POSTBACK_SECRET).items():
+            if args.only and name not in args.only:
+                continue
+            n = max(1, int(args.requests * SLOW_SCENARIOS.get(name, 1.0)))
+            results[name] = await _drive(client, make_request, n, args.concurrency)
+    return {"seed_s": round(seed_s, 1), "endpoints": results}
+
+
+def compare(current: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Регрессия — rps упал или p99 вырос больше чем на tolerance."""
+    problems = []
+    for name, cur in current["endpoints"].items():
+        base = baseline.get("endpoints", {}).get(name)
+        if not base:
+            continue
+        if base["rps"] and cur["rps"] < base["rps"] * (1 - tolerance):
+            problems.append(f"{name}: rps {base['rps']} -> {cur['rps']}")
+        if base["p99_ms"] and cur["p99_ms"] > base["p99_ms"] * (1 + tolerance):
+            problems.append(f"{name}: p99 {base['p99_ms']}ms -> {cur['p99_ms']}ms")
+    return problems
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--users", type=int, default=10_000)
+    ap.add_argument("--logs", type=int, default=100_000)
+    ap.add_argument("--requests", type=int, default=1000, help="запросов на эндпоинт")
+    ap.add_argument("--concurrency", type=int, default=32)
+    ap.add_argument("--only", nargs="*", help="прогнать только эти сценарии")
+    ap.add_argument("--ingest", choices=("sync", "queue"), default="sync", help="режим POSTBACK_INGEST")
+    ap.add_argument("--baseline", type=Path, default=BASELINE_PATH)
+    ap.add_argument("--save-baseline", action="store_true")
+    ap.add_argument("--tolerance", type=float, default=0.2)
+    ap.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.worker:
+        print(json.dumps(asyncio.run(_worker_run(args))))
+        return
+
+    worker_args = ["--worker", "--users", str(args.users), "--logs", str(args.logs),
+                   "--requests", str(args.requests), "--concurrency", str(args.concurrency)]
+    if args.only:
+        worker_args += ["--only", *args.only]
+    result = run_isolated("bench.funnel", {"POSTBACK_INGEST": args.ingest}, worker_args)
+    result["config"] = {k: getattr(args, k) for k in ("users", "logs", "requests", "concurrency", "ingest")}
+    result["created_at"] = datetime.utcnow().isoformat() + "Z"
+    print(f"seed: {result['seed_s']}s", file=sys.stderr)
+    for name, r in result["endpoints"].items():
+        print(f"{name:>15}: {r['rps']:>8} rps  p50={r['p50_ms']}ms  p95={r['p95_ms']}ms  "
+              f"p99={r['p99_ms']}ms  errors={r['errors']}", file=sys.stderr)
+
+    RESULTS_DIR.mkdir(parents=True, exist_ok=True)
+    out = RESULTS_DIR / f"funnel-{datetime.utcnow():%Y%m%d-%H%M%S}.json"
+    out.write_text(json.dumps(result, indent=2))
+    print(f"saved {out}", file=sys.stderr)
+
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps(result, indent=2))
+        print(f"baseline -> {args.baseline}", file=sys.stderr)
+        return
+    if args.baseline.exists():
+        problems = compare(result, json.loads(args.baseline.read_text()), args.tolerance)
+        for p in problems:
+            print(f"REGRESSION {p}", file=sys.stderr)
+        sys.exit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+# bench/login_storm.py
+"""python -m bench.login_storm --duration 10 --logins 32 --postback-rps 100"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+from bench.common import asgi_client, latency_summary, run_isolated
+
+LOGIN, PASSWORD = "bench_user", "bench_password"
+
+
+async def _postbacks(client, secret: str, duration: float, rps: int) -> dict:
+    latencies, statuses = [], {}
+    interval = 1 / rps
+    deadline = time.perf_counter() + duration
+    i = 0
+
+    async def one(n):
+        t0 = time.perf_counter()
+        r = await client.get("/postback", params={"token": secret, "event": "deposit",
+                                                  "click_id": f"storm-{time.time_ns()}-{n}", "amount": "1"})
+        latencies.append(time.perf_counter() - t0)
+        statuses[r.status_code] = statuses.get(r.status_code, 0) + 1
+
+    tasks = []
+    t_start = time.perf_counter()
+    while time.perf_counter() < deadline:
+        tasks.append(asyncio.create_task(one(i)))
+        i += 1
+        await asyncio.sleep(interval)
+    await asyncio.gather(*tasks)
+    return {**latency_summary(latencies, time.perf_counter() - t_start), "statuses": statuses}
+
+
+async def _login_storm(client, stop: asyncio.Event, concurrency: int) -> dict:
+    statuses = {}
+
+    async def loop():
+        while not stop.is_set():
+            r = await client.post("/auth", data={"login": LOGIN, "password": PASSWORD, "action": "login"})
+            statuses[r.status_code] = statuses.get(r.status_code, 0) + 1
+
+    await asyncio.gather(*(loop() for _ in range(concurrency)))
+    return statuses
+
+
+async def _worker_run(duration: float, logins: int, rps: int) -> dict:
+    from main import app
+    from postback import POSTBACK_SECRET
+    from passwords import queue_stats
+
+    async with asgi_client(app) as client:
+        r = await client.post("/auth", data={"login": LOGIN, "email": "bench@example.com",
+                                             "password": PASSWORD, "action": "register"})
+        assert r.status_code == 200, r.text
+
+        quiet = await _postbacks(client, POSTBACK_SECRET, duration, rps)
+
+        stop = asyncio.Event()
+        storm = asyncio.create_task(_login_storm(client, stop, logins))
+        loaded = await _postbacks(client, POSTBACK_SECRET, duration, rps)
+        stop.set()
+        login_statuses = await storm
+
+    return {"postback_quiet": quiet, "postback_under_storm": loaded,
+            "logins": login_statuses, "hash_pool": queue_stats()}
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--duration", type=float, default=10)
+    ap.add_argument("--logins", type=int, default=32, help="одновременных клиентов, логинящихся без пауз")
+    ap.add_argument("--postback-rps", type=int, default=100)
+    ap.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.worker:
+        print(json.dumps(asyncio.run(_worker_run(args.duration, args.logins, args.postback_rps))))
+        return
+
+    res = run_isolated("bench.login_storm", {"POSTBACK_INGEST": "sync"},
+                       ["--worker", "--duration", str(args.duration), "--logins", str(args.logins),
+                        "--postback-rps", str(args.postback_rps)])
+    for name in ("postback_quiet", "postback_under_storm"):
+        r = res[name]
+        print(f"{name:>22}: p50={r['p50_ms']}ms p95={r['p95_ms']}ms p99={r['p99_ms']}ms ({r['requests']} req)",
+              file=sys.stderr)
+    print(f"{'logins':>22}: {res['logins']}  pool={res['hash_pool']}", file=sys.stderr)
+    print(json.dumps(res))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+# bench/mailer.py
+"""python -m bench.mailer --emails 500 --domains 5 --rtt 20 (нужен aiosmtpd)"""
+import argparse
+import asyncio
+import json
+import socket
+import sys
+import time
+
+from bench.common import run_isolated
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class _Handler:
+    def __init__(self, rtt: float):
+        self.rtt = rtt
+        self.received = 0
+        self.sessions = 0
+
+    async def handle_EHLO(self, server, session, envelope, hostname, responses):
+        self.sessions += 1
+        await asyncio.sleep(self.rtt)
+        session.host_name = hostname
+        return responses
+
+    async def handle_DATA(self, server, session, envelope):
+        await asyncio.sleep(self.rtt)
+        self.received += 1
+        return "250 OK"
+
+
+def _recipients(emails: int, domains: int) -> list[str]:
+    return [f"user{i}@d{i % domains}.example" for i in range(emails)]
+
+
+async def _worker_run(mode: str, emails: int, domains: int) -> dict:
+    from migrations import run_migrations
+
+    run_migrations()
+    to = _recipients(emails, domains)
+    t0 = time.perf_counter()
+    if mode == "per_email":
+        from mailer import SmtpPool, _message, _quit
+        from models import OutboxEmail
+
+        pool = SmtpPool(1)
+        for addr in to:
+            server = pool._connect()
+            server.send_message(_message(OutboxEmail(to_email=addr, subject="bench", body="<p>bench</p>")))
+            _quit(server)
+        stats = pool.stats()
+    else:
+        from database import write_session
+        from mailer import enqueue, outbox
+
+        async with write_session() as db:
+            for addr in to:
+                enqueue(db, addr, "bench", "<p>bench</p>")
+            await db.commit()
+        t0 = time.perf_counter()  # меряем отправку, не вставку
+        await outbox.drain()
+        stats = outbox.stats()
+        outbox.pool.close()
+    elapsed = time.perf_counter() - t0
+    return {"emails": emails, "seconds": round(elapsed, 3),
+            "emails_per_s": round(emails / elapsed, 1) if elapsed else 0.0, "stats": stats}
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--emails", type=int, default=500)
+    ap.add_argument("--domains", type=int, default=5)
+    ap.add_argument("--rtt", type=float, default=20, help="задержка заглушки на EHLO и DATA, мс")
+    ap.add_argument("--connections", type=int, default=4, help="MAIL_SMTP_CONNECTIONS для outbox")
+    ap.add_argument("--modes", nargs="+", default=["per_email", "outbox"])
+    ap.add_argument("--worker", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.worker:
+        print(json.dumps(asyncio.run(_worker_run(args.worker, args.emails, args.domains))))
+        return
+
+    from aiosmtpd.controller import Controller
+
+    port = _free_port()
+    handler = _Handler(args.rtt / 1000)
+    controller = Controller(handler, hostname="127.0.0.1", port=port)
+    controller.start()
+    env = {"MAIL_ENABLED": "1", "SMTP_SERVER": "127.0.0.1", "SMTP_PORT": str(port), "SMTP_USE_TLS": "false",
+           "SMTP_USERNAME": "", "SMTP_FROM": "bench@qomex.top", "MAIL_SMTP_CONNECTIONS": str(args.connections),
+           "MAIL_BATCH": "100", "MAIL_DOMAIN_RATE": "1000000", "MAIL_DOMAIN_BURST": "1000000"}
+    results = {}
+    try:
+        for mode in args.modes:
+            before = handler.received
+            results[mode] = run_isolated("bench.mailer", env, ["--worker", mode, "--emails", str(args.emails),
+                                                               "--domains", str(args.domains)])
+            results[mode]["received"] = handler.received - before
+    finally:
+        controller.stop()
+
+    for mode, r in results.items():
+        print(f"{mode:>10}: {r['emails_per_s']:>8} emails/s  ({r['seconds']}s, received={r['received']}, "
+              f"connects={r['stats']['connects']})", file=sys.stderr)
+    print(json.dumps(results))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+# bench/sqlite_profile.py
+"""python -m bench.sqlite_profile --requests 2000 --concurrency 50"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+from bench.common import asgi_client, latency_summary, run_isolated
+
+PROFILES = ("default", "production")
+
+
+async def _worker_run(requests: int, concurrency: int) -> dict:
+    from main import app
+    from postback import POSTBACK_SECRET
+
+    latencies, errors = [], 0
+    counter = iter(range(requests))
+
+    async with asgi_client(app) as client:
+        async def worker():
+            nonlocal errors
+            for i in counter:
+                t0 = time.perf_counter()
+                r = await client.get("/postback", params={
+                    "token": POSTBACK_SECRET, "event": "deposit",
+                    "click_id": f"bench-{i}", "amount": "10", "currency": "USD",
+                })
+                latencies.append(time.perf_counter() - t0)
+                if r.status_code != 200:
+                    errors += 1
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - t0
+
+    return {**latency_summary(latencies, elapsed), "errors": errors}
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--requests", type=int, default=2000)
+    ap.add_argument("--concurrency", type=int, default=50)
+    ap.add_argument("--worker", choices=PROFILES, help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.worker:
+        print(json.dumps(asyncio.run(_worker_run(args.requests, args.concurrency))))
+        return
+
+    results = {}
+    for profile in PROFILES:
+        results[profile] = run_isolated(
+            "bench.sqlite_profile",
+            {"SQLITE_PROFILE": profile, "POSTBACK_INGEST": "sync"},
+            ["--worker", profile, "--requests", str(args.requests), "--concurrency", str(args.concurrency)],
+        )
+        r = results[profile]
+        print(f"{profile:>10}: {r['rps']:>8} inserts/s  p50={r['p50_ms']}ms  p99={r['p99_ms']}ms  errors={r['errors']}",
+              file=sys.stderr)
+    print(json.dumps(results))
+
+
+if __name__ == "__main__":
+    main()
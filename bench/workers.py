@@ -0,0 +1,159 @@
+# bench/workers.py
+"""python -m bench.workers --workers 1 2 4 8 (нужны gunicorn и httpx)"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench.common import ROOT, latency_summary, temp_db_url
+
+DEFAULT_SCENARIOS = ["profile", "deposit_check", "postback_get"]
+STARTUP_TIMEOUT = 60  # сек
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_ready(url: str, proc: subprocess.Popen, workers: int):
+    """Готов — когда пачка параллельных запросов (разойдутся по воркерам) проходит целиком."""
+    import httpx
+    from concurrent.futures import ThreadPoolExecutor
+
+    def probe(_):
+        try:
+            return httpx.get(url + "/metrics", timeout=2).status_code == 200
+        except httpx.HTTPError:
+            return False
+
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    with ThreadPoolExecutor(workers * 4) as pool:
+        while time.monotonic() < deadline:
+            if proc.poll() is not None:
+                raise RuntimeError(f"gunicorn exited with code {proc.returncode}")
+            if all(pool.map(probe, range(workers * 4))):
+                return
+            time.sleep(0.5)
+    raise RuntimeError("gunicorn did not start in time")
+
+
+async def _client_run(url: str, scenario: str, users: int, requests: int, concurrency: int) -> dict:
+    import httpx
+    from bench.funnel import scenarios
+    from postback import POSTBACK_SECRET
+
+    make_request = scenarios(users, POSTBACK_SECRET)[scenario]
+    latencies, errors = [], 0
+    counter = iter(range(requests))
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=30) as client:
+        async def worker():
+            nonlocal errors
+            for i in counter:
+                method, path, kwargs = make_request(i)
+                t0 = time.perf_counter()
+                try:
+                    r = await client.request(method, path, **kwargs)
+                except httpx.TransportError:  # воркер перезапущен / соединение сброшено
+                    errors += 1
+                    continue
+                latencies.append(time.perf_counter() - t0)
+                if r.status_code >= 400:
+                    errors += 1
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return {"latencies": latencies, "errors": errors}
+
+
+def _drive(url: str, env: dict, scenario: str, args) -> dict:
+    """Нагрузка из args.clients процессов сразу; rps — по общему времени."""
+    per_client = max(1, args.requests // args.clients)
+    conc = max(1, args.concurrency // args.clients)
+    cmd = [sys.executable, "-m", "bench.workers", "--client", url, "--scenario", scenario,
+           "--users", str(args.users), "--requests", str(per_client), "--concurrency", str(conc)]
+    t0 = time.perf_counter()
+    procs = [subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=subprocess.PIPE, text=True)
+             for _ in range(args.clients)]
+    outputs = [p.communicate()[0] for p in procs]
+    elapsed = time.perf_counter() - t0
+    latencies, errors = [], 0
+    for out in outputs:
+        r = json.loads(out.strip().splitlines()[-1])
+        latencies += r["latencies"]
+        errors += r["errors"]
+    return {**latency_summary(latencies, elapsed), "errors": errors}
+
+
+def _run_workers(n: int, args) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        port = _free_port()
+        env = {**os.environ, "PYTHONPATH": str(ROOT), "DATABASE_URL": temp_db_url(tmp),
+               "WEB_CONCURRENCY": str(n), "BIND": f"127.0.0.1:{port}",
+               "APP_LOG_FILE": os.path.join(tmp, "app.log"), "POSTBACK_INGEST": args.ingest,
+               "RATELIMIT_ENABLED": os.getenv("RATELIMIT_ENABLED", "0"),  # клиенты — с одного IP
+               # клиенты подписывают cookie сессии тем же ключом, что и воркеры
+               "SESSION_SECRET": os.getenv("SESSION_SECRET", "bench-session-secret")}
+        subprocess.run([sys.executable, "-m", "bench.workers", "--seed", "--users", str(args.users)],
+                       cwd=ROOT, env=env, check=True)
+        server_log = open(os.path.join(tmp, "gunicorn.log"), "w+")
+        server = subprocess.Popen(["gunicorn", "main:app", "-c", "gunicorn.conf.py"], cwd=ROOT, env=env,
+                                  stdout=server_log, stderr=subprocess.STDOUT)
+        url = f"http://127.0.0.1:{port}"
+        try:
+            _wait_ready(url, server, n)
+            results = {name: _drive(url, env, name, args) for name in args.scenarios}
+        finally:
+            server.terminate()
+            server.wait(timeout=30)
+        if any(r["errors"] for r in results.values()):
+            server_log.seek(0)
+            sys.stderr.write(server_log.read()[-4000:])
+        server_log.close()
+        return results
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    ap.add_argument("--users", type=int, default=10_000)
+    ap.add_argument("--requests", type=int, default=4000, help="запросов на сценарий")
+    ap.add_argument("--concurrency", type=int, default=64, help="всего, делится между клиентами")
+    ap.add_argument("--clients", type=int, default=4, help="клиентских процессов")
+    ap.add_argument("--scenarios", nargs="+", default=DEFAULT_SCENARIOS)
+    ap.add_argument("--ingest", choices=("sync", "queue"), default="sync", help="режим POSTBACK_INGEST")
+    ap.add_argument("--seed", action="store_true", help=argparse.SUPPRESS)
+    ap.add_argument("--client", help=argparse.SUPPRESS)
+    ap.add_argument("--scenario", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.seed:
+        from bench.funnel import seed
+        from migrations import run_migrations
+        run_migrations()
+        seed(args.users, 0)
+        return
+    if args.client:
+        print(json.dumps(asyncio.run(_client_run(args.client, args.scenario, args.users,
+                                                 args.requests, args.concurrency))))
+        return
+
+    results = {}
+    for n in args.workers:
+        results[n] = _run_workers(n, args)
+        for name, r in results[n].items():
+            base = results[args.workers[0]][name]["rps"]
+            print(f"workers={n:<2} {name:>15}: {r['rps']:>8} rps (x{r['rps'] / base if base else 0:.2f})  "
+                  f"p50={r['p50_ms']}ms  p99={r['p99_ms']}ms  errors={r['errors']}", file=sys.stderr)
+    print(json.dumps(results))
+
+
+if __name__ == "__main__":
+    main()
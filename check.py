@@ -1,18 +1,19 @@
 # check.py
 from fastapi import APIRouter, Request, Form, Depends
-from fastapi.templating import Jinja2Templates
 from fastapi.responses import RedirectResponse
-from sqlalchemy.orm import Session
-from typing import Optional
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from urllib.parse import urlencode, urlsplit, urlunsplit, parse_qsl
 import os
 
-from database import SessionLocal
+from database import get_db, single_writer
 from models import User, PostbackLog
 from utils import gen_click_id, attach_pending_postbacks
+from user_cache import user_cache
+from templating import templates
+from sessions import current_session, set_session_cookie
 
 router = APIRouter(prefix="/check")
-templates = Jinja2Templates(directory="templates")
 
 PO_BASE = "https://u3.shortink.io/smart/16ZjQA8RfjI79Z"
 OUT_PARAM_NAME = "click_id"
@@ -20,20 +21,6 @@ OUT_PARAM_NAME = "click_id"
 IS_SECURE_COOKIES = os.getenv("ENV", "dev") != "dev"
 SAMESITE_POLICY = "Lax"
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
-def _get_user_id_from_cookie(request: Request) -> Optional[int]:
-    v = request.cookies.get("user_id")
-    try:
-        return int(v) if v is not None else None
-    except:
-        return None
-
 def _add_params(url: str, params: dict) -> str:
     u = urlsplit(url)
     q = dict(parse_qsl(u.query))
@@ -46,23 +33,27 @@ def _ref_link_from_request(request: Request) -> tuple[str, str]:
     return click_id, ref_link
 
 @router.get("")
-async def check_form(request: Request, db: Session = Depends(get_db), user_id: Optional[int] = None):
-    if user_id is None:
-        user_id = _get_user_id_from_cookie(request)
+async def check_form(request: Request, db: AsyncSession = Depends(get_db)):
+    # пользователь — только из подписанной сессии (user_id из query/cookie больше не принимаем)
+    session = current_session(request)
+    user_id = session.user_id if session else None
 
     click_id, ref_link = _ref_link_from_request(request)
 
+    me = None
     if user_id:
-        me = db.get(User, user_id)
+        me = await db.get(User, user_id)
         if me:
-            changed = False
-            if not me.click_id:
-                me.click_id = click_id
-                changed = True
-            if changed:
-                db.commit(); db.refresh(me)
-            # подтянуть «висящие» события по click_id/trader_id
-            attach_pending_postbacks(db, me)
+            async with single_writer():
+                changed = False
+                if not me.click_id:
+                    me.click_id = click_id
+                    changed = True
+                if changed:
+                    await db.commit(); await db.refresh(me)
+                    user_cache.invalidate(me.id)
+                # подтянуть «висящие» события по click_id/trader_id
+                await db.run_sync(attach_pending_postbacks, me)
 
     resp = templates.TemplateResponse("register_check.html", {
         "request": request,
@@ -72,18 +63,20 @@ async def check_form(request: Request, db: Session = Depends(get_db), user_id: O
     })
     resp.set_cookie("click_id", click_id, max_age=60*60*24*30,
                     secure=IS_SECURE_COOKIES, samesite=SAMESITE_POLICY)
+    if me:
+        # висящие события могли дать trader_id/депозит — обновляем токен сразу
+        set_session_cookie(resp, me, session.remember, session.sid)
     return resp
 
 @router.post("")
 async def check_trader_id(
     request: Request,
     trader_id: str = Form(...),
-    user_id: Optional[int] = Form(None),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     trader_id = (trader_id or "").strip()
-    if user_id is None:
-        user_id = _get_user_id_from_cookie(request)
+    session = current_session(request)
+    user_id = session.user_id if session else None
 
     click_id, ref_link = _ref_link_from_request(request)
 
@@ -95,7 +88,7 @@ async def check_trader_id(
             "ref_link": ref_link,
         })
 
-    me = db.get(User, user_id)
+    me = await db.get(User, user_id)
     if not me:
         return templates.TemplateResponse("register_check.html", {
             "request": request,
@@ -104,25 +97,31 @@ async def check_trader_id(
             "ref_link": ref_link,
         })
 
-    # синхронизируем click_id (если надо)
-    if not me.click_id and click_id:
-        me.click_id = click_id
-        db.commit(); db.refresh(me)
+    async with single_writer():
+        # синхронизируем click_id (если надо)
+        if not me.click_id and click_id:
+            me.click_id = click_id
+            await db.commit(); await db.refresh(me)
+            user_cache.invalidate(me.id)
 
-    # 1) перед проверкой подтянем все «висящие» логи
-    attach_pending_postbacks(db, me)
+        # 1) перед проверкой подтянем все «висящие» логи
+        await db.run_sync(attach_pending_postbacks, me)
 
     # 2) если всё ещё нет trader_id — попробуем найти его ЛОКАЛЬНО в логах по введённому trader_id
     if not me.trader_id and trader_id:
-        pb = (db.query(PostbackLog)
-                .filter(PostbackLog.trader_id == trader_id)
-                .order_by(PostbackLog.id.desc())
-                .first())
+        pb = await db.scalar(select(PostbackLog)
+                             .where(PostbackLog.trader_id == trader_id)
+                             .order_by(PostbackLog.id.desc())
+                             .limit(1))
         if pb:
-            # прикрепим трейдер к пользователю и применим все его события
-            me.trader_id = trader_id
-            db.commit(); db.refresh(me)
-            attach_pending_postbacks(db, me)
+            # прикрепим трейдер к пользователю и применим все его события; привязку в агрегатах
+            # считает attach_pending_postbacks по дню лога — как rollups.backfill
+            async with single_writer():
+                await db.run_sync(attach_pending_postbacks, me, trader_id)
+                if not me.trader_id:  # висящих логов нет — лог уже привязан к другому
+                    me.trader_id = trader_id
+                    await db.commit(); await db.refresh(me)
+                    user_cache.invalidate(me.id)
 
     # 3) после всех попыток — если trader_id так и нет, показываем ожидание
     if not me.trader_id:
@@ -147,4 +146,5 @@ async def check_trader_id(
     resp = RedirectResponse(url=f"/deposit-check?trader_id={me.trader_id}", status_code=302)
     resp.set_cookie("trader_id", me.trader_id, max_age=60*60*24*30,
                     secure=IS_SECURE_COOKIES, samesite=SAMESITE_POLICY)
+    set_session_cookie(resp, me, session.remember, session.sid)
     return resp
@@ -0,0 +1,169 @@
+# cluster.py
+"""Синхронизация кэшей между воркерами (cache_events) и задачи ведущего воркера."""
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable
+
+from sqlalchemy import delete, event, func, insert, or_, select
+from sqlalchemy.orm import Session
+
+from database import APP_WORKERS, AsyncSessionLocal, lock_path, single_writer
+from locks import hold_lock
+from models import CacheEvent, FxRate, RevokedSession, User
+from user_cache import user_cache
+
+CACHE_SYNC = os.getenv("CACHE_SYNC", "1" if APP_WORKERS > 1 else "0") == "1"
+CACHE_SYNC_INTERVAL = float(os.getenv("CACHE_SYNC_INTERVAL", "1.0"))  # сек
+CACHE_EVENTS_KEEP = int(os.getenv("CACHE_EVENTS_KEEP", "3600"))      # сек хранения событий
+CACHE_SYNC_BATCH = 1000
+# id событий выдаются до commit: на Postgres меньший id может появиться позже большего.
+# Пропуски ждём CACHE_SYNC_GAP_TIMEOUT сек (откаченные транзакции оставляют их навсегда)
+CACHE_SYNC_GAP_TIMEOUT = float(os.getenv("CACHE_SYNC_GAP_TIMEOUT", "60"))  # сек
+CACHE_SYNC_MAX_GAPS = 1000
+PRUNE_INTERVAL = 60  # сек
+LEADER_POLL_INTERVAL = float(os.getenv("LEADER_POLL_INTERVAL", "5"))  # сек между попытками взять замок
+
+log = logging.getLogger("cluster")
+
+
+def is_leader() -> bool:
+    return APP_WORKERS <= 1 or hold_lock(lock_path("leader"))
+
+
+# --- публикация ---
+
+def _cache_key(obj) -> tuple[str, str | None] | None:
+    if isinstance(obj, User):
+        return ("users", str(obj.id)) if obj.id is not None else None
+    if isinstance(obj, FxRate):
+        return ("fx", None)
+    if isinstance(obj, RevokedSession):
+        return ("sessions", None)
+    return None
+
+@event.listens_for(Session, "after_flush")
+def _publish(session, flush_context):
+    if not CACHE_SYNC:
+        return
+    # после flush списки dirty/deleted/new ещё в состоянии «до flush»
+    keys = {key for obj in (*session.dirty, *session.deleted, *session.new)
+            if (key := _cache_key(obj)) is not None}
+    if keys:
+        session.connection().execute(insert(CacheEvent),
+                                     [{"cache": cache, "key": key} for cache, key in keys])
+
+
+# --- приём ---
+
+class CacheSync:
+    def __init__(self, gap_timeout: float = CACHE_SYNC_GAP_TIMEOUT):
+        self.last_id: int | None = None
+        self.gaps: dict[int, float] = {}  # пропущенный id -> когда заметили (monotonic)
+        self.gap_timeout = gap_timeout
+        self.applied = 0
+
+    async def _fetch(self, db):
+        if self.last_id is None:  # старт: всё, что было до нас, уже в БД
+            self.last_id = (await db.scalar(select(func.max(CacheEvent.id)))) or 0
+            return []
+        newer = CacheEvent.id > self.last_id
+        return (await db.execute(
+            select(CacheEvent.id, CacheEvent.cache, CacheEvent.key)
+            .where(or_(newer, CacheEvent.id.in_(list(self.gaps))) if self.gaps else newer)
+            .order_by(CacheEvent.id).limit(CACHE_SYNC_BATCH)
+        )).all()
+
+    def _advance(self, rows) -> bool:
+        """Сдвигает last_id и учитывает пропуски; False — пропусков слишком много, кэш не догнать."""
+        now = time.monotonic()
+        gaps = {i: seen for i, seen in self.gaps.items() if now - seen < self.gap_timeout}
+        last, overflow = self.last_id, False
+        for r in rows:
+            if r.id <= last:  # пропуск дождались
+                gaps.pop(r.id, None)
+                continue
+            if r.id - last - 1 > CACHE_SYNC_MAX_GAPS:
+                overflow = True
+            else:
+                gaps.update(dict.fromkeys(range(last + 1, r.id), now))
+            last = r.id
+        self.last_id = last
+        if overflow or len(gaps) > CACHE_SYNC_MAX_GAPS:
+            self.gaps = {}
+            return False
+        self.gaps = gaps
+        return True
+
+    async def poll(self) -> int:
+        from fx import refresh as refresh_fx
+        from sessions import refresh_deny_list
+
+        async with AsyncSessionLocal() as db:
+            rows = await self._fetch(db)
+        in_order = self._advance(rows)
+        if not rows:
+            return 0
+        user_ids = {int(r.key) for r in rows if r.cache == "users" and r.key}
+        if not in_order or len(rows) == CACHE_SYNC_BATCH or any(r.cache == "users" and not r.key for r in rows):
+            user_cache.clear()  # отстали (или сброс целиком) — дешевле начать кэш заново
+        elif user_ids:
+            user_cache.invalidate(*user_ids)
+        if any(r.cache == "fx" for r in rows):
+            await refresh_fx()
+        if any(r.cache == "sessions" for r in rows):
+            await refresh_deny_list()
+        self.applied += len(rows)
+        return len(rows)
+
+    def stats(self) -> dict:
+        return {"last_id": self.last_id or 0, "gaps": len(self.gaps), "applied": self.applied}
+
+
+cache_sync = CacheSync()
+
+
+async def prune(keep_seconds: int = CACHE_EVENTS_KEEP) -> int:
+    cutoff = datetime.utcnow() - timedelta(seconds=keep_seconds)
+    async with single_writer():
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(delete(CacheEvent).where(CacheEvent.created_at < cutoff))
+            await db.commit()
+    return result.rowcount
+
+
+async def run_cache_sync(interval: float = CACHE_SYNC_INTERVAL):
+    while True:
+        try:
+            await cache_sync.poll()
+        except Exception:
+            log.exception("CACHE_SYNC_FAILED")
+        await asyncio.sleep(interval)
+
+
+async def run_prune(interval: float = PRUNE_INTERVAL):
+    """Задача ведущего воркера (см. run_leader)."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await prune()
+        except Exception:
+            log.exception("CACHE_EVENTS_PRUNE_FAILED")
+
+
+# --- ведущий воркер ---
+
+async def run_leader(jobs: dict[str, Callable[[], Awaitable]], interval: float = LEADER_POLL_INTERVAL):
+    """Ждёт замок leader и запускает задачи-одиночки jobs (имя -> фабрика корутины)."""
+    while not is_leader():
+        await asyncio.sleep(interval)
+    log.info("LEADER_ACQUIRED pid=%d jobs=%s", os.getpid(), ",".join(jobs))
+    tasks = [asyncio.create_task(factory(), name=name) for name, factory in jobs.items()]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
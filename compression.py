@@ -0,0 +1,145 @@
+# compression.py
+"""gzip / brotli сжатие динамических ответов на уровне ASGI."""
+import os
+import zlib
+
+from metrics import compression_bytes
+from static_pipeline import accepts
+
+try:
+    import brotli
+except ImportError:  # опционально: без него — только gzip
+    brotli = None
+
+COMPRESSION_ENABLED = os.getenv("COMPRESSION", "1") == "1"
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+COMPRESSION_GZIP_LEVEL = int(os.getenv("COMPRESSION_GZIP_LEVEL", "6"))
+COMPRESSION_BROTLI_QUALITY = int(os.getenv("COMPRESSION_BROTLI_QUALITY", "4"))  # 11 — для сборки статики, не для запроса
+COMPRESSION_TYPES = tuple(t.strip() for t in os.getenv(
+    "COMPRESSION_TYPES",
+    "text/html,text/css,text/plain,text/csv,text/xml,application/json,application/x-ndjson,"
+    "application/javascript,application/xml,image/svg+xml",
+).split(",") if t.strip())
+COMPRESSION_EXCLUDE = tuple(p.strip() for p in os.getenv(
+    "COMPRESSION_EXCLUDE", "/postback,/static").split(",") if p.strip())
+
+_SKIP_STATUSES = {204, 304}
+
+
+def pick_encoding(accept_encoding: str) -> str | None:
+    if brotli is not None and accepts(accept_encoding, "br"):
+        return "br"
+    if accepts(accept_encoding, "gzip"):
+        return "gzip"
+    return None
+
+
+class _Compressor:
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == "br":
+            self._c = brotli.Compressor(quality=COMPRESSION_BROTLI_QUALITY)
+        else:
+            self._c = zlib.compressobj(COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 31)  # 31 — gzip-обёртка
+
+    def chunk(self, data: bytes) -> bytes:
+        """Сжатый кусок, который можно отдать клиенту сразу."""
+        if self.encoding == "br":
+            return self._c.process(data) + self._c.flush()
+        return self._c.compress(data) + self._c.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self, data: bytes = b"") -> bytes:
+        if self.encoding == "br":
+            return self._c.process(data) + self._c.finish()
+        return self._c.compress(data) + self._c.flush()
+
+
+def compress_body(data: bytes, encoding: str) -> bytes:
+    """Сжать тело целиком (для заранее готовых ответов, см. templating.cached_page)."""
+    return _Compressor(encoding).finish(data)
+
+
+def _header(headers: list, name: bytes) -> bytes | None:
+    for k, v in headers:
+        if k.lower() == name:
+            return v
+    return None
+
+
+def _compressible(headers: list) -> bool:
+    content_type = (_header(headers, b"content-type") or b"").decode("latin-1").lower()
+    return content_type.startswith(COMPRESSION_TYPES)
+
+
+class CompressionMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if (not COMPRESSION_ENABLED or scope["type"] != "http" or scope["method"] == "HEAD"
+                or scope["path"].startswith(COMPRESSION_EXCLUDE)):
+            return await self.app(scope, receive, send)
+
+        accept_encoding = ""
+        for k, v in scope["headers"]:
+            if k == b"accept-encoding":
+                accept_encoding = v.decode("latin-1")
+                break
+        encoding = pick_encoding(accept_encoding)
+
+        start = None        # отложенный http.response.start
+        compressor = None   # не None — сжимаем этот ответ
+        passthrough = False
+
+        async def send_wrapper(message):
+            nonlocal start, compressor, passthrough
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                status = message["status"]
+                if (300 <= status < 400 or status in _SKIP_STATUSES
+                        or _header(headers, b"content-encoding") is not None or not _compressible(headers)):
+                    passthrough = True
+                    return await send(message)
+                headers.append((b"vary", b"Accept-Encoding"))
+                if encoding is None:
+                    passthrough = True
+                    return await send({**message, "headers": headers})
+                start = {**message, "headers": headers}
+                return
+
+            if message["type"] != "http.response.body" or passthrough:
+                return await send(message)
+
+            body, more_body = message.get("body", b""), message.get("more_body", False)
+
+            if compressor is None:
+                headers = start["headers"]
+                declared = _header(headers, b"content-length")
+                size = len(body) if not more_body else int(declared) if declared else None
+                if size is not None and size < COMPRESSION_MIN_SIZE:
+                    passthrough = True
+                    await send(start)
+                    return await send(message)
+
+                compressor = _Compressor(encoding)
+                headers = [(k, v) for k, v in headers if k.lower() != b"content-length"]
+                headers.append((b"content-encoding", encoding.encode()))
+                etag = _header(headers, b"etag")
+                if etag is not None and not etag.startswith(b"W/"):
+                    # байты уже другие — сильный ETag превращаем в слабый
+                    headers = [(k, b"W/" + v if k.lower() == b"etag" else v) for k, v in headers]
+                if not more_body:
+                    out = compressor.finish(body)
+                    headers.append((b"content-length", str(len(out)).encode()))
+                    compression_bytes.inc(encoding, "in", amount=len(body))
+                    compression_bytes.inc(encoding, "out", amount=len(out))
+                    await send({**start, "headers": headers})
+                    return await send({"type": "http.response.body", "body": out})
+                await send({**start, "headers": headers})
+
+            out = compressor.chunk(body) if more_body else compressor.finish(body)
+            compression_bytes.inc(encoding, "in", amount=len(body))
+            compression_bytes.inc(encoding, "out", amount=len(out))
+            await send({"type": "http.response.body", "body": out, "more_body": more_body})
+
+        await self.app(scope, receive, send_wrapper)
@@ -1,9 +1,17 @@
 from fastapi import APIRouter, Request
-from fastapi.templating import Jinja2Templates
+from fastapi.responses import RedirectResponse
+from templating import cached_page, login_variant
+from sessions import current_session
+from funnel import NEXT_STEP, VERIFIED
 
 router = APIRouter()
-templates = Jinja2Templates(directory="templates")
 
 @router.get("/dashboard")
 async def dashboard(request: Request):
-    return templates.TemplateResponse("dashboard.html", {"request": request})
+    # только прошедшим воронку; остальных — на их шаг (состояние из токена, без БД)
+    session = current_session(request)
+    if not session:
+        return RedirectResponse("/auth")
+    if session.funnel_state != VERIFIED:
+        return RedirectResponse(NEXT_STEP[session.funnel_state])
+    return cached_page(request, "dashboard.html", login_variant(request), vary="Cookie")
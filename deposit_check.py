@@ -1,22 +1,15 @@
 # deposit_check.py
 from fastapi import APIRouter, Request, Depends
-from fastapi.templating import Jinja2Templates
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import Optional
-from database import SessionLocal
-from models import User
+from database import get_db
+from user_cache import get_user, get_user_by_trader_id
+from sessions import current_session
+from templating import templates
+from funnel import MIN_DEPOSIT
 
 router = APIRouter()
-templates = Jinja2Templates(directory="templates")
 
-MIN_DEPOSIT = 50.0
-
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
 
 def get_cookie(request: Request, key: str) -> Optional[str]:
     return request.cookies.get(key)
@@ -25,11 +18,15 @@ def get_cookie(request: Request, key: str) -> Optional[str]:
 async def deposit_check(
     request: Request,
     trader_id: Optional[str] = None,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    # если trader_id не передали в query — попробуем взять из cookie
+    # если trader_id не передали в query — попробуем взять из cookie, затем из сессии
     if not trader_id:
         trader_id = get_cookie(request, "trader_id")
+    session = current_session(request)
+    if not trader_id and session and session.has_trader:
+        me = await get_user(db, session.user_id)
+        trader_id = me.trader_id if me else None
 
     ctx = {
         "request": request,
@@ -45,18 +42,16 @@ async def deposit_check(
         # просто отрисуем страницу с формой ввода trader_id
         return templates.TemplateResponse("deposit_check.html", ctx)
 
-    user = db.query(User).filter(User.trader_id == trader_id).first()
+    user = await get_user_by_trader_id(db, trader_id)
     if not user:
         return templates.TemplateResponse("deposit_check.html", ctx)
 
     first = float(user.first_deposit or 0.0)
     total = float(user.total_deposit or 0.0)
 
-    # критерий прохождения: либо первый депозит ≥ 50, либо суммарно ≥ 50
-    passed = (first >= MIN_DEPOSIT) or (total >= MIN_DEPOSIT)
-
+    # критерий прохождения (первый или суммарный депозит ≥ MIN_DEPOSIT) проверен при записи
     ctx.update({
-        "status": "success" if passed else "fail",
+        "status": "success" if user.deposit_verified else "fail",
         "amount": first if first >= MIN_DEPOSIT else total,
         "first_deposit": first,
         "total_deposit": total,
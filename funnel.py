@@ -0,0 +1,61 @@
+# funnel.py
+"""Шаг воронки users.funnel_state; python funnel.py --backfill — досчитать после массовых UPDATE."""
+import argparse
+import os
+
+MIN_DEPOSIT = float(os.getenv("MIN_DEPOSIT", "50"))  # в базовой валюте (fx.BASE_CURRENCY), как и суммы пользователя
+
+REGISTERED = "registered"
+TRADER_LINKED = "trader_linked"
+VERIFIED = "verified"
+
+NEXT_STEP = {
+    REGISTERED: "/check",
+    TRADER_LINKED: "/deposit-check",
+    VERIFIED: "/dashboard",
+}
+
+
+def deposit_passed(first_deposit, total_deposit) -> bool:
+    return (first_deposit or 0.0) >= MIN_DEPOSIT or (total_deposit or 0.0) >= MIN_DEPOSIT
+
+
+def update_state(user):
+    """Пересчитать deposit_verified и funnel_state объекта User (до записи в БД)."""
+    user.deposit_verified = bool(user.deposit_verified) or deposit_passed(user.first_deposit, user.total_deposit)
+    if user.deposit_verified:
+        user.funnel_state = VERIFIED
+    elif user.trader_id:
+        user.funnel_state = TRADER_LINKED
+    else:
+        user.funnel_state = REGISTERED
+
+
+def backfill(conn) -> int:
+    """Пересчитать обе колонки у всех пользователей одним UPDATE. Возвращает число строк."""
+    from sqlalchemy import case, func, or_, update
+    from models import User
+
+    verified = or_(User.deposit_verified.is_(True),  # NULL-безопасно: без депозита — false, не NULL
+                   func.coalesce(User.first_deposit, 0.0) >= MIN_DEPOSIT,
+                   func.coalesce(User.total_deposit, 0.0) >= MIN_DEPOSIT)
+    stmt = update(User.__table__).values(
+        deposit_verified=verified,
+        funnel_state=case((verified, VERIFIED), (User.trader_id.is_not(None), TRADER_LINKED), else_=REGISTERED),
+    )
+    return conn.execute(stmt).rowcount
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Состояние воронки пользователей")
+    ap.add_argument("--backfill", action="store_true", help="пересчитать funnel_state и deposit_verified")
+    args = ap.parse_args()
+    if args.backfill:
+        from sqlalchemy import insert
+        from database import engine
+        from models import CacheEvent
+        with engine.begin() as conn:
+            print(f"users updated: {backfill(conn)}")
+            conn.execute(insert(CacheEvent).values(cache="users", key=None))  # воркерам — сбросить кэш
+    else:
+        ap.print_help()
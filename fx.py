@@ -0,0 +1,117 @@
+# fx.py
+"""Курсы валют и пересчёт депозитов в BASE_CURRENCY; python fx.py --backfill — досчитать amount_base."""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+
+from sqlalchemy import select, update
+
+from database import AsyncSessionLocal
+from metrics import Counter
+from models import FxRate, PostbackLog
+
+BASE_CURRENCY = os.getenv("BASE_CURRENCY", "USD").strip().upper()
+FX_RATES_FILE = os.getenv("FX_RATES_FILE", "fx_rates.json")
+FX_REFRESH_INTERVAL = int(os.getenv("FX_REFRESH_INTERVAL", "3600"))  # сек; 0 — без фонового обновления
+
+log = logging.getLogger("fx")
+
+unknown_currency = Counter("fx_unknown_currency_total", "Amounts without an FX rate (not counted in deposits)",
+                           ("currency",))
+
+
+def _read_file(path: str) -> dict[str, float]:
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    return {str(k).strip().upper(): float(v) for k, v in data.items() if v}
+
+
+class FxRates:
+    def __init__(self):
+        self._rates: dict[str, float] = {BASE_CURRENCY: 1.0}
+        self.loaded_at: float | None = None
+
+    def load(self, db) -> int:
+        """Перечитывает файл и таблицу (db — Session или Connection). Возвращает число курсов."""
+        rates = {BASE_CURRENCY: 1.0}
+        rates.update(_read_file(FX_RATES_FILE))
+        for currency, rate in db.execute(select(FxRate.currency, FxRate.rate)):
+            if rate:
+                rates[currency.upper()] = rate
+        rates[BASE_CURRENCY] = 1.0
+        self._rates = rates  # подмена целиком: читатели видят либо старый, либо новый словарь
+        self.loaded_at = time.time()
+        return len(rates)
+
+    def rate(self, currency: str | None) -> float | None:
+        """Курс к базовой валюте; None — курса нет."""
+        return self._rates.get((currency or "").strip().upper() or BASE_CURRENCY)
+
+    def to_base(self, amount: float, currency: str | None) -> float | None:
+        """amount в базовой валюте; None — курса нет (сумму не учитываем, а не берём как есть)."""
+        rate = self.rate(currency)
+        if rate is None:
+            if amount:
+                cur = (currency or "").strip().upper()[:10]
+                unknown_currency.inc(cur)
+                log.warning("FX_UNKNOWN_CURRENCY %s amount=%s: not counted in deposits", cur, amount)
+            return None
+        return round((amount or 0.0) * rate, 6)
+
+    def snapshot(self) -> dict[str, float]:
+        return dict(self._rates)
+
+
+fx_rates = FxRates()
+
+
+def backfill(conn, rates: FxRates) -> int:
+    """amount_base у логов без курса, для валют, курс которых теперь известен. Возвращает число строк."""
+    filled = 0
+    missing = conn.execute(select(PostbackLog.currency).where(PostbackLog.amount_base.is_(None)).distinct())
+    for (cur,) in missing.all():
+        rate = rates.rate(cur)
+        if rate is None:
+            continue
+        cond = PostbackLog.currency.is_(None) if cur is None else PostbackLog.currency == cur
+        filled += conn.execute(update(PostbackLog).where(cond, PostbackLog.amount_base.is_(None))
+                               .values(amount_base=PostbackLog.amount * rate)).rowcount
+    return filled
+
+
+async def refresh() -> int:
+    async with AsyncSessionLocal() as db:
+        return await db.run_sync(fx_rates.load)
+
+
+async def run_periodic(interval: int = FX_REFRESH_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await refresh()
+        except Exception:
+            log.exception("FX_REFRESH_FAILED")
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Курсы валют")
+    ap.add_argument("--backfill", action="store_true",
+                    help="досчитать amount_base у логов без курса и пересобрать балансы")
+    args = ap.parse_args()
+    if args.backfill:
+        from database import engine
+        from projections import rebuild
+        with engine.begin() as conn:
+            rates = FxRates()
+            rates.load(conn)
+            filled = backfill(conn, rates)
+            print(f"logs filled: {filled}")
+            if filled:
+                print(rebuild(conn))
+    else:
+        ap.print_help()
@@ -0,0 +1,27 @@
+# gunicorn.conf.py
+"""Запуск в несколько воркеров: gunicorn main:app -c gunicorn.conf.py."""
+import os
+import subprocess
+import sys
+
+bind = os.getenv("BIND", "127.0.0.1:8000")
+workers = int(os.getenv("WEB_CONCURRENCY", str(min(os.cpu_count() or 1, 8))))
+worker_class = "uvicorn.workers.UvicornWorker"
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "60"))
+graceful_timeout = 30
+# без preload: каждый воркер импортирует приложение сам (свои пулы соединений и event loop)
+preload_app = False
+
+raw_env = [
+    f"APP_WORKERS={workers}",
+    "MIGRATE_ON_STARTUP=0",
+]
+os.environ.setdefault("APP_LOG_MAX_BYTES", "0")
+os.environ.setdefault("APP_LOG_ROTATE_SECONDS", "0")
+
+
+def on_starting(server):
+    root = os.path.dirname(os.path.abspath(__file__))
+    for cmd in (["migrations.py"], ["static_pipeline.py"]):
+        server.log.info("running %s", " ".join(cmd))
+        subprocess.run([sys.executable, *cmd], cwd=root, check=True)
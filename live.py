@@ -0,0 +1,182 @@
+# live.py
+"""SSE /events/funnel: смена шага воронки без перезагрузки страницы."""
+import asyncio
+import json
+import logging
+import os
+import time
+
+from fastapi import APIRouter, Request
+from fastapi.responses import Response, StreamingResponse
+
+from sqlalchemy import select
+
+from database import AsyncSessionLocal
+from funnel import NEXT_STEP, VERIFIED
+from models import User
+from sessions import current_session
+from user_cache import get_funnel_state, user_cache
+
+LIVE_KEEPALIVE = float(os.getenv("LIVE_KEEPALIVE", "15"))          # сек между комментариями-пингами
+LIVE_MAX_SECONDS = float(os.getenv("LIVE_MAX_SECONDS", "300"))     # сек жизни одного потока
+LIVE_MAX_SUBSCRIBERS = int(os.getenv("LIVE_MAX_SUBSCRIBERS", "10000"))  # на процесс
+LIVE_RETRY_MS = 5000
+LIVE_BROADCAST_CHUNK = 500  # id в одном IN (...) при broadcast
+
+router = APIRouter()
+log = logging.getLogger("live")
+
+
+class Subscriber:
+    __slots__ = ("wake", "sent", "fresh")
+
+    def __init__(self):
+        self.wake = asyncio.Event()
+        self.sent = None   # последний отправленный шаг
+        self.fresh = None  # шаг, уже прочитанный broadcast'ом, — поток не читает его сам
+
+
+class Hub:
+    """Подписчики по user_id; каждого будят (Subscriber.wake) при изменении пользователя."""
+
+    def __init__(self):
+        self._subs: dict[int, set[Subscriber]] = {}
+        self._count = 0
+        self._broadcast_task = None
+        self._broadcast_again = False
+        self._touched: set[int] = set()  # изменены адресно, пока broadcast читал пачку
+        self.notified = 0
+        self.broadcasts = 0
+
+    def subscribe(self, user_id: int) -> Subscriber:
+        sub = Subscriber()
+        self._subs.setdefault(user_id, set()).add(sub)
+        self._count += 1
+        return sub
+
+    def unsubscribe(self, user_id: int, sub: Subscriber):
+        subs = self._subs.get(user_id)
+        if subs is not None and sub in subs:
+            subs.discard(sub)
+            self._count -= 1
+            if not subs:
+                del self._subs[user_id]
+
+    def notify(self, user_ids):
+        """Слушатель user_cache: None — изменились все (user_cache.clear())."""
+        if not self._subs:
+            return
+        if user_ids is None:
+            self._schedule_broadcast()
+            return
+        for user_id in user_ids:
+            subs = self._subs.get(user_id)
+            if not subs:
+                continue
+            if self._broadcast_task is not None and not self._broadcast_task.done():
+                self._touched.add(user_id)
+            for sub in subs:
+                sub.fresh = None  # значение broadcast'а могло устареть — пусть перечитает
+                sub.wake.set()
+                self.notified += 1
+
+    def _schedule_broadcast(self):
+        if self._broadcast_task is not None and not self._broadcast_task.done():
+            self._broadcast_again = True  # текущий проход мог прочитать пачку до изменения
+            return
+        self._broadcast_task = asyncio.get_running_loop().create_task(self._broadcast(), name="live_broadcast")
+
+    async def _broadcast(self):
+        self._broadcast_again = True
+        while self._broadcast_again:
+            self._broadcast_again = False
+            self.broadcasts += 1
+            user_ids = list(self._subs)
+            for i in range(0, len(user_ids), LIVE_BROADCAST_CHUNK):
+                chunk = user_ids[i:i + LIVE_BROADCAST_CHUNK]
+                self._touched.clear()
+                try:
+                    async with AsyncSessionLocal() as db:
+                        states = dict((await db.execute(
+                            select(User.id, User.funnel_state).where(User.id.in_(chunk))
+                        )).all())
+                except Exception:
+                    # не вышло — ждущие узнают о шаге при следующем изменении или переподключении
+                    log.exception("LIVE_BROADCAST_FAILED users=%d", len(chunk))
+                    continue
+                for user_id in chunk:
+                    if user_id in self._touched:
+                        continue  # уже разбужены адресно и прочитают шаг сами
+                    state = states.get(user_id)
+                    for sub in self._subs.get(user_id, ()):
+                        if state is None or state != sub.sent:  # None — пользователя нет, пусть проверит сам
+                            sub.fresh = state
+                            sub.wake.set()
+                            self.notified += 1
+        self._touched.clear()
+
+    def __len__(self):
+        return self._count
+
+    def stats(self) -> dict:
+        return {"subscribers": self._count, "users": len(self._subs), "notified": self.notified,
+                "broadcasts": self.broadcasts}
+
+
+hub = Hub()
+user_cache.subscribe(hub.notify)
+
+
+def _event(name: str, data: dict) -> bytes:
+    return f"event: {name}\ndata: {json.dumps(data)}\n\n".encode()
+
+
+async def _read_state(user_id: int):
+    async with AsyncSessionLocal() as db:
+        return await get_funnel_state(db, user_id)
+
+
+async def _stream(user_id: int):
+    # отключение клиента StreamingResponse ловит сам и отменяет генератор — отписка в finally
+    sub = hub.subscribe(user_id)
+    try:
+        yield f"retry: {LIVE_RETRY_MS}\n\n".encode()
+        deadline = time.monotonic() + LIVE_MAX_SECONDS
+        while True:
+            sub.wake.clear()  # до чтения: изменение во время чтения разбудит ещё раз
+            state, sub.fresh = sub.fresh, None
+            if state is None:
+                state = await _read_state(user_id)
+            if state is None:
+                return
+            if state != sub.sent:
+                sub.sent = state
+                yield _event("funnel", {"state": state, "next": NEXT_STEP[state]})
+                if state == VERIFIED:
+                    return  # дальше воронки ждать нечего
+            # ждём изменения пользователя; по таймауту — пинг (держит соединение через прокси)
+            while not sub.wake.is_set():
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return
+                try:
+                    await asyncio.wait_for(sub.wake.wait(), timeout=min(LIVE_KEEPALIVE, left))
+                except asyncio.TimeoutError:
+                    yield b": ping\n\n"
+    finally:
+        hub.unsubscribe(user_id, sub)
+
+
+@router.get("/events/funnel")
+async def funnel_events(request: Request):
+    session = current_session(request)
+    if not session:
+        return Response(status_code=204)
+    if len(hub) >= LIVE_MAX_SUBSCRIBERS:
+        # EventSource на не-200 не переподключается — страница остаётся на кнопке «проверить»
+        return Response(status_code=503, headers={"Retry-After": "30"})
+    return StreamingResponse(
+        _stream(session.user_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
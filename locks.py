@@ -0,0 +1,76 @@
+# locks.py
+"""Межпроцессные блокировки на flock(2)."""
+import asyncio
+import fcntl
+import os
+from contextlib import contextmanager
+
+_held: dict[str, int] = {}  # path -> fd замков, удерживаемых процессом (hold_lock)
+
+
+def _open(path: str) -> int:
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    return os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+
+
+@contextmanager
+def file_lock(path: str):
+    fd = _open(path)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)  # закрытие снимает flock
+
+
+def hold_lock(path: str) -> bool:
+    """True, если замок у этого процесса (уже был или только что захвачен)."""
+    if path in _held:
+        return True
+    fd = _open(path)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return False
+    _held[path] = fd
+    return True
+
+
+class AsyncFileLock:
+    """flock без блокировки event loop; от корутин своего процесса не защищает."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._fd = None
+        self._pid = None
+
+    def _fileno(self) -> int:
+        if self._pid != os.getpid():
+            self._fd, self._pid = _open(self.path), os.getpid()
+        return self._fd
+
+    async def acquire(self):
+        fd = self._fileno()
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return
+        except BlockingIOError:
+            pass
+        fut = asyncio.get_running_loop().run_in_executor(None, fcntl.flock, fd, fcntl.LOCK_EX)
+        try:
+            await asyncio.shield(fut)
+        except asyncio.CancelledError:
+            # поток всё равно дождётся замка — отпускаем его сразу, как только получим
+            fut.add_done_callback(lambda f: f.exception() is None and fcntl.flock(fd, fcntl.LOCK_UN))
+            raise
+
+    def release(self):
+        fcntl.flock(self._fileno(), fcntl.LOCK_UN)
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *exc):
+        self.release()
@@ -0,0 +1,119 @@
+# logging_setup.py
+"""Структурированные JSON-логи через очередь и отдельный поток записи."""
+import atexit
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import shutil
+import time
+from datetime import datetime, timezone
+
+APP_LOG_FILE = os.getenv("APP_LOG_FILE", "/tmp/postback.log")
+APP_LOG_LEVEL = os.getenv("APP_LOG_LEVEL", "INFO").upper()
+APP_LOG_MAX_BYTES = int(os.getenv("APP_LOG_MAX_BYTES", str(100 * 1024 * 1024)))
+APP_LOG_ROTATE_SECONDS = int(os.getenv("APP_LOG_ROTATE_SECONDS", "86400"))
+APP_LOG_BACKUPS = int(os.getenv("APP_LOG_BACKUPS", "14"))
+APP_LOG_QUEUE_SIZE = int(os.getenv("APP_LOG_QUEUE_SIZE", "100000"))
+POSTBACK_LOG_SAMPLE = float(os.getenv("POSTBACK_LOG_SAMPLE", "1.0"))
+
+# стандартные атрибуты LogRecord — всё остальное пришло через extra
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+_listener: logging.handlers.QueueListener | None = None
+
+
+def sample_payload(outcome: str) -> bool:
+    """Сырой payload пишем для доли POSTBACK_LOG_SAMPLE и всегда — для ошибок/отказов."""
+    if outcome not in ("ok", "no_user_yet", "duplicate", "queued"):
+        return True
+    return POSTBACK_LOG_SAMPLE >= 1.0 or random.random() < POSTBACK_LOG_SAMPLE
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler без форматирования в потоке запроса."""
+
+    def prepare(self, record):
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass  # лог не должен тормозить запрос: при переполнении запись теряем
+
+
+class CompressingRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """Ротация по размеру или по времени; старые файлы сжимаются в .gz."""
+
+    def __init__(self, filename, max_bytes: int, rotate_seconds: int, backups: int):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backups, encoding="utf-8")
+        self.rotate_seconds = rotate_seconds
+        self.opened_at = time.time()
+        self.namer = lambda name: name + ".gz"
+        self.rotator = self._gzip_rotate
+
+    @staticmethod
+    def _gzip_rotate(source: str, dest: str):
+        with open(source, "rb") as src, gzip.open(dest, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(source)
+
+    def shouldRollover(self, record) -> bool:
+        if self.rotate_seconds and time.time() - self.opened_at >= self.rotate_seconds:
+            return True
+        return bool(super().shouldRollover(record))
+
+    def doRollover(self):
+        super().doRollover()
+        self.opened_at = time.time()
+
+
+def setup_logging():
+    """Вешает очередь на root-логгер и запускает поток записи. Повторный вызов — no-op."""
+    global _listener
+    if _listener is not None:
+        return
+
+    file_handler = CompressingRotatingFileHandler(APP_LOG_FILE, APP_LOG_MAX_BYTES,
+                                                  APP_LOG_ROTATE_SECONDS, APP_LOG_BACKUPS)
+    file_handler.setFormatter(JsonFormatter())
+
+    log_queue = queue.Queue(maxsize=APP_LOG_QUEUE_SIZE)
+    root = logging.getLogger()
+    root.setLevel(APP_LOG_LEVEL)
+    root.addHandler(_DeferredQueueHandler(log_queue))
+
+    _listener = logging.handlers.QueueListener(log_queue, file_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Дописывает всё, что осталось в очереди (на shutdown)."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
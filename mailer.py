@@ -0,0 +1,327 @@
+# mailer.py
+"""Outbox исходящей почты и фоновая отправка через пул SMTP-соединений."""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import smtplib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from email.mime.text import MIMEText
+
+from sqlalchemy import delete, select, update
+
+from database import AsyncSessionLocal, write_session
+from models import OutboxEmail
+from ratelimit import Limiter, MemoryStore, TokenBucket
+
+MAIL_ENABLED = os.getenv("MAIL_ENABLED", "0") == "1"
+
+SMTP_SERVER = os.getenv("SMTP_SERVER", "smtp.gmail.com")
+SMTP_PORT = int(os.getenv("SMTP_PORT", "587"))
+SMTP_USERNAME = os.getenv("SMTP_USERNAME")  # пусто — без LOGIN (локальный relay, заглушка)
+SMTP_PASSWORD = os.getenv("SMTP_PASSWORD")
+SMTP_FROM = os.getenv("SMTP_FROM", SMTP_USERNAME)
+SMTP_USE_TLS = os.getenv("SMTP_USE_TLS", "true").lower() == "true"
+SMTP_USE_SSL = os.getenv("SMTP_USE_SSL", "false").lower() == "true"
+SMTP_TIMEOUT = float(os.getenv("SMTP_TIMEOUT", "20"))  # сек
+
+MAIL_SMTP_CONNECTIONS = int(os.getenv("MAIL_SMTP_CONNECTIONS", "2"))
+MAIL_SMTP_IDLE = float(os.getenv("MAIL_SMTP_IDLE", "60"))        # сек без писем — закрываем соединение
+MAIL_BATCH = int(os.getenv("MAIL_BATCH", "50"))
+MAIL_POLL_INTERVAL = float(os.getenv("MAIL_POLL_INTERVAL", "2"))  # сек
+MAIL_MAX_ATTEMPTS = int(os.getenv("MAIL_MAX_ATTEMPTS", "8"))
+MAIL_BACKOFF_BASE = float(os.getenv("MAIL_BACKOFF_BASE", "30"))   # сек
+MAIL_BACKOFF_MAX = float(os.getenv("MAIL_BACKOFF_MAX", "3600"))   # сек
+MAIL_DOMAIN_RATE = float(os.getenv("MAIL_DOMAIN_RATE", "30"))     # писем в минуту на домен
+MAIL_DOMAIN_BURST = int(os.getenv("MAIL_DOMAIN_BURST", "10"))
+MAIL_KEEP_DAYS = int(os.getenv("MAIL_KEEP_DAYS", "7"))
+PRUNE_INTERVAL = 3600  # сек
+
+PENDING, SENT, FAILED = "pending", "sent", "failed"
+
+log = logging.getLogger("mailer")
+
+
+def enqueue(db, to_email: str, subject: str, body: str) -> OutboxEmail:
+    """Добавить письмо в сессию вызывающего (Session или AsyncSession); уйдёт после его commit."""
+    to_email = to_email.strip()
+    row = OutboxEmail(to_email=to_email, domain=to_email.rpartition("@")[2].lower(),
+                      subject=subject, body=body, status=PENDING, next_attempt_at=datetime.utcnow())
+    db.add(row)
+    return row
+
+
+def _message(row: OutboxEmail) -> MIMEText:
+    msg = MIMEText(row.body, "html", "utf-8")
+    msg["Subject"] = row.subject
+    msg["From"] = SMTP_FROM
+    msg["To"] = row.to_email
+    return msg
+
+
+def is_permanent(e: Exception) -> bool:
+    """5xx на адрес/письмо — повтор не поможет. Ошибки логина и соединения — временные (настройки, сеть)."""
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in e.recipients.values())
+    if isinstance(e, smtplib.SMTPAuthenticationError):
+        return False
+    return isinstance(e, smtplib.SMTPResponseException) and e.smtp_code >= 500
+
+
+# --- пул SMTP-соединений ---
+
+class SmtpPool:
+    """Постоянные SMTP-соединения для пула потоков отправки."""
+
+    def __init__(self, size: int = MAIL_SMTP_CONNECTIONS):
+        self.size = size
+        self._idle: list[tuple[float, smtplib.SMTP]] = []  # (когда освободилось, соединение)
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix="smtp")
+        self._stats = {"connects": 0, "reconnects": 0, "sent": 0}
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self._stats, "idle": len(self._idle)}
+
+    def _count(self, key: str):
+        with self._lock:
+            self._stats[key] += 1
+
+    def _connect(self) -> smtplib.SMTP:
+        if SMTP_USE_SSL:
+            server = smtplib.SMTP_SSL(SMTP_SERVER, SMTP_PORT, timeout=SMTP_TIMEOUT)
+            server.ehlo()
+        else:
+            server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=SMTP_TIMEOUT)
+            server.ehlo()
+            if SMTP_USE_TLS:
+                server.starttls()
+                server.ehlo()
+        if SMTP_USERNAME:
+            server.login(SMTP_USERNAME, SMTP_PASSWORD or "")
+        self._count("connects")
+        return server
+
+    def _acquire(self) -> smtplib.SMTP:
+        now = time.monotonic()
+        stale = []
+        server = None
+        with self._lock:
+            while self._idle:
+                freed_at, candidate = self._idle.pop()
+                if now - freed_at < MAIL_SMTP_IDLE:
+                    server = candidate
+                    break
+                stale.append(candidate)
+        for old in stale:
+            _quit(old)
+        return server or self._connect()
+
+    def _release(self, server: smtplib.SMTP):
+        with self._lock:
+            self._idle.append((time.monotonic(), server))
+
+    def send_sync(self, msg):
+        server = self._acquire()
+        try:
+            server.send_message(msg)
+        except smtplib.SMTPServerDisconnected:
+            # сервер закрыл простаивавшее соединение — открываем новое и повторяем один раз
+            _quit(server)
+            self._count("reconnects")
+            server = self._connect()
+            try:
+                server.send_message(msg)
+            except BaseException:
+                _quit(server)
+                raise
+        except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused):
+            self._release(server)  # отказ по письму: соединение живо (smtplib сделал RSET)
+            raise
+        except BaseException:
+            _quit(server)
+            raise
+        self._release(server)
+        self._count("sent")
+
+    async def send(self, msg):
+        await asyncio.wrap_future(self._executor.submit(self.send_sync, msg))
+
+    def close_idle(self, max_idle: float = MAIL_SMTP_IDLE):
+        now = time.monotonic()
+        with self._lock:
+            stale = [s for t, s in self._idle if now - t >= max_idle]
+            self._idle = [(t, s) for t, s in self._idle if now - t < max_idle]
+        for server in stale:
+            self._executor.submit(_quit, server)
+
+    def close(self):
+        self.close_idle(max_idle=0)
+        self._executor.shutdown(wait=True)
+
+
+def _quit(server: smtplib.SMTP):
+    try:
+        server.quit()
+    except Exception:
+        server.close()
+
+
+# --- лимит на домен ---
+
+def domain_limiter() -> Limiter:
+    """Token bucket на домен получателя."""
+    bucket = TokenBucket(MAIL_DOMAIN_BURST, MAIL_DOMAIN_BURST * 60 / MAIL_DOMAIN_RATE)
+    return Limiter("mail_domain", bucket, MemoryStore())
+
+
+# --- отправка ---
+
+def backoff(attempts: int) -> float:
+    """Задержка перед попыткой attempts+1, с разбросом ±20% (не будим всё отложенное разом)."""
+    delay = min(MAIL_BACKOFF_MAX, MAIL_BACKOFF_BASE * 2 ** max(attempts - 1, 0))
+    return delay * random.uniform(0.8, 1.2)
+
+
+class Outbox:
+    def __init__(self, pool: SmtpPool | None = None, limiter: Limiter | None = None):
+        self.pool = pool or SmtpPool()
+        self.limiter = limiter or domain_limiter()
+        self._wake = asyncio.Event()
+        self._stats = {"sent": 0, "retried": 0, "failed": 0, "deferred": 0}
+
+    def wake(self):
+        self._wake.set()
+
+    def stats(self) -> dict:
+        return {**self._stats, **self.pool.stats()}
+
+    async def _due(self) -> list[OutboxEmail]:
+        async with AsyncSessionLocal() as db:
+            return list((await db.scalars(
+                select(OutboxEmail)
+                .where(OutboxEmail.status == PENDING, OutboxEmail.next_attempt_at <= datetime.utcnow())
+                .order_by(OutboxEmail.next_attempt_at).limit(MAIL_BATCH)
+            )).all())
+
+    async def _send(self, row: OutboxEmail):
+        try:
+            await self.pool.send(_message(row))
+            return None
+        except Exception as e:
+            return e
+
+    async def run_once(self) -> int:
+        """Одна пачка: сколько писем взято из очереди (отправлено, отложено или с ошибкой)."""
+        rows = await self._due()
+        if not rows:
+            return 0
+        now = datetime.utcnow()
+        ready, changes = [], []  # changes: (id, values)
+        for row in rows:
+            decision = self.limiter.hit(row.domain)
+            if not decision.allowed:
+                changes.append((row.id, {"next_attempt_at": now + timedelta(seconds=decision.retry_after)}))
+                self._stats["deferred"] += 1
+            else:
+                ready.append(row)
+
+        errors = await asyncio.gather(*(self._send(row) for row in ready))
+        sent_ids = []
+        for row, e in zip(ready, errors):
+            if e is None:
+                sent_ids.append(row.id)
+                continue
+            attempts = row.attempts + 1
+            error = f"{type(e).__name__}: {e}"[:1000]
+            if is_permanent(e) or attempts >= MAIL_MAX_ATTEMPTS:
+                changes.append((row.id, {"status": FAILED, "attempts": attempts, "last_error": error}))
+                self._stats["failed"] += 1
+                log.warning("MAIL_SEND_FAILED id=%s to=%s attempts=%d error=%s", row.id, row.to_email, attempts, error)
+            else:
+                retry_at = now + timedelta(seconds=backoff(attempts))
+                changes.append((row.id, {"attempts": attempts, "last_error": error, "next_attempt_at": retry_at}))
+                self._stats["retried"] += 1
+                log.info("MAIL_SEND_RETRY id=%s attempts=%d error=%s", row.id, attempts, error)
+
+        async with write_session() as db:
+            if sent_ids:
+                await db.execute(update(OutboxEmail).where(OutboxEmail.id.in_(sent_ids))
+                                 .values(status=SENT, sent_at=datetime.utcnow(), last_error=None))
+            for row_id, values in changes:
+                await db.execute(update(OutboxEmail).where(OutboxEmail.id == row_id).values(**values))
+            await db.commit()
+        self._stats["sent"] += len(sent_ids)
+        return len(rows)
+
+    async def drain(self) -> int:
+        """Все подошедшие письма, пачка за пачкой (отложенные лимитом домена — в следующий раз)."""
+        total = 0
+        while (n := await self.run_once()) == MAIL_BATCH:
+            total += n
+        return total + n
+
+    async def prune(self, keep_days: int = MAIL_KEEP_DAYS) -> int:
+        cutoff = datetime.utcnow() - timedelta(days=keep_days)
+        async with write_session() as db:
+            result = await db.execute(delete(OutboxEmail).where(OutboxEmail.status == SENT,
+                                                                OutboxEmail.sent_at < cutoff))
+            await db.commit()
+        return result.rowcount
+
+    async def run(self, interval: float = MAIL_POLL_INTERVAL):
+        if not SMTP_FROM:
+            log.error("MAIL_CONFIG_MISSING: SMTP_FROM (or SMTP_USERNAME) is not set, sender not started")
+            return
+        last_prune = 0.0
+        try:
+            while True:
+                self._wake.clear()
+                try:
+                    await self.drain()
+                    self.pool.close_idle()
+                    if time.monotonic() - last_prune >= PRUNE_INTERVAL:
+                        last_prune = time.monotonic()
+                        await self.prune()
+                except Exception:
+                    log.exception("MAIL_SENDER_FAILED")
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=interval)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.pool.close_idle(max_idle=0)
+
+
+outbox = Outbox()
+
+
+def wake():
+    """Позвать после commit транзакции с enqueue — sender этого процесса не ждёт интервала."""
+    outbox.wake()
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Очередь исходящих писем")
+    ap.add_argument("--flush", action="store_true", help="отправить все подошедшие письма и выйти")
+    ap.add_argument("--test", metavar="EMAIL", help="поставить тестовое письмо и отправить его")
+    args = ap.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+    async def _main():
+        if args.test:
+            async with write_session() as db:
+                enqueue(db, args.test, "QOMEX: тестовое письмо", "<p>Почта работает.</p>")
+                await db.commit()
+        if args.flush or args.test:
+            print(f"taken: {await outbox.drain()}  stats: {outbox.stats()}")
+        else:
+            ap.print_help()
+        outbox.pool.close()
+
+    asyncio.run(_main())
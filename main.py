@@ -1,29 +1,58 @@
+import asyncio
+import os
 from fastapi import FastAPI
-from fastapi.staticfiles import StaticFiles
-from fastapi.templating import Jinja2Templates
-from database import Base, engine
+from static_pipeline import static_app
+from database import engine, async_engine
+import metrics
+from compression import CompressionMiddleware
+from logging_setup import setup_logging, stop_logging
+from migrations import check_schema, run_migrations
 from admin import init_admin
 # грузим .env один раз на старте (чтобы SMTP/BASE_URL и т.д. были в окружении)
 from dotenv import load_dotenv
 load_dotenv(dotenv_path="/var/www/qomex/.env")
 
+# логи приложения: JSON-строки через очередь и отдельный поток записи (см. logging_setup.py)
+setup_logging()
+
 
 # --- ваши роутеры ---
 from auth import router as auth_router
-from postback import router as postback_router
+from postback import router as postback_router, ingest_queue, POSTBACK_INGEST
+from reconcile import run_periodic as run_reconcile, RECONCILE_INTERVAL
+from fx import fx_rates, run_periodic as run_fx_refresh, FX_REFRESH_INTERVAL
+import cluster
 from check import router as check_router
 from deposit_check import router as deposit_check_router
 from dashboard import router as dashboard_router
 from home import router as home_router
 from users import router as users_router
+from rollups import router as rollups_router
 from profile import router as profile_router
 from routes import router as routes_router
+from live import router as live_router, hub as live_hub
+from mailer import MAIL_ENABLED, outbox
+import ratelimit
+from sessions import SessionMiddleware, deny_list
 
 # ДОБАВИТЬ: роутер сброса пароля
 from password_reset import router as password_reset_router
 
 app = FastAPI()
 
+# Сессии: подписанный токен вместо cookie user_id, проверка без БД (sessions.py); самый внутренний слой
+app.add_middleware(SessionMiddleware)
+
+# Сжатие ответов (gzip/brotli); добавляется раньше метрик, чтобы метрики были внешним слоем
+app.add_middleware(CompressionMiddleware)
+
+# Метрики: /metrics + middleware (латентность по маршрутам, SQL на запрос)
+app.add_middleware(metrics.MetricsMiddleware)
+app.include_router(metrics.router)
+metrics.instrument_engine(engine)
+metrics.instrument_engine(async_engine.sync_engine)
+metrics.pool_gauge({"sync": engine, "async": async_engine.sync_engine})
+
 # Подключение роутеров (порядок не критичен, главное — чтобы все были добавлены)
 app.include_router(auth_router)
 app.include_router(postback_router)
@@ -32,17 +61,89 @@ app.include_router(deposit_check_router)
 app.include_router(dashboard_router)
 app.include_router(home_router)
 app.include_router(users_router)
+app.include_router(rollups_router)
 app.include_router(profile_router)
 app.include_router(routes_router)
+app.include_router(live_router)
 
 # ВАЖНО: подключаем роуты сброса пароля
 app.include_router(password_reset_router)
 
-# Статика/шаблоны
-app.mount("/static", StaticFiles(directory="static"), name="static")
-templates = Jinja2Templates(directory="templates")
+# Статика: сборка с хэшами и предсжатыми вариантами (static_pipeline.py);
+# шаблоны — общее окружение в templating.py
+app.mount("/static", static_app(), name="static")
+
+# Таблицы БД: миграции (идемпотентны, на свежей базе создают всё с нуля).
+# С несколькими воркерами их один раз запускает gunicorn.conf.py, а воркеры только проверяют версию
+if os.getenv("MIGRATE_ON_STARTUP", "1") == "1":
+    run_migrations(engine)
+else:
+    check_schema(engine)
 
-# Таблицы БД
-Base.metadata.create_all(bind=engine)
+# Курсы валют в память до первого постбэка (дальше — фоновое обновление), deny list сессий
+with engine.connect() as _conn:
+    fx_rates.load(_conn)
+    deny_list.load(_conn)
 
 init_admin(app)
+
+from passwords import queue_stats as password_queue_stats
+from user_cache import user_cache
+from templating import page_cache
+metrics.register_gauge("password_hash_pool", "bcrypt pool queue depth and counters", ("state",),
+                       lambda: {(k,): v for k, v in password_queue_stats().items()})
+metrics.register_gauge("postback_queue_depth", "Events waiting in the postback queue", (),
+                       lambda: {(): ingest_queue.qsize()})
+metrics.register_gauge("user_cache", "User lookup cache size and hit/miss counters", ("stat",),
+                       lambda: {(k,): v for k, v in user_cache.stats().items()})
+metrics.register_gauge("cache_sync", "Cross-worker cache invalidation progress", ("stat",),
+                       lambda: {(k,): v for k, v in cluster.cache_sync.stats().items()})
+metrics.register_gauge("live_events", "Open funnel event streams (SSE) and wake-ups", ("stat",),
+                       lambda: {(k,): v for k, v in live_hub.stats().items()})
+metrics.register_gauge("mail_outbox", "Outbox sender and SMTP pool counters", ("stat",),
+                       lambda: {(k,): v for k, v in outbox.stats().items()})
+metrics.register_gauge("ratelimit_store", "Rate limit store size (memory) or operations/errors (sqlite)", ("stat",),
+                       lambda: {(k,): v for k, v in ratelimit.store.stats().items()})
+metrics.register_gauge("page_cache", "Pre-rendered page cache size and hit/miss counters", ("stat",),
+                       lambda: {(k,): v for k, v in page_cache.stats().items()})
+
+# Фоновая очередь постбэков (режим POSTBACK_INGEST=queue)
+@app.on_event("startup")
+async def start_postback_queue():
+    if POSTBACK_INGEST == "queue":
+        await ingest_queue.start()
+
+@app.on_event("shutdown")
+async def drain_postback_queue():
+    await ingest_queue.stop()
+
+# Фоновые задачи: курсы, синхронизация кэшей и задачи ведущего воркера
+_background_tasks: list[asyncio.Task] = []
+
+@app.on_event("startup")
+async def start_background_tasks():
+    # задачи-одиночки: ведущий воркер поднимает их, когда получит замок (и после смерти прежнего)
+    leader_jobs = {}
+    if RECONCILE_INTERVAL > 0:
+        leader_jobs["reconcile"] = run_reconcile
+    if MAIL_ENABLED:
+        leader_jobs["mailer"] = outbox.run
+    if cluster.CACHE_SYNC:
+        leader_jobs["cache_events_prune"] = cluster.run_prune
+    if leader_jobs:
+        _background_tasks.append(asyncio.create_task(cluster.run_leader(leader_jobs), name="leader"))
+    if FX_REFRESH_INTERVAL > 0:
+        _background_tasks.append(asyncio.create_task(run_fx_refresh(), name="fx_refresh"))
+    if cluster.CACHE_SYNC:
+        _background_tasks.append(asyncio.create_task(cluster.run_cache_sync(), name="cache_sync"))
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    for task in _background_tasks:
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+
+# последним: дописываем очередь логов (после остановки очереди постбэков и фоновых задач)
+@app.on_event("shutdown")
+async def flush_logs():
+    stop_logging()
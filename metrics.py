@@ -0,0 +1,218 @@
+# metrics.py
+"""Метрики Prometheus (/metrics) без внешних зависимостей."""
+import contextvars
+import threading
+import time
+from bisect import bisect_left
+
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+from sqlalchemy import event
+
+router = APIRouter()
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 50)
+
+_registry: list = []
+_gauges: list = []
+
+
+def _fmt_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{n}="{str(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    def __init__(self, name: str, doc: str, labels: tuple = ()):
+        self.name, self.doc, self.labels = name, doc, labels
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, *label_values, amount: float = 1.0):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0.0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} counter"]
+        for values, v in sorted(self._values.items()):
+            lines.append(f"{self.name}{_fmt_labels(self.labels, values)} {v}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, doc: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name, self.doc, self.labels, self.buckets = name, doc, labels, buckets
+        self._values: dict[tuple, list] = {}  # labels -> [counts по бакетам..., sum, count]
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value: float, *label_values):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            row = self._values.get(label_values)
+            if row is None:
+                row = self._values[label_values] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            row[i] += 1
+            row[-2] += value
+            row[-1] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} histogram"]
+        for values, row in sorted(self._values.items()):
+            cumulative = 0
+            for b, n in zip(self.buckets + (float("inf"),), row):
+                cumulative += n
+                le = "+Inf" if b == float("inf") else repr(b)
+                bucket_label = f'le="{le}"'
+                lines.append(f"{self.name}_bucket{_fmt_labels(self.labels, values, bucket_label)} {cumulative}")
+            lines.append(f"{self.name}_sum{_fmt_labels(self.labels, values)} {row[-2]}")
+            lines.append(f"{self.name}_count{_fmt_labels(self.labels, values)} {row[-1]}")
+        return lines
+
+
+def register_gauge(name: str, doc: str, labels: tuple, collect):
+    """collect() -> {tuple(значения меток): число}; вызывается только при scrape."""
+    _gauges.append((name, doc, labels, collect))
+
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    for name, doc, labels, collect in _gauges:
+        lines += [f"# HELP {name} {doc}", f"# TYPE {name} gauge"]
+        for values, v in sorted(collect().items()):
+            lines.append(f"{name}{_fmt_labels(labels, values)} {v}")
+    return "\n".join(lines) + "\n"
+
+
+# --- метрики приложения ---
+
+http_requests = Counter("http_requests_total", "HTTP requests", ("route", "method", "status"))
+http_latency = Histogram("http_request_duration_seconds", "HTTP request latency", ("route", "method"))
+db_queries = Histogram("db_queries_per_request", "SQL statements per HTTP request", ("route",),
+                       buckets=COUNT_BUCKETS)
+db_time = Histogram("db_time_per_request_seconds", "Time spent in SQL per HTTP request", ("route",))
+postback_outcomes = Counter("postback_outcomes_total", "Postback outcomes by normalized event",
+                            ("event", "outcome"))
+password_hash_time = Histogram("password_hash_seconds", "bcrypt hash/verify time", ("op",),
+                               buckets=(0.05, 0.1, 0.2, 0.3, 0.5, 1.0, 2.0))
+compression_bytes = Counter("http_compression_bytes_total", "Response bytes before (in) and after (out) compression",
+                            ("encoding", "stage"))
+template_render_time = Histogram("template_render_seconds", "Jinja template render time", ("template",))
+
+KNOWN_EVENTS = {"registration", "deposit"}
+
+
+def postback_outcome(event: str, outcome: str):
+    # произвольные event от брокера в метки не пускаем — кардинальность
+    postback_outcomes.inc(event if event in KNOWN_EVENTS else "other", outcome)
+
+
+# --- SQL на запрос ---
+
+# [число запросов, суммарное время]; объект изменяемый — run_sync/greenlet видят тот же
+_request_db: contextvars.ContextVar = contextvars.ContextVar("request_db", default=None)
+_query_started: contextvars.ContextVar = contextvars.ContextVar("query_started", default=0.0)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _request_db.get() is not None:
+        _query_started.set(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    acc = _request_db.get()
+    if acc is not None:
+        acc[0] += 1
+        acc[1] += time.perf_counter() - _query_started.get()
+
+
+def instrument_engine(sync_engine):
+    event.listen(sync_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(sync_engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def pool_gauge(engines: dict):
+    """engines: {"sync": engine, "async": async_engine.sync_engine}."""
+    def collect():
+        out = {}
+        for name, eng in engines.items():
+            pool = eng.pool
+            if hasattr(pool, "checkedout"):
+                out[(name, "checked_out")] = pool.checkedout()
+                out[(name, "size")] = pool.size()
+                out[(name, "overflow")] = max(pool.overflow(), 0)  # QueuePool считает от -size
+        return out
+    register_gauge("db_pool_connections", "Connection pool usage", ("engine", "state"), collect)
+
+
+# --- шаблоны ---
+
+def instrument_templates(templates):
+    """Оборачивает templates.TemplateResponse: рендер идёт в конструкторе ответа."""
+    original = templates.TemplateResponse
+    if getattr(original, "_instrumented", False):
+        return templates
+
+    def TemplateResponse(name, *args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return original(name, *args, **kwargs)
+        finally:
+            template_render_time.observe(time.perf_counter() - t0, name)
+
+    TemplateResponse._instrumented = True
+    templates.TemplateResponse = TemplateResponse
+    return templates
+
+
+# --- ASGI-middleware ---
+
+def _route_label(scope) -> str:
+    route = scope.get("route")
+    if route is not None and getattr(route, "path", None):
+        return route.path
+    path = scope.get("path", "")
+    for prefix in ("/static", "/admin"):
+        if path.startswith(prefix):
+            return prefix
+    return "unmatched"
+
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        acc = [0, 0.0]
+        token = _request_db.set(acc)
+        t0 = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - t0
+            _request_db.reset(token)
+            route, method = _route_label(scope), scope["method"]
+            http_requests.inc(route, method, status["code"])
+            http_latency.observe(elapsed, route, method)
+            db_queries.observe(acc[0], route)
+            db_time.observe(acc[1], route)
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint():
+    return PlainTextResponse(render(), media_type="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,247 @@
+# migrations.py
+"""Миграции схемы; python migrations.py [--check-plans]."""
+import argparse
+import logging
+import sys
+import tempfile
+from datetime import datetime
+
+from sqlalchemy import (Column, DateTime, Integer, String, Table, and_, bindparam, create_engine,
+                        exists, false, func, inspect, select, text, update)
+
+from database import Base, engine, lock_path
+from locks import file_lock
+from models import CacheEvent, DailyStat, FxRate, OutboxEmail, PostbackLog, RevokedSession, User
+
+log = logging.getLogger("migrations")
+
+schema_version = Table(
+    "schema_version", Base.metadata,
+    Column("version", Integer, primary_key=True),
+    Column("name", String(255), nullable=False),
+    Column("applied_at", DateTime, default=datetime.utcnow),
+)
+
+
+# --- помощники для шагов ---
+
+def _has_column(conn, table: str, column: str) -> bool:
+    return any(c["name"] == column for c in inspect(conn).get_columns(table))
+
+def _add_column(conn, table: str, column: str, ddl_type: str):
+    if not _has_column(conn, table, column):
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl_type}"))
+
+def _create_index(conn, model, name: str):
+    """Создаёт индекс, описанный в models.py, если его ещё нет."""
+    index = next(i for i in model.__table__.indexes if i.name == name)
+    index.create(conn, checkfirst=True)
+
+def _drop_index(conn, name: str):
+    conn.execute(text(f"DROP INDEX IF EXISTS {name}"))
+
+
+# --- шаги ---
+
+def m0001_baseline(conn):
+    # недостающие таблицы целиком (на свежей базе — сразу в актуальном виде)
+    Base.metadata.create_all(conn, checkfirst=True)
+
+def m0002_postback_fingerprint(conn):
+    _add_column(conn, "postbacks_log", "fingerprint", "VARCHAR(64)")
+    _create_index(conn, PostbackLog, "ix_postbacks_log_fingerprint")
+
+def m0003_pending_partial_indexes(conn):
+    _create_index(conn, PostbackLog, "ix_postbacks_log_pending_click_id")
+    _create_index(conn, PostbackLog, "ix_postbacks_log_pending_trader_id")
+
+def m0004_hot_query_indexes(conn):
+    _create_index(conn, PostbackLog, "ix_postbacks_log_pending_id")
+    _create_index(conn, PostbackLog, "ix_postbacks_log_trader_id_id")
+    _create_index(conn, User, "ix_users_reset_token")
+    # одиночные индексы, которые перекрыты новыми (и сбивают планировщик на processed)
+    _drop_index(conn, "ix_postbacks_log_processed")
+    _drop_index(conn, "ix_postbacks_log_trader_id")
+
+def m0005_daily_stats(conn):
+    from rollups import backfill
+    DailyStat.__table__.create(conn, checkfirst=True)
+    backfill(conn)  # агрегаты по уже накопленным логам
+
+def m0006_fx_amount_base(conn):
+    from fx import FxRates
+    _add_column(conn, "postbacks_log", "amount_base", "FLOAT")
+    FxRate.__table__.create(conn, checkfirst=True)
+
+    rates = FxRates()
+    rates.load(conn)
+    currencies = [c for (c,) in conn.execute(select(PostbackLog.currency).distinct())]
+    for cur in currencies:
+        if rates.rate(cur) is None:
+            continue  # курса нет — amount_base остаётся NULL (fx.py --backfill, когда курс добавят)
+        cond = PostbackLog.currency.is_(None) if cur is None else PostbackLog.currency == cur
+        conn.execute(update(PostbackLog).where(cond).values(amount_base=PostbackLog.amount * rates.rate(cur)))
+
+    # суммы пользователей были в смешанных валютах — пересчитываем по привязанным депозитам.
+    # Если все валюты в логах по курсу 1, суммы не меняются и пользователей не трогаем.
+    if all(rates.rate(cur) == 1.0 for cur in currencies):
+        return
+    is_deposit = and_(PostbackLog.event == "deposit", PostbackLog.amount > 0, PostbackLog.user_id.is_not(None),
+                      PostbackLog.amount_base.is_not(None))
+    first_ids = select(func.min(PostbackLog.id)).where(is_deposit).group_by(PostbackLog.user_id)
+    firsts = dict(conn.execute(select(PostbackLog.user_id, PostbackLog.amount_base)
+                               .where(PostbackLog.id.in_(first_ids))).all())
+    totals = conn.execute(select(PostbackLog.user_id, func.sum(PostbackLog.amount_base))
+                          .where(is_deposit).group_by(PostbackLog.user_id)).all()
+    if totals:
+        conn.execute(update(User.__table__).where(User.__table__.c.id == bindparam("uid")),
+                     [{"uid": uid, "total_deposit": total, "first_deposit": firsts.get(uid)}
+                      for uid, total in totals])
+
+def m0007_balance_projection(conn):
+    from projections import check
+    _add_column(conn, "users", "balance_log_id", "INTEGER NOT NULL DEFAULT 0")
+    _create_index(conn, PostbackLog, "ix_postbacks_log_user_id_id")
+    # контрольная точка — последний привязанный лог; сами суммы не трогаем
+    last_ids = (select(func.max(PostbackLog.id)).where(PostbackLog.user_id == User.__table__.c.id,
+                                                       PostbackLog.processed.is_(True))
+                .scalar_subquery())
+    conn.execute(update(User.__table__).values(balance_log_id=func.coalesce(last_ids, 0)))
+    problems = check(conn, limit=1)
+    if problems:
+        log.warning("BALANCE_PROJECTION_MISMATCH e.g. %s: run python projections.py --rebuild", problems[0])
+
+def m0008_cache_events(conn):
+    CacheEvent.__table__.create(conn, checkfirst=True)
+
+def m0009_revoked_sessions(conn):
+    RevokedSession.__table__.create(conn, checkfirst=True)
+
+def m0010_funnel_state(conn):
+    from funnel import backfill
+    _add_column(conn, "users", "funnel_state", "VARCHAR(16) NOT NULL DEFAULT 'registered'")
+    backfill(conn)  # заодно впервые заполняет deposit_verified
+
+def m0011_email_outbox(conn):
+    OutboxEmail.__table__.create(conn, checkfirst=True)  # вместе с частичным индексом pending
+
+
+MIGRATIONS = [
+    (1, "baseline", m0001_baseline),
+    (2, "postback_fingerprint", m0002_postback_fingerprint),
+    (3, "pending_partial_indexes", m0003_pending_partial_indexes),
+    (4, "hot_query_indexes", m0004_hot_query_indexes),
+    (5, "daily_stats", m0005_daily_stats),
+    (6, "fx_amount_base", m0006_fx_amount_base),
+    (7, "balance_projection", m0007_balance_projection),
+    (8, "cache_events", m0008_cache_events),
+    (9, "revoked_sessions", m0009_revoked_sessions),
+    (10, "funnel_state", m0010_funnel_state),
+    (11, "email_outbox", m0011_email_outbox),
+]
+
+
+def current_version(conn) -> int:
+    schema_version.create(conn, checkfirst=True)
+    return conn.execute(select(schema_version.c.version).order_by(schema_version.c.version.desc())
+                        .limit(1)).scalar() or 0
+
+def run_migrations(bind=engine) -> int:
+    """Применяет недостающие шаги и возвращает итоговую версию схемы."""
+    with file_lock(lock_path("migrate")):
+        return _run_migrations(bind)
+
+def _run_migrations(bind) -> int:
+    with bind.begin() as conn:
+        version = current_version(conn)
+    for number, name, step in MIGRATIONS:
+        if number <= version:
+            continue
+        with bind.begin() as conn:
+            step(conn)
+            conn.execute(schema_version.insert().values(version=number, name=name))
+        log.info("MIGRATION_APPLIED %04d_%s", number, name)
+        version = number
+    if bind.dialect.name == "sqlite":
+        with bind.begin() as conn:
+            conn.execute(text("PRAGMA optimize"))
+    return version
+
+def check_schema(bind=engine) -> int:
+    """Для воркеров без миграций на старте: схема должна быть уже обновлена (python migrations.py)."""
+    with bind.connect() as conn:
+        version = current_version(conn)
+    latest = MIGRATIONS[-1][0]
+    if version < latest:
+        raise RuntimeError(f"schema version {version} < {latest}: run `python migrations.py` first")
+    return version
+
+
+# --- регрессия планов горячих запросов ---
+
+def hot_queries() -> dict:
+    """Запросы с горячих путей в том виде, в каком их строит код."""
+    from projections import recompute_query
+    from users import _users_query
+    from utils import pending_postbacks_filter
+
+    probe_user = User(click_id="cid", trader_id="123")
+    return {
+        "attach: pending probe": select(exists().where(pending_postbacks_filter(probe_user))),
+        "postback: user by click_id": select(User).where(User.click_id == "cid"),
+        "postback: user by trader_id": select(User).where(User.trader_id == "123"),
+        "postback: dedup fingerprint": select(exists().where(PostbackLog.fingerprint == "fp")),
+        "check: last log by trader_id": select(PostbackLog).where(PostbackLog.trader_id == "123")
+                                        .order_by(PostbackLog.id.desc()).limit(1),
+        "reconcile: pending chunk": select(PostbackLog.id).where(PostbackLog.processed == false(),
+                                                                 PostbackLog.id > 0)
+                                    .order_by(PostbackLog.id).limit(5000),
+        "auth: user by login": select(User).where(User.login == "login"),
+        "auth: user by email": select(User).where(User.email == "a@b.c"),
+        "password-reset: user by token": select(User).where(User.reset_token == "token"),
+        "stats: daily range": select(DailyStat).where(DailyStat.day >= datetime(2024, 1, 1).date())
+                              .order_by(DailyStat.day, DailyStat.currency),
+        "projections: user recompute": recompute_query([1, 2]),
+        "funnel: state by user id": select(User.funnel_state).where(User.id == 1),
+        "mailer: due batch": select(OutboxEmail).where(OutboxEmail.status == "pending",
+                                                       OutboxEmail.next_attempt_at <= datetime(2024, 1, 1))
+                             .order_by(OutboxEmail.next_attempt_at).limit(50),
+        "users: keyset page": _users_query(100, None, None, True, 10.0, None).limit(100),
+    }
+
+def check_query_plans(bind=None) -> list[str]:
+    """Возвращает список запросов, план которых содержит полный скан таблицы."""
+    tmpdir = None
+    if bind is None:
+        tmpdir = tempfile.TemporaryDirectory()
+        bind = create_engine(f"sqlite:///{tmpdir.name}/plans.db")
+        run_migrations(bind)
+    failures = []
+    try:
+        with bind.connect() as conn:
+            for name, stmt in hot_queries().items():
+                compiled = stmt.compile(dialect=bind.dialect, compile_kwargs={"render_postcompile": True})
+                params = tuple(compiled.params[k] for k in compiled.positiontup)
+                plan = conn.exec_driver_sql("EXPLAIN QUERY PLAN " + str(compiled), params).all()
+                details = [row[-1] for row in plan]
+                scans = [d for d in details if d.startswith("SCAN ") and d != "SCAN CONSTANT ROW"]
+                print(f"{'FAIL' if scans else 'ok':>4}  {name}: {' | '.join(details)}")
+                if scans:
+                    failures.append(name)
+    finally:
+        if tmpdir is not None:
+            bind.dispose()
+            tmpdir.cleanup()
+    return failures
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Миграции схемы QOMEX")
+    ap.add_argument("--check-plans", action="store_true",
+                    help="проверить, что горячие запросы не сканируют таблицы целиком")
+    args = ap.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+    if args.check_plans:
+        sys.exit(1 if check_query_plans() else 0)
+    print(f"schema version: {run_migrations()}")
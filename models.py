@@ -1,7 +1,8 @@
 # models.py
-from sqlalchemy import Column, Integer, String, DateTime, Float, Boolean, ForeignKey, Text
+from sqlalchemy import Column, Integer, String, Date, DateTime, Float, Boolean, ForeignKey, Text, Index, event, false
 from datetime import datetime
 from database import Base
+import funnel
 
 class User(Base):
     __tablename__ = "users"
@@ -12,9 +13,11 @@ class User(Base):
     password = Column(String(255), nullable=False)  # хранить хэш
     click_id = Column(String(255), unique=True, nullable=False, index=True)
     trader_id = Column(String(255), unique=True, nullable=True)
-    first_deposit = Column(Float, nullable=True)
-    total_deposit = Column(Float, nullable=False, default=0.0)
-    deposit_verified = Column(Boolean, default=False)
+    first_deposit = Column(Float, nullable=True)                 # в базовой валюте (fx.BASE_CURRENCY)
+    total_deposit = Column(Float, nullable=False, default=0.0)   # в базовой валюте
+    balance_log_id = Column(Integer, nullable=False, default=0)  # последний учтённый в балансе лог (projections.py)
+    deposit_verified = Column(Boolean, default=False)            # пишется при каждой записи (funnel.py)
+    funnel_state = Column(String(16), nullable=False, default=funnel.REGISTERED)  # шаг воронки (funnel.py)
     reset_token = Column(String(255), nullable=True)  # <-- добавлено
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
@@ -24,17 +27,25 @@ class User(Base):
                 f"trader_id='{self.trader_id}', total_deposit={self.total_deposit})>")
 
 
+@event.listens_for(User, "before_insert")
+@event.listens_for(User, "before_update")
+def _update_funnel_state(mapper, connection, target):
+    funnel.update_state(target)
+
+
 class PostbackLog(Base):
     __tablename__ = "postbacks_log"
 
     id = Column(Integer, primary_key=True)
     event = Column(String(50))
     click_id = Column(String(255), index=True)
-    trader_id = Column(String(255), index=True)
+    trader_id = Column(String(255))  # индекс (trader_id, id) — ниже
     amount = Column(Float)
     currency = Column(String(10))
+    amount_base = Column(Float, nullable=True)  # amount в базовой валюте (fx.py)
     raw = Column(Text)  # сырые параметры постбэка (JSON строкой)
-    processed = Column(Boolean, default=False, index=True)
+    fingerprint = Column(String(64), unique=True, index=True, nullable=True)  # см. postback_dedup
+    processed = Column(Boolean, default=False)  # индексы — частичные, ниже
     user_id = Column(Integer, ForeignKey("users.id"), nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     processed_at = Column(DateTime, nullable=True)
@@ -42,3 +53,99 @@ class PostbackLog(Base):
     def __repr__(self):
         return (f"<PostbackLog(id={self.id}, event='{self.event}', click_id='{self.click_id}', "
                 f"trader_id='{self.trader_id}', amount={self.amount}, processed={self.processed})>")
+
+
+class DailyStat(Base):
+    """Дневные агрегаты воронки (см. rollups.py). currency="" — для счётчиков без валюты."""
+    __tablename__ = "daily_stats"
+
+    day = Column(Date, primary_key=True)
+    currency = Column(String(10), primary_key=True, default="")
+    registrations = Column(Integer, nullable=False, default=0)   # постбэки registration
+    trader_linked = Column(Integer, nullable=False, default=0)   # пользователям привязан trader_id
+    ftd_count = Column(Integer, nullable=False, default=0)       # первые депозиты
+    ftd_volume = Column(Float, nullable=False, default=0.0)
+    deposit_count = Column(Integer, nullable=False, default=0)   # все депозитные постбэки
+    deposit_volume = Column(Float, nullable=False, default=0.0)
+
+    def __repr__(self):
+        return (f"<DailyStat(day={self.day}, currency='{self.currency}', ftd={self.ftd_count}, "
+                f"deposits={self.deposit_count}, volume={self.deposit_volume})>")
+
+
+class FxRate(Base):
+    """Курс: сколько базовой валюты за единицу currency (см. fx.py)."""
+    __tablename__ = "fx_rates"
+
+    currency = Column(String(10), primary_key=True)
+    rate = Column(Float, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<FxRate(currency='{self.currency}', rate={self.rate})>"
+
+class CacheEvent(Base):
+    """Инвалидация кэшей между воркерами (cluster.py); id — общий счётчик версий."""
+    __tablename__ = "cache_events"
+
+    id = Column(Integer, primary_key=True)
+    cache = Column(String(20), nullable=False)   # "users" | "fx" | "sessions"
+    key = Column(String(64), nullable=True)      # id пользователя; пусто — весь кэш
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<CacheEvent(id={self.id}, cache='{self.cache}', key='{self.key}')>"
+
+class RevokedSession(Base):
+    """Deny list сессий (sessions.py): «s:<sid>» — одна сессия, «u:<user_id>» — все выданные до revoked_at."""
+    __tablename__ = "revoked_sessions"
+
+    key = Column(String(40), primary_key=True)
+    revoked_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    expires_at = Column(DateTime, nullable=False)  # дальше токены истекают сами — запись не нужна
+
+    def __repr__(self):
+        return f"<RevokedSession(key='{self.key}', expires_at={self.expires_at})>"
+
+class OutboxEmail(Base):
+    """Исходящие письма (mailer.py): пишутся в той же транзакции, что и повод для письма."""
+    __tablename__ = "email_outbox"
+
+    id = Column(Integer, primary_key=True)
+    to_email = Column(String(255), nullable=False)
+    domain = Column(String(255), nullable=False)  # для лимита писем на домен получателя
+    subject = Column(String(255), nullable=False)
+    body = Column(Text, nullable=False)           # HTML
+    status = Column(String(10), nullable=False, default="pending")  # pending | sent | failed
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    sent_at = Column(DateTime, nullable=True)
+
+    def __repr__(self):
+        return f"<OutboxEmail(id={self.id}, to='{self.to_email}', status='{self.status}', attempts={self.attempts})>"
+
+
+# Индексы под горячие запросы (при изменении — добавить шаг в migrations.py).
+# Частичные — по необработанным логам для attach_pending_postbacks.
+_pending = PostbackLog.processed == false()
+Index("ix_postbacks_log_pending_click_id", PostbackLog.click_id,
+      sqlite_where=_pending, postgresql_where=_pending)
+Index("ix_postbacks_log_pending_trader_id", PostbackLog.trader_id,
+      sqlite_where=_pending, postgresql_where=_pending)
+# reconcile: processed = false AND id > ? ORDER BY id
+Index("ix_postbacks_log_pending_id", PostbackLog.id,
+      sqlite_where=_pending, postgresql_where=_pending)
+# /check: trader_id = ? ORDER BY id DESC
+Index("ix_postbacks_log_trader_id_id", PostbackLog.trader_id, PostbackLog.id)
+# projections.recompute: логи пользователя (user_id IN (...) GROUP BY user_id)
+Index("ix_postbacks_log_user_id_id", PostbackLog.user_id, PostbackLog.id)
+# /password-reset: reset_token = ? (токен есть у единиц пользователей)
+_has_reset_token = User.reset_token.is_not(None)
+Index("ix_users_reset_token", User.reset_token,
+      sqlite_where=_has_reset_token, postgresql_where=_has_reset_token)
+# mailer: status = 'pending' AND next_attempt_at <= ? ORDER BY next_attempt_at
+_mail_pending = OutboxEmail.status == "pending"
+Index("ix_email_outbox_pending_next", OutboxEmail.next_attempt_at,
+      sqlite_where=_mail_pending, postgresql_where=_mail_pending)
@@ -0,0 +1,65 @@
+# passwords.py
+"""bcrypt в отдельном пуле потоков, вне event loop."""
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from passlib.context import CryptContext
+
+from metrics import password_hash_time
+
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))  # cost factor; старые хэши проверяются со своим
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+PASSWORD_HASH_QUEUE_LIMIT = int(os.getenv("PASSWORD_HASH_QUEUE_LIMIT", "64"))
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+
+_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="bcrypt")
+_lock = threading.Lock()
+_stats = {"queued": 0, "running": 0, "completed": 0, "rejected": 0, "max_queued": 0}
+
+
+class PasswordHasherBusy(RuntimeError):
+    """Очередь на хэширование переполнена — вызывающий отвечает 503."""
+
+
+def hash_password(password: str) -> str:
+    return pwd_context.hash(password)
+
+def verify_password(plain_password: str, hashed_password: str) -> bool:
+    return pwd_context.verify(plain_password, hashed_password)
+
+def queue_stats() -> dict:
+    """Снимок глубины очереди и счётчиков пула."""
+    with _lock:
+        return {**_stats, "workers": PASSWORD_HASH_WORKERS, "limit": PASSWORD_HASH_QUEUE_LIMIT}
+
+def _tracked(fn, *args):
+    with _lock:
+        _stats["queued"] -= 1
+        _stats["running"] += 1
+    t0 = time.perf_counter()
+    try:
+        return fn(*args)
+    finally:
+        password_hash_time.observe(time.perf_counter() - t0, fn.__name__)
+        with _lock:
+            _stats["running"] -= 1
+            _stats["completed"] += 1
+
+def _submit(fn, *args):
+    with _lock:
+        if _stats["queued"] >= PASSWORD_HASH_QUEUE_LIMIT:
+            _stats["rejected"] += 1
+            raise PasswordHasherBusy("password hash queue is full")
+        _stats["queued"] += 1
+        _stats["max_queued"] = max(_stats["max_queued"], _stats["queued"])
+    return _executor.submit(_tracked, fn, *args)
+
+async def hash_password_async(password: str) -> str:
+    return await asyncio.wrap_future(_submit(hash_password, password))
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    return await asyncio.wrap_future(_submit(verify_password, plain_password, hashed_password))
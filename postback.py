@@ -1,18 +1,38 @@
 # postback.py
-from fastapi import APIRouter, Request, HTTPException
-from database import SessionLocal
+from fastapi import APIRouter, Depends, Request, Response, HTTPException
+from database import write_session
 from models import User, PostbackLog
+from postback_queue import PostbackQueue
+from postback_dedup import RecentFingerprints, event_fingerprint
+from user_cache import user_cache
+from metrics import postback_outcome
+from logging_setup import sample_payload
+from ratelimit import check, client_ip, digest, sliding_window
+import rollups
+import projections
+from fx import fx_rates
+from sqlalchemy import exists
+from sqlalchemy.exc import IntegrityError
 from datetime import datetime
-import os, json, logging, re
+import os, json, logging, re, time, uuid
 
 router = APIRouter()
 POSTBACK_SECRET = os.getenv("POSTBACK_SECRET", "YOUR_SECRET")
+# "sync" — пишем в БД прямо в запросе (как раньше), "queue" — через фоновую очередь пачками
+POSTBACK_INGEST = os.getenv("POSTBACK_INGEST", "sync").strip().lower()
 
-logging.basicConfig(filename="/tmp/postback.log", level=logging.INFO,
-                    format="%(asctime)s %(message)s")
+# запись в файл — logging_setup (очередь + отдельный поток), здесь только логгер
+log = logging.getLogger("postback")
 
 DIGITS_RE = re.compile(r"^\d+$")
 
+# лимиты: верный токен — общий с запасом (дальше отвечает очередь), чужой токен — строго по IP
+POSTBACK_TOKEN_LIMIT = sliding_window("postback_token", os.getenv("RATELIMIT_POSTBACK_TOKEN", "60000/60"))
+POSTBACK_BAD_TOKEN_LIMIT = sliding_window("postback_bad_token", os.getenv("RATELIMIT_POSTBACK_BAD_TOKEN", "20/60"))
+
+# свежие отпечатки событий: ретраи брокера отбрасываем, не трогая БД
+recent_fingerprints = RecentFingerprints()
+
 def normalize_event(v: str) -> str:
     v = (v or "").strip().lower()
     if v in ("registration", "register", "signup", "trader_has_registered"):
@@ -43,80 +63,250 @@ async def _collect_params(request: Request) -> dict:
             pass
     return params
 
+def _find_by(db, key: str, value: str):
+    # id берём из кэша, строку всё равно грузим — её будем менять; кэш мог устареть
+    uid = user_cache.resolve_id(key, value)
+    if uid is not None:
+        user = db.get(User, uid)
+        if user is not None and getattr(user, key) == value:
+            return user
+    return db.query(User).filter(getattr(User, key) == value).first()
+
 def _find_user(db, click_id: str, trader_id: str):
     user = None
     if click_id:
-        user = db.query(User).filter(User.click_id == click_id).first()
+        user = _find_by(db, "click_id", click_id)
     if user is None and trader_id and DIGITS_RE.match(trader_id):
-        user = db.query(User).filter(User.trader_id == trader_id).first()
+        user = _find_by(db, "trader_id", trader_id)
     return user
 
 def _log_postback(db, params: dict, event: str, click_id: str, trader_id: str,
-                  amount: float, currency: str, user_id: int | None, processed: bool):
+                  amount: float, currency: str, user_id: int | None, processed: bool,
+                  fingerprint: str | None = None, amount_base: float | None = None):
+    now = datetime.utcnow()
     plog = PostbackLog(
         event=event,
         click_id=click_id or None,
         trader_id=trader_id or None,
         amount=amount or 0.0,
         currency=(currency or None),
+        amount_base=amount_base,
         raw=json.dumps(params, ensure_ascii=False),
+        fingerprint=fingerprint,
         processed=processed,
         user_id=user_id,
-        processed_at=datetime.utcnow() if processed else None,
+        created_at=now,
+        processed_at=now if processed else None,
     )
     db.add(plog)
+    return plog
 
-async def _handle(params: dict):
-    logging.info("RAW_POSTBACK %s", json.dumps(params, ensure_ascii=False))
+def _parse_event(params: dict) -> dict:
+    """Нормализованное событие из сырых параметров (без обращения к БД)."""
+    ev = {
+        "params": params,
+        "event": normalize_event(params.get("event")),
+        "click_id": (params.get("click_id") or "").strip(),
+        "trader_id": (params.get("trader_id") or "").strip(),
+        "amount": parse_amount(params.get("amount") or ""),
+        "currency": (params.get("currency") or "").strip().upper(),
+    }
+    ev["fingerprint"] = event_fingerprint(ev)
+    # курс — из памяти (fx_rates), без запроса к БД
+    ev["amount_base"] = fx_rates.to_base(ev["amount"], ev["currency"])
+    return ev
+
+def _apply_event(db, ev: dict) -> dict:
+    """Применяет одно событие в открытой сессии. Коммит — на вызывающей стороне."""
+    params, event = ev["params"], ev["event"]
+    click_id, trader_id = ev["click_id"], ev["trader_id"]
+    amount, currency, amount_base = ev["amount"], ev["currency"], ev["amount_base"]
+    fp = ev["fingerprint"]
+
+    # повтор уже записанного события (LRU мог его забыть) — ничего не меняем
+    if fp is not None and db.query(exists().where(PostbackLog.fingerprint == fp)).scalar():
+        return {"status": "duplicate"}
+
+    user = _find_user(db, click_id, trader_id)
+
+    if user is None:
+        # Пользователя нет — просто логируем (ожидаем, что появится позже)
+        plog = _log_postback(db, params, event, click_id, trader_id, amount, currency, None, False, fp, amount_base)
+        rollups.record_postback(db, event, amount, currency, plog.created_at.date())
+        return {"status": "no_user_yet", "click_id": click_id or None}
+
+    # лог помечаем обработанным; id нужен проекции баланса как контрольная точка
+    plog = _log_postback(db, params, event, click_id, trader_id, amount, currency, user.id, True, fp, amount_base)
+    day = plog.created_at.date()  # агрегаты — по дню лога, как в rollups.backfill
+    rollups.record_postback(db, event, amount, currency, day)
+
+    # Пользователь найден — обновляем его профиль по событию
+    ev["user_id"] = user.id  # после commit сбросим его из user_cache
+    user.updated_at = plog.created_at
+    if (not user.trader_id) and trader_id and DIGITS_RE.match(trader_id):
+        user.trader_id = trader_id  # НЕ трогаем, если уже установлен
+        rollups.record_trader_linked(db, day)
+    db.flush()
+
+    # суммы пользователя — в базовой валюте, только через projections; без курса не учитываем
+    deposit = amount_base if event == "deposit" and amount > 0 and amount_base is not None else 0.0
+    had_first = user.first_deposit is not None
+    if not projections.apply(user, plog.id, plog.id, deposit, amount_base):
+        projections.recompute(db, [user])
+    elif deposit and not had_first:
+        rollups.record_ftd(db, amount, currency, day)
+    return {"status": "ok"}
+
+def _is_duplicate_error(e: IntegrityError) -> bool:
+    """Конфликт именно по отпечатку (а не, например, по уникальному users.trader_id)."""
+    return "fingerprint" in str(e.orig)
+
+def _apply_events(db, events: list[dict]) -> list[dict]:
+    return [_apply_event(db, ev) for ev in events]
+
+async def _apply_batch(events: list[dict]):
+    """Применяет пачку событий одной транзакцией, при ошибке — по одному."""
+    # дубли внутри одной пачки отсекаем заранее — иначе уникальный индекс уронит всю пачку
+    seen, unique_events = set(), []
+    for ev in events:
+        fp = ev["fingerprint"]
+        if fp is None or fp not in seen:  # без отпечатка (нет id транзакции) — не дубль
+            seen.add(fp)
+            unique_events.append(ev)
+    events = unique_events
+
+    async with write_session() as db:
+        try:
+            results = await db.run_sync(_apply_events, events)
+            await db.commit()
+            user_cache.invalidate(*(ev.get("user_id") for ev in events))
+            for ev, result in zip(events, results):
+                postback_outcome(ev["event"], result["status"])
+            return
+        except Exception:
+            await db.rollback()
+            log.exception("ERROR_PROCESSING_POSTBACK_BATCH size=%d", len(events))
+
+    for ev in events:
+        async with write_session() as db:
+            try:
+                result = await db.run_sync(_apply_event, ev)
+                await db.commit()
+                user_cache.invalidate(ev.get("user_id"))
+                postback_outcome(ev["event"], result["status"])
+            except IntegrityError as e:
+                await db.rollback()
+                if _is_duplicate_error(e):  # дубль по отпечатку — молча пропускаем
+                    postback_outcome(ev["event"], "duplicate")
+                else:
+                    recent_fingerprints.discard(ev["fingerprint"])
+                    postback_outcome(ev["event"], "error")
+                    log.exception("ERROR_PROCESSING_POSTBACK", extra={"payload": ev["params"]})
+            except Exception:
+                await db.rollback()
+                postback_outcome(ev["event"], "error")
+                # событие не применилось — пусть ретрай брокера пройдёт фильтр
+                recent_fingerprints.discard(ev["fingerprint"])
+                log.exception("ERROR_PROCESSING_POSTBACK", extra={"payload": ev["params"]})
 
+ingest_queue = PostbackQueue(_apply_batch)
+
+async def _handle(params: dict):
     token = params.get("token")
     if token != POSTBACK_SECRET:
+        postback_outcome(normalize_event(params.get("event")), "forbidden")
         raise HTTPException(status_code=403, detail="forbidden")
 
-    event = normalize_event(params.get("event"))
-    click_id = (params.get("click_id") or "").strip()
-    trader_id = (params.get("trader_id") or "").strip()
-    amount = parse_amount(params.get("amount") or "")
-    currency = (params.get("currency") or "").strip().upper()
+    ev = _parse_event(params)
+    fp = ev["fingerprint"]
+    if fp in recent_fingerprints:
+        postback_outcome(ev["event"], "duplicate")
+        return {"status": "duplicate"}
+
+    if POSTBACK_INGEST == "queue":
+        # быстрый путь: кладём в очередь и сразу отвечаем брокеру
+        if not ingest_queue.put_nowait(ev):
+            postback_outcome(ev["event"], "queue_full")
+            raise HTTPException(status_code=503, detail="queue_full",
+                                headers={"Retry-After": "1"})
+        recent_fingerprints.add(fp)
+        postback_outcome(ev["event"], "queued")
+        return {"status": "queued"}
 
-    db = SessionLocal()
+    async with write_session() as db:
+        try:
+            result = await db.run_sync(_apply_event, ev)
+            await db.commit()
+            user_cache.invalidate(ev.get("user_id"))
+            recent_fingerprints.add(fp)
+            postback_outcome(ev["event"], result["status"])
+            return result
+        except IntegrityError as e:
+            await db.rollback()
+            if _is_duplicate_error(e):
+                # тот же отпечаток успел записать параллельный запрос
+                recent_fingerprints.add(fp)
+                postback_outcome(ev["event"], "duplicate")
+                return {"status": "duplicate"}
+            postback_outcome(ev["event"], "error")
+            log.exception("ERROR_PROCESSING_POSTBACK")
+            raise HTTPException(status_code=500, detail="internal_error")
+        except Exception:
+            await db.rollback()
+            postback_outcome(ev["event"], "error")
+            log.exception("ERROR_PROCESSING_POSTBACK")
+            raise HTTPException(status_code=500, detail="internal_error")
+
+_STATUS_OUTCOMES = {403: "forbidden", 503: "queue_full"}
+
+async def _handle_logged(request: Request, response: Response, params: dict):
+    """_handle с одной строкой RAW_POSTBACK на запрос."""
+    request_id = request.headers.get("x-request-id") or uuid.uuid4().hex[:16]
+    response.headers["X-Request-ID"] = request_id
+    t0 = time.perf_counter()
+    outcome, status_code = "error", 500
     try:
-        user = _find_user(db, click_id, trader_id)
-
-        if user is None:
-            # Пользователя нет — просто логируем (ожидаем, что появится позже)
-            _log_postback(db, params, event, click_id, trader_id, amount, currency, None, False)
-            db.commit()
-            return {"status": "no_user_yet", "click_id": click_id or None}
-
-        # Пользователь найден — обновляем его профиль по событию
-        user.updated_at = datetime.utcnow()
-        if (not user.trader_id) and trader_id and DIGITS_RE.match(trader_id):
-            user.trader_id = trader_id  # НЕ трогаем, если уже установлен
-
-        if event == "deposit" and amount > 0:
-            # first_deposit заполняем, если ещё не было
-            if user.first_deposit is None:
-                user.first_deposit = amount
-            user.total_deposit = (user.total_deposit or 0.0) + amount
-
-        # лог помечаем обработанным
-        _log_postback(db, params, event, click_id, trader_id, amount, currency, user.id, True)
-        db.commit()
-        return {"status": "ok"}
-    except Exception:
-        db.rollback()
-        logging.exception("ERROR_PROCESSING_POSTBACK")
-        raise HTTPException(status_code=500, detail="internal_error")
+        result = await _handle(params)
+        outcome, status_code = result["status"], 200
+        return result
+    except HTTPException as e:
+        outcome, status_code = _STATUS_OUTCOMES.get(e.status_code, "error"), e.status_code
+        raise
     finally:
-        db.close()
+        extra = {
+            "request_id": request_id,
+            "method": request.method,
+            "event": params.get("event"),
+            "outcome": outcome,
+            "status_code": status_code,
+            "latency_ms": round((time.perf_counter() - t0) * 1000, 2),
+        }
+        if sample_payload(outcome):
+            extra["payload"] = params
+        log.info("RAW_POSTBACK", extra=extra)
 
-@router.get("/postback")
-async def postback_get(request: Request):
+async def _limit(limiter, key: str, event: str):
+    try:
+        await check(limiter, key)
+    except HTTPException:
+        postback_outcome(event, "rate_limited")
+        raise
+
+async def limited_params(request: Request) -> dict:
+    """Параметры постбэка после лимитов: верный токен — общий лимит на токен, иначе — строгий по IP."""
     params = await _collect_params(request)
-    return await _handle(params)
+    event = normalize_event(params.get("event"))
+    token = params.get("token")
+    if token == POSTBACK_SECRET:
+        await _limit(POSTBACK_TOKEN_LIMIT, digest(token), event)
+    else:
+        await _limit(POSTBACK_BAD_TOKEN_LIMIT, client_ip(request), event)
+    return params
+
+@router.get("/postback")
+async def postback_get(request: Request, response: Response, params: dict = Depends(limited_params)):
+    return await _handle_logged(request, response, params)
 
 @router.post("/postback")
-async def postback_post(request: Request):
-    params = await _collect_params(request)
-    return await _handle(params)
+async def postback_post(request: Request, response: Response, params: dict = Depends(limited_params)):
+    return await _handle_logged(request, response, params)
@@ -0,0 +1,63 @@
+# postback_dedup.py
+"""Отпечатки постбэков для отбрасывания повторов брокера."""
+import hashlib
+import os
+from collections import OrderedDict
+
+POSTBACK_DEDUP_CACHE = int(os.getenv("POSTBACK_DEDUP_CACHE", "100000"))
+
+# ключи, под которыми брокеры присылают id транзакции/события
+TXN_ID_KEYS = ("transaction_id", "txn_id", "tx_id", "trans_id", "deposit_id",
+               "payment_id", "event_id", "order_id")
+
+
+def broker_txn_id(params: dict) -> str:
+    for key in TXN_ID_KEYS:
+        v = params.get(key)
+        if v not in (None, ""):
+            return str(v).strip()
+    return ""
+
+
+def event_fingerprint(ev: dict) -> str | None:
+    """Отпечаток нормализованного события (см. postback._parse_event); None — без id транзакции."""
+    txn_id = broker_txn_id(ev["params"])
+    if not txn_id:
+        return None
+    parts = (
+        ev["event"],
+        ev["click_id"],
+        ev["trader_id"],
+        f"{ev['amount']:.2f}",
+        ev["currency"],
+        txn_id,
+    )
+    return hashlib.sha256("|".join(parts).encode("utf-8")).hexdigest()
+
+
+class RecentFingerprints:
+    """LRU-множество последних отпечатков (фронт-фильтр перед БД)."""
+
+    def __init__(self, maxsize: int = POSTBACK_DEDUP_CACHE):
+        self.maxsize = maxsize
+        self._items: OrderedDict[str, None] = OrderedDict()
+
+    def __contains__(self, fp: str | None) -> bool:
+        if fp is not None and fp in self._items:
+            self._items.move_to_end(fp)
+            return True
+        return False
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def add(self, fp: str | None):
+        if fp is None:
+            return
+        self._items[fp] = None
+        self._items.move_to_end(fp)
+        if len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+    def discard(self, fp: str | None):
+        self._items.pop(fp, None)
@@ -0,0 +1,94 @@
+# postback_queue.py
+"""Ограниченная очередь постбэков с применением пачками."""
+import asyncio
+import logging
+import os
+import time
+from typing import Awaitable, Callable
+
+POSTBACK_QUEUE_SIZE = int(os.getenv("POSTBACK_QUEUE_SIZE", "10000"))
+POSTBACK_BATCH_SIZE = int(os.getenv("POSTBACK_BATCH_SIZE", "200"))
+POSTBACK_BATCH_MS = int(os.getenv("POSTBACK_BATCH_MS", "50"))
+POSTBACK_DRAIN_TIMEOUT = float(os.getenv("POSTBACK_DRAIN_TIMEOUT", "30"))
+
+log = logging.getLogger("postback_queue")
+
+
+class PostbackQueue:
+    def __init__(self, apply_batch: Callable[[list[dict]], Awaitable[None]],
+                 maxsize: int = POSTBACK_QUEUE_SIZE,
+                 batch_size: int = POSTBACK_BATCH_SIZE,
+                 batch_ms: int = POSTBACK_BATCH_MS):
+        # apply_batch — корутина, применяющая пачку через AsyncSession
+        self.apply_batch = apply_batch
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.batch_ms = batch_ms
+        self._queue: asyncio.Queue | None = None
+        self._worker: asyncio.Task | None = None
+        self._accepting = False
+
+    @property
+    def running(self) -> bool:
+        return self._worker is not None and not self._worker.done()
+
+    def qsize(self) -> int:
+        return self._queue.qsize() if self._queue else 0
+
+    def put_nowait(self, ev: dict) -> bool:
+        """False — очередь полна или остановлена (вызывающий отвечает 503)."""
+        if not self._accepting or self._queue is None:
+            return False
+        try:
+            self._queue.put_nowait(ev)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    async def start(self):
+        if self.running:
+            return
+        self._queue = asyncio.Queue(maxsize=self.maxsize)
+        self._accepting = True
+        self._worker = asyncio.create_task(self._run(), name="postback-queue")
+
+    async def stop(self, timeout: float = POSTBACK_DRAIN_TIMEOUT):
+        """Перестаём принимать новые события и ждём, пока воркер дочистит очередь."""
+        if not self.running:
+            return
+        self._accepting = False
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            log.error("POSTBACK_QUEUE_DRAIN_TIMEOUT left=%d", self.qsize())
+        self._worker.cancel()
+        try:
+            await self._worker
+        except asyncio.CancelledError:
+            pass
+        self._worker = None
+
+    async def _next_batch(self) -> list[dict]:
+        # ждём первое событие сколько угодно, остальные — не дольше batch_ms
+        batch = [await self._queue.get()]
+        deadline = time.monotonic() + self.batch_ms / 1000
+        while len(batch) < self.batch_size:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout=left))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._next_batch()
+            try:
+                await self.apply_batch(batch)
+            except Exception:
+                log.exception("POSTBACK_QUEUE_BATCH_FAILED size=%d", len(batch))
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
@@ -1,21 +1,20 @@
-from fastapi import APIRouter, Request
+from fastapi import APIRouter, Request, Depends
 from fastapi.responses import HTMLResponse, RedirectResponse
-from fastapi.templating import Jinja2Templates
-from database import SessionLocal
-from models import User
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import get_db
+from user_cache import get_user
+from templating import templates
+from sessions import current_session
 
 router = APIRouter()
-templates = Jinja2Templates(directory="templates")
 
 @router.get("/profile", response_class=HTMLResponse)
-async def profile(request: Request):
-    user_id = request.cookies.get("user_id")
-    if not user_id:
+async def profile(request: Request, db: AsyncSession = Depends(get_db)):
+    session = current_session(request)
+    if not session:
         return RedirectResponse("/auth")
 
-    db = SessionLocal()
-    user = db.query(User).filter(User.id == int(user_id)).first()
-    db.close()
+    user = await get_user(db, session.user_id)
 
     if not user:
         return RedirectResponse("/auth")
@@ -0,0 +1,149 @@
+# projections.py
+"""Балансы пользователей как проекция postbacks_log; python projections.py --check | --rebuild."""
+import argparse
+import sys
+
+from sqlalchemy import and_, bindparam, case, func, insert, select, update
+
+from database import engine
+from models import CacheEvent, PostbackLog, User
+import funnel
+import rollups
+
+REBUILD_BATCH = 10_000
+EPSILON = 1e-6
+
+# депозит без курса (amount_base = NULL, см. fx.py) в баланс не входит
+AMOUNT_BASE = PostbackLog.amount_base
+IS_DEPOSIT = and_(PostbackLog.event == "deposit", PostbackLog.amount > 0, PostbackLog.amount_base.is_not(None))
+ATTACHED = and_(PostbackLog.user_id.is_not(None), PostbackLog.processed.is_(True))
+
+
+# --- инкрементальное применение ---
+
+def apply(user: User, min_log_id: int, max_log_id: int, deposit_sum: float = 0.0,
+          first_amount: float | None = None) -> bool:
+    """Применяет логи [min_log_id, max_log_id]; False — нужен recompute()."""
+    if min_log_id <= (user.balance_log_id or 0):
+        return False
+    if deposit_sum > 0:
+        if user.first_deposit is None:
+            user.first_deposit = first_amount
+        user.total_deposit = (user.total_deposit or 0.0) + deposit_sum
+    user.balance_log_id = max_log_id
+    return True
+
+
+def recompute_query(user_ids):
+    """user_id, сумма депозитов, id первого депозита и последний id лога — по индексу (user_id, id)."""
+    return select(
+        PostbackLog.user_id,
+        func.coalesce(func.sum(case((IS_DEPOSIT, AMOUNT_BASE), else_=0.0)), 0.0),
+        func.min(case((IS_DEPOSIT, PostbackLog.id))),
+        func.max(PostbackLog.id),
+    ).where(ATTACHED, PostbackLog.user_id.in_(user_ids)).group_by(PostbackLog.user_id)
+
+
+def recompute(db, users: list[User]):
+    """Пересчитывает проекции пользователей из их привязанных логов."""
+    if not users:
+        return
+    by_id = {u.id: u for u in users}
+    rows = db.execute(recompute_query(list(by_id))).all()
+    first_ids = [r[2] for r in rows if r[2] is not None]
+    firsts = {row.id: row for row in db.execute(
+        select(PostbackLog.id, PostbackLog.amount, PostbackLog.currency, PostbackLog.created_at,
+               AMOUNT_BASE.label("amount_base"))
+        .where(PostbackLog.id.in_(first_ids))
+    )} if first_ids else {}
+
+    had_first = {u.id for u in users if u.first_deposit is not None}
+    for user in users:
+        user.first_deposit, user.total_deposit, user.balance_log_id = None, 0.0, 0
+    for user_id, total, first_id, max_id in rows:
+        user = by_id[user_id]
+        user.total_deposit = total
+        user.balance_log_id = max_id
+        first = firsts.get(first_id)
+        if first is not None:
+            user.first_deposit = first.amount_base
+            if user_id not in had_first:
+                rollups.record_ftd(db, first.amount, first.currency, rollups.log_day(first.created_at))
+
+
+# --- полная пересборка и проверка ---
+
+def rebuild(conn) -> dict:
+    """Пересобирает все проекции одним проходом по postbacks_log."""
+    state: dict[int, list] = {}  # user_id -> [first, total, last_log_id]
+    scanned = 0
+    result = conn.execution_options(yield_per=REBUILD_BATCH).execute(
+        select(PostbackLog.user_id, PostbackLog.id, IS_DEPOSIT.label("is_deposit"), AMOUNT_BASE)
+        .where(ATTACHED).order_by(PostbackLog.id)
+    )
+    for user_id, log_id, is_deposit, amount_base in result:
+        scanned += 1
+        s = state.setdefault(user_id, [None, 0.0, 0])
+        if is_deposit:
+            if s[0] is None:
+                s[0] = amount_base
+            s[1] += amount_base
+        s[2] = log_id
+
+    users = User.__table__
+    conn.execute(update(users).values(first_deposit=None, total_deposit=0.0, balance_log_id=0))
+    rows = [{"uid": uid, "first_deposit": s[0], "total_deposit": s[1], "balance_log_id": s[2]}
+            for uid, s in state.items()]
+    for i in range(0, len(rows), REBUILD_BATCH):
+        conn.execute(update(users).where(users.c.id == bindparam("uid")), rows[i:i + REBUILD_BATCH])
+    funnel.backfill(conn)  # суммы поменялись мимо ORM — досчитываем состояние воронки
+    # bulk UPDATE мимо ORM: воркерам (cluster.py) — сбросить кэш пользователей целиком
+    conn.execute(insert(CacheEvent).values(cache="users", key=None))
+    return {"logs_scanned": scanned, "users_with_logs": len(state)}
+
+
+def check(conn, limit: int = 100) -> list[dict]:
+    """Расхождения между сохранённой проекцией и пересчётом агрегатом SQL (не более limit)."""
+    agg = (select(
+        PostbackLog.user_id.label("user_id"),
+        func.sum(case((IS_DEPOSIT, AMOUNT_BASE), else_=0.0)).label("total"),
+        func.min(case((IS_DEPOSIT, PostbackLog.id))).label("first_id"),
+    ).where(ATTACHED).group_by(PostbackLog.user_id).subquery())
+    first_log = PostbackLog.__table__.alias("first_log")
+    expected_total = func.coalesce(agg.c.total, 0.0)
+    expected_first = first_log.c.amount_base
+    stored_first = User.first_deposit
+
+    mismatch = (
+        (func.abs(User.total_deposit - expected_total) > EPSILON)
+        | (stored_first.is_(None) != expected_first.is_(None))
+        | (func.abs(func.coalesce(stored_first, 0.0) - func.coalesce(expected_first, 0.0)) > EPSILON)
+    )
+    rows = conn.execute(
+        select(User.id, User.first_deposit, User.total_deposit, expected_first, expected_total)
+        .outerjoin(agg, agg.c.user_id == User.id)
+        .outerjoin(first_log, first_log.c.id == agg.c.first_id)
+        .where(mismatch).order_by(User.id).limit(limit)
+    ).all()
+    return [{"user_id": r[0], "first_deposit": r[1], "total_deposit": r[2],
+             "expected_first_deposit": r[3], "expected_total_deposit": round(r[4], 6)} for r in rows]
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Проекции балансов пользователей из postbacks_log")
+    group = ap.add_mutually_exclusive_group(required=True)
+    group.add_argument("--check", action="store_true", help="сравнить балансы с пересчётом из логов")
+    group.add_argument("--rebuild", action="store_true", help="пересобрать все балансы из логов")
+    ap.add_argument("--limit", type=int, default=100, help="сколько расхождений показать")
+    args = ap.parse_args()
+
+    if args.rebuild:
+        with engine.begin() as conn:
+            print(rebuild(conn))
+    else:
+        with engine.connect() as conn:
+            problems = check(conn, args.limit)
+        for p in problems:
+            print(p)
+        print(f"mismatches: {len(problems)}{'+' if len(problems) == args.limit else ''}")
+        sys.exit(1 if problems else 0)
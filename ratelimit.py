@@ -0,0 +1,236 @@
+# ratelimit.py
+"""Ограничение частоты запросов (TokenBucket / SlidingWindow) до работы с БД."""
+import asyncio
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Optional, Union
+
+from fastapi import HTTPException, Request
+
+from database import APP_WORKERS, side_path
+from metrics import Counter
+
+RATELIMIT_ENABLED = os.getenv("RATELIMIT_ENABLED", "1") == "1"
+RATELIMIT_STORE = os.getenv("RATELIMIT_STORE", "sqlite" if APP_WORKERS > 1 else "memory")
+RATELIMIT_MEMORY_KEYS = int(os.getenv("RATELIMIT_MEMORY_KEYS", "100000"))
+RATELIMIT_SQLITE_TIMEOUT = float(os.getenv("RATELIMIT_SQLITE_TIMEOUT", "0.05"))  # сек
+RATELIMIT_PRUNE_EVERY = 1000  # SqliteStore: раз в столько обращений — удалить истёкшие ключи
+
+log = logging.getLogger("ratelimit")
+
+rejections = Counter("ratelimit_rejections_total", "Requests rejected by rate limits", ("limit",))
+
+
+def parse_spec(spec: str) -> tuple[int, float]:
+    """«N/S» -> (N, S): N запросов за S секунд."""
+    count, _, seconds = spec.partition("/")
+    return int(count), float(seconds or 1)
+
+
+@dataclass(frozen=True)
+class Decision:
+    allowed: bool
+    retry_after: float = 0.0  # сек до следующей разрешённой попытки
+
+
+State = tuple[float, float, float]
+
+
+# --- алгоритмы: чистые функции состояния ---
+
+class TokenBucket:
+    """Состояние (жетоны, когда пересчитаны, -)."""
+
+    def __init__(self, count: int, seconds: float):
+        self.burst = count
+        self.rate = count / seconds
+        self.ttl = seconds  # полный бак через столько секунд — состояние можно забыть
+
+    def hit(self, state: Optional[State], now: float, cost: float = 1.0) -> tuple[Decision, State]:
+        tokens, at = (state[0], state[1]) if state else (self.burst, now)
+        tokens = min(self.burst, tokens + (now - at) * self.rate)
+        if tokens >= cost:
+            return Decision(True), (tokens - cost, now, 0.0)
+        return Decision(False, (cost - tokens) / self.rate), (tokens, now, 0.0)
+
+
+class SlidingWindow:
+    """Состояние (номер текущего окна, счётчик текущего, счётчик предыдущего)."""
+
+    def __init__(self, count: int, seconds: float):
+        self.limit = count
+        self.window = seconds
+        self.ttl = 2 * seconds
+
+    def hit(self, state: Optional[State], now: float, cost: float = 1.0) -> tuple[Decision, State]:
+        index = now // self.window
+        cur_index, cur, prev = state if state else (index, 0.0, 0.0)
+        if cur_index != index:
+            prev = cur if index - cur_index == 1 else 0.0
+            cur = 0.0
+        elapsed = now / self.window - index  # доля текущего окна
+        if prev * (1 - elapsed) + cur + cost <= self.limit:
+            return Decision(True), (index, cur + cost, prev)
+        if cur + cost > self.limit or prev <= 0:
+            retry = (1 - elapsed) * self.window  # до конца окна
+        else:
+            # вес предыдущего окна убывает линейно — когда освободится место под cost
+            need = 1 - (self.limit - cur - cost) / prev
+            retry = (need - elapsed) * self.window
+        return Decision(False, max(retry, 0.001)), (index, cur, prev)
+
+
+Algorithm = Union[TokenBucket, SlidingWindow]
+
+
+# --- хранилища ---
+
+class MemoryStore:
+    def __init__(self, maxkeys: int = RATELIMIT_MEMORY_KEYS):
+        self.maxkeys = maxkeys
+        self._data: OrderedDict[str, State] = OrderedDict()
+        self._lock = threading.Lock()  # mailer и обработчики могут звать из разных потоков
+
+    def apply(self, key: str, algo: Algorithm, now: float, cost: float = 1.0) -> Decision:
+        with self._lock:
+            decision, state = algo.hit(self._data.get(key), now, cost)
+            self._data[key] = state
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxkeys:
+                self._data.popitem(last=False)
+        return decision
+
+    async def apply_async(self, key: str, algo: Algorithm, now: float, cost: float = 1.0) -> Decision:
+        return self.apply(key, algo, now, cost)  # только память — потоки не нужны
+
+    def stats(self) -> dict:
+        return {"keys": len(self._data)}
+
+
+class SqliteStore:
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        # обращения и так идут по одному (_lock) — одного потока хватает
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ratelimit")
+        self._ops = 0
+        self.errors = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=RATELIMIT_SQLITE_TIMEOUT, isolation_level=None,
+                               check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=OFF")  # счётчики не переживают сбой питания — и не нужно
+        conn.execute("CREATE TABLE IF NOT EXISTS ratelimit ("
+                     "key TEXT PRIMARY KEY, a REAL, b REAL, c REAL, expires_at REAL)")
+        return conn
+
+    def apply(self, key: str, algo: Algorithm, now: float, cost: float = 1.0) -> Decision:
+        with self._lock:
+            try:
+                if self._conn is None:
+                    self._conn = self._connect()
+                conn = self._conn
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    row = conn.execute("SELECT a, b, c FROM ratelimit WHERE key = ? AND expires_at > ?",
+                                       (key, now)).fetchone()
+                    decision, state = algo.hit(row, now, cost)
+                    conn.execute("INSERT OR REPLACE INTO ratelimit VALUES (?, ?, ?, ?, ?)",
+                                 (key, *state, now + algo.ttl))
+                    self._ops += 1
+                    if self._ops % RATELIMIT_PRUNE_EVERY == 0:
+                        conn.execute("DELETE FROM ratelimit WHERE expires_at <= ?", (now,))
+                    conn.execute("COMMIT")
+                except BaseException:
+                    conn.execute("ROLLBACK")
+                    raise
+                return decision
+            except sqlite3.Error as e:
+                # занято другим воркером или файл недоступен — пропускаем, а не отказываем
+                self.errors += 1
+                if self.errors % 100 == 1:
+                    log.warning("RATELIMIT_STORE_ERROR %s (request allowed)", e)
+                return Decision(True)
+
+    async def apply_async(self, key: str, algo: Algorithm, now: float, cost: float = 1.0) -> Decision:
+        """apply в потоке хранилища: ожидание файла (до RATELIMIT_SQLITE_TIMEOUT) не держит event loop."""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self.apply, key, algo, now, cost)
+
+    def stats(self) -> dict:
+        return {"ops": self._ops, "errors": self.errors}
+
+
+def _default_store():
+    if RATELIMIT_STORE == "sqlite":
+        return SqliteStore(os.getenv("RATELIMIT_DB") or side_path("ratelimit", "db"))
+    return MemoryStore()
+
+store = _default_store()
+
+
+# --- лимиты ---
+
+class Limiter:
+    def __init__(self, name: str, algo: Algorithm, store=None):
+        self.name = name
+        self.algo = algo
+        self.store = store
+
+    def _store(self):
+        return self.store if self.store is not None else store
+
+    def hit(self, key: str, cost: float = 1.0) -> Decision:
+        """Синхронно — для кода вне event loop или с MemoryStore (mailer)."""
+        return self._store().apply(f"{self.name}:{key}", self.algo, time.time(), cost)
+
+    async def hit_async(self, key: str, cost: float = 1.0) -> Decision:
+        return await self._store().apply_async(f"{self.name}:{key}", self.algo, time.time(), cost)
+
+
+def token_bucket(name: str, spec: str, store=None) -> Limiter:
+    return Limiter(name, TokenBucket(*parse_spec(spec)), store)
+
+def sliding_window(name: str, spec: str, store=None) -> Limiter:
+    return Limiter(name, SlidingWindow(*parse_spec(spec)), store)
+
+
+def client_ip(request: Request) -> str:
+    # за nginx адрес клиента подставляет uvicorn (--proxy-headers / forwarded_allow_ips)
+    return request.client.host if request.client else "unknown"
+
+def digest(value: str) -> str:
+    """Ключ без самого значения (токены, email) — в памяти и в файле лимитов."""
+    return hashlib.blake2b(value.encode(), digest_size=12).hexdigest()
+
+
+async def check(limiter: Limiter, key: Optional[str], detail: str = "rate_limited"):
+    """Списать попытку; при превышении — 429 с Retry-After."""
+    if not RATELIMIT_ENABLED or not key:
+        return
+    decision = await limiter.hit_async(key)
+    if not decision.allowed:
+        rejections.inc(limiter.name)
+        retry = max(1, int(decision.retry_after + 0.999))
+        raise HTTPException(status_code=429, detail=detail.format(retry=retry),
+                            headers={"Retry-After": str(retry)})
+
+
+KeyFunc = Callable[[Request], Union[Optional[str], Awaitable[Optional[str]]]]
+
+def rate_limit(limiter: Limiter, key_func: KeyFunc = client_ip, detail: str = "rate_limited"):
+    """Зависимость FastAPI: Depends(rate_limit(...)) или dependencies=[...] у маршрута."""
+    async def dependency(request: Request):
+        key = key_func(request)
+        if hasattr(key, "__await__"):
+            key = await key
+        await check(limiter, key, detail)
+    return dependency
@@ -0,0 +1,173 @@
+# reconcile.py
+"""Привязка висящих постбэков; python reconcile.py [--chunk 5000]."""
+import argparse
+import asyncio
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+
+from sqlalchemy import false, or_, select, update
+
+from database import SessionLocal, write_session
+from models import PostbackLog, User
+from user_cache import user_cache
+import rollups
+import projections
+
+RECONCILE_CHUNK = int(os.getenv("RECONCILE_CHUNK", "5000"))
+RECONCILE_INTERVAL = int(os.getenv("RECONCILE_INTERVAL", "0"))  # сек; 0 — без фоновой задачи
+
+log = logging.getLogger("reconcile")
+
+
+@dataclass
+class ReconcileStats:
+    scanned: int = 0
+    attached: int = 0
+    deposits: int = 0
+    deposit_volume: float = 0.0
+    users: set = field(default_factory=set)
+    started: float = field(default_factory=time.perf_counter)
+
+    def report(self) -> dict:
+        elapsed = time.perf_counter() - self.started
+        return {
+            "scanned": self.scanned,
+            "attached": self.attached,
+            "users_updated": len(self.users),
+            "deposits": self.deposits,
+            "deposit_volume": round(self.deposit_volume, 2),
+            "elapsed_s": round(elapsed, 2),
+            "logs_per_s": round(self.scanned / elapsed, 1) if elapsed else 0.0,
+        }
+
+
+def _load_users(db, logs) -> tuple[dict, dict]:
+    """Один запрос на чанк: пользователи по всем click_id и trader_id из логов."""
+    click_ids = {pb.click_id for pb in logs if pb.click_id}
+    trader_ids = {pb.trader_id for pb in logs if pb.trader_id and pb.trader_id.isdigit()}
+    conds = []
+    if click_ids:
+        conds.append(User.click_id.in_(click_ids))
+    if trader_ids:
+        conds.append(User.trader_id.in_(trader_ids))
+    if not conds:
+        return {}, {}
+    users = db.scalars(select(User).where(or_(*conds))).all()
+    return ({u.click_id: u for u in users if u.click_id},
+            {u.trader_id: u for u in users if u.trader_id})
+
+
+def apply_logs(db, logs, stats: ReconcileStats) -> int:
+    """Привязывает пачку логов к пользователям и возвращает число привязанных."""
+    stats.scanned += len(logs)
+    by_click, by_trader = _load_users(db, logs)
+    if not by_click and not by_trader:
+        return 0
+
+    # trader_id, которые уже заняты, — чтобы не присвоить чужой
+    wanted_tids = {pb.trader_id for pb in logs if pb.trader_id and pb.trader_id.isdigit()} - set(by_trader)
+    taken_tids = set(db.scalars(select(User.trader_id).where(User.trader_id.in_(wanted_tids)))) if wanted_tids else set()
+
+    now = datetime.utcnow()
+    updates = []
+    stale = {}
+    for pb in logs:
+        user = by_click.get(pb.click_id) if pb.click_id else None
+        if user is None and pb.trader_id:
+            user = by_trader.get(pb.trader_id)
+        if user is None:
+            continue
+        day = rollups.log_day(pb.created_at)
+
+        if not user.trader_id and pb.trader_id and pb.trader_id.isdigit() and pb.trader_id not in taken_tids:
+            user.trader_id = pb.trader_id
+            by_trader[pb.trader_id] = user
+            taken_tids.add(pb.trader_id)
+            rollups.record_trader_linked(db, day)
+
+        deposit = 0.0
+        if pb.event == "deposit" and (pb.amount or 0) > 0 and pb.amount_base is not None:  # без курса — не учитываем
+            deposit = pb.amount_base
+            stats.deposits += 1
+            stats.deposit_volume += deposit
+        # баланс — через projections; лог старше контрольной точки — пересчёт после UPDATE
+        had_first = user.first_deposit is not None
+        if user.id in stale or not projections.apply(user, pb.id, pb.id, deposit, deposit):
+            stale[user.id] = user
+        elif deposit and not had_first:
+            rollups.record_ftd(db, pb.amount, pb.currency, day)
+
+        user.updated_at = now
+        stats.users.add(user.id)
+        updates.append({"id": pb.id, "user_id": user.id, "processed": True, "processed_at": now})
+
+    if updates:
+        # bulk UPDATE по первичному ключу (executemany)
+        db.execute(update(PostbackLog), updates)
+    projections.recompute(db, list(stale.values()))
+    db.commit()
+    user_cache.invalidate(*{u["user_id"] for u in updates})
+    stats.attached += len(updates)
+    return len(updates)
+
+
+def reconcile_chunk(db, after_id: int, chunk: int, stats: ReconcileStats) -> int | None:
+    """Обрабатывает следующий чанк висящих логов с id > after_id. None — логи кончились."""
+    logs = db.execute(
+        select(PostbackLog.id, PostbackLog.event, PostbackLog.click_id, PostbackLog.trader_id,
+               PostbackLog.amount, PostbackLog.currency, PostbackLog.amount_base, PostbackLog.created_at)
+        .where(PostbackLog.processed == false(), PostbackLog.id > after_id)
+        .order_by(PostbackLog.id)
+        .limit(chunk)
+    ).all()
+    if not logs:
+        return None
+    apply_logs(db, logs, stats)
+    return logs[-1].id
+
+
+def reconcile_all(chunk: int = RECONCILE_CHUNK) -> dict:
+    """Синхронный проход по всем висящим логам (CLI)."""
+    stats = ReconcileStats()
+    after_id = 0
+    with SessionLocal() as db:
+        while after_id is not None:
+            after_id = reconcile_chunk(db, after_id, chunk, stats)
+            db.expunge_all()  # не копим объекты между чанками
+            if after_id is not None:
+                log.info("RECONCILE_PROGRESS %s", stats.report())
+    return stats.report()
+
+
+async def reconcile_all_async(chunk: int = RECONCILE_CHUNK) -> dict:
+    """То же внутри приложения: каждый чанк — отдельная транзакция под single_writer."""
+    stats = ReconcileStats()
+    after_id = 0
+    while after_id is not None:
+        async with write_session() as db:
+            after_id = await db.run_sync(reconcile_chunk, after_id, chunk, stats)
+        await asyncio.sleep(0)  # даём дорогу запросам между чанками
+    return stats.report()
+
+
+async def run_periodic(interval: int = RECONCILE_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            report = await reconcile_all_async()
+            if report["attached"]:
+                log.info("RECONCILE_DONE %s", report)
+        except Exception:
+            log.exception("RECONCILE_FAILED")
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Привязать все висящие постбэки к пользователям")
+    ap.add_argument("--chunk", type=int, default=RECONCILE_CHUNK)
+    args = ap.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    import cluster  # noqa: F401 — при CACHE_SYNC=1 воркеры узнают о привязанных пользователях
+    print(reconcile_all(args.chunk))
@@ -1,8 +1,8 @@
 from database import Base, engine
-from models import User
+from migrations import run_migrations
 
-# Удаляем и создаём заново таблицы
+# Удаляем и создаём заново таблицы (schema_version тоже в Base.metadata)
 Base.metadata.drop_all(bind=engine)
-Base.metadata.create_all(bind=engine)
+run_migrations(engine)
 
 print("✅ База очищена и пересоздана.")
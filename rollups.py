@@ -0,0 +1,158 @@
+# rollups.py
+"""Дневные агрегаты воронки (daily_stats); python rollups.py --backfill."""
+import argparse
+from datetime import date, datetime, timedelta
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Query
+from sqlalchemy import and_, delete, event, func, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from database import engine, get_db
+from models import DailyStat, PostbackLog
+
+router = APIRouter()
+
+COUNTERS = ("registrations", "trader_linked", "ftd_count", "ftd_volume", "deposit_count", "deposit_volume")
+STATS_MAX_DAYS = 366
+
+_INFO_KEY = "rollup_deltas"
+
+
+# --- инкрементальные дельты ---
+
+def record(db, day: date, currency: Optional[str] = "", **deltas):
+    """Добавить дельты к (день, валюта); запишутся при коммите этой сессии."""
+    pending = db.info.setdefault(_INFO_KEY, {})
+    row = pending.setdefault((day, (currency or "")[:10]), dict.fromkeys(COUNTERS, 0))
+    for name, value in deltas.items():
+        row[name] += value
+
+def log_day(created_at: Optional[datetime]) -> date:
+    """День лога — тот же, что date(created_at) в backfill."""
+    return (created_at or datetime.utcnow()).date()
+
+def record_postback(db, event_name: str, amount: float, currency: Optional[str], day: date):
+    """Принятый (не дубль) постбэк."""
+    if event_name == "registration":
+        record(db, day, registrations=1)
+    elif event_name == "deposit" and amount > 0:
+        record(db, day, currency, deposit_count=1, deposit_volume=amount)
+
+def record_trader_linked(db, day: date):
+    record(db, day, trader_linked=1)
+
+def record_ftd(db, amount: float, currency: Optional[str], day: date):
+    record(db, day, currency, ftd_count=1, ftd_volume=amount)
+
+
+def _upsert(dialect_name: str):
+    insert = postgresql.insert if dialect_name == "postgresql" else sqlite.insert
+    stmt = insert(DailyStat)
+    return stmt.on_conflict_do_update(
+        index_elements=[DailyStat.day, DailyStat.currency],
+        set_={name: getattr(DailyStat, name) + stmt.excluded[name] for name in COUNTERS},
+    )
+
+@event.listens_for(Session, "before_commit")
+def _flush_deltas(session):
+    pending = session.info.pop(_INFO_KEY, None)
+    if not pending:
+        return
+    rows = [{"day": day, "currency": currency, **counters} for (day, currency), counters in pending.items()]
+    session.execute(_upsert(session.get_bind().dialect.name), rows)
+
+@event.listens_for(Session, "after_soft_rollback")
+def _drop_deltas(session, previous_transaction):
+    session.info.pop(_INFO_KEY, None)
+
+
+# --- пересчёт с нуля ---
+
+def _as_date(value) -> date:
+    return date.fromisoformat(value) if isinstance(value, str) else value
+
+def backfill(conn) -> int:
+    """Пересчитывает daily_stats из postbacks_log (в транзакции conn). Возвращает число строк."""
+    day = func.date(PostbackLog.created_at)
+    currency = func.coalesce(PostbackLog.currency, "")
+    is_deposit = and_(PostbackLog.event == "deposit", PostbackLog.amount > 0)
+    totals: dict[tuple, dict] = {}
+
+    def add(d, cur, **deltas):
+        row = totals.setdefault((_as_date(d), cur or ""), dict.fromkeys(COUNTERS, 0))
+        for name, value in deltas.items():
+            row[name] += value or 0
+
+    for d, n in conn.execute(select(day, func.count()).where(PostbackLog.event == "registration")
+                             .group_by(day)):
+        add(d, "", registrations=n)
+    for d, cur, n, volume in conn.execute(select(day, currency, func.count(), func.sum(PostbackLog.amount))
+                                          .where(is_deposit).group_by(day, currency)):
+        add(d, cur, deposit_count=n, deposit_volume=volume)
+
+    # первый депозит (как в projections: только с курсом) и первый лог с trader_id — по минимальному id
+    first_deposit = (select(func.min(PostbackLog.id).label("id"))
+                     .where(is_deposit, PostbackLog.amount_base.is_not(None), PostbackLog.user_id.is_not(None))
+                     .group_by(PostbackLog.user_id).subquery())
+    for d, cur, n, volume in conn.execute(
+            select(day, currency, func.count(), func.sum(PostbackLog.amount))
+            .join(first_deposit, PostbackLog.id == first_deposit.c.id).group_by(day, currency)):
+        add(d, cur, ftd_count=n, ftd_volume=volume)
+    first_trader = (select(func.min(PostbackLog.id).label("id"))
+                    .where(PostbackLog.trader_id.is_not(None), PostbackLog.user_id.is_not(None))
+                    .group_by(PostbackLog.user_id).subquery())
+    for d, n in conn.execute(select(day, func.count())
+                             .join(first_trader, PostbackLog.id == first_trader.c.id).group_by(day)):
+        add(d, "", trader_linked=n)
+
+    conn.execute(delete(DailyStat))
+    if totals:
+        conn.execute(DailyStat.__table__.insert(),
+                     [{"day": d, "currency": cur, **counters} for (d, cur), counters in totals.items()])
+    return len(totals)
+
+
+# --- чтение ---
+
+@router.get("/stats/daily")
+async def daily_stats(
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    currency: Optional[str] = Query(None, max_length=10),
+    db: AsyncSession = Depends(get_db),
+):
+    """Агрегаты за [date_from, date_to] (по умолчанию — последние 30 дней); читает только daily_stats."""
+    date_to = date_to or datetime.utcnow().date()
+    date_from = max(date_from or date_to - timedelta(days=29), date_to - timedelta(days=STATS_MAX_DAYS))
+    stmt = (select(DailyStat).where(DailyStat.day >= date_from, DailyStat.day <= date_to)
+            .order_by(DailyStat.day, DailyStat.currency))
+    if currency is not None:
+        stmt = stmt.where(DailyStat.currency == currency.upper())
+    rows = (await db.scalars(stmt)).all()
+
+    days, totals = [], {}
+    for r in rows:
+        item = {"day": r.day.isoformat(), "currency": r.currency or None}
+        total = totals.setdefault(r.currency or "-", dict.fromkeys(COUNTERS, 0))  # суммы — по валютам
+        for name in COUNTERS:
+            item[name] = getattr(r, name)
+            total[name] += item[name]
+        days.append(item)
+    for total in totals.values():
+        total["ftd_volume"] = round(total["ftd_volume"], 2)
+        total["deposit_volume"] = round(total["deposit_volume"], 2)
+    return {"from": date_from.isoformat(), "to": date_to.isoformat(), "days": days, "totals": totals}
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Дневные агрегаты QOMEX")
+    ap.add_argument("--backfill", action="store_true", help="пересчитать daily_stats из postbacks_log")
+    args = ap.parse_args()
+    if args.backfill:
+        with engine.begin() as conn:
+            print(f"daily_stats rows: {backfill(conn)}")
+    else:
+        ap.print_help()
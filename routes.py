@@ -1,11 +1,11 @@
 # routes.py
 from fastapi import APIRouter, Request
-from fastapi.templating import Jinja2Templates
 from fastapi.responses import HTMLResponse, RedirectResponse
 import urllib.parse, secrets, os
+from templating import cached_page
+from sessions import end_session
 
 router = APIRouter()
-templates = Jinja2Templates(directory="templates")
 
 IS_SECURE_COOKIES = os.getenv("ENV", "dev") != "dev"
 SAMESITE_POLICY = "Lax"
@@ -23,32 +23,33 @@ def ensure_click_id(request: Request) -> str:
 
 @router.get("/cookie.html", response_class=HTMLResponse)
 async def cookie_policy(request: Request):
-    return templates.TemplateResponse("cookie.html", {"request": request})
+    return cached_page(request, "cookie.html")
 
 @router.get("/terms.html", response_class=HTMLResponse)
 async def terms(request: Request):
-    return templates.TemplateResponse("terms.html", {"request": request})
+    return cached_page(request, "terms.html")
 
 @router.get("/privacy.html", response_class=HTMLResponse)
 async def privacy(request: Request):
-    return templates.TemplateResponse("privacy.html", {"request": request})
+    return cached_page(request, "privacy.html")
 
 
-def _delete_auth_cookies(resp: RedirectResponse):
-    # удаляем с теми же атрибутами и path="/"
+async def _delete_auth_cookies(request: Request, resp: RedirectResponse):
+    # сессию отзываем, остальное удаляем с теми же атрибутами и path="/" (user_id — от старых версий)
+    await end_session(request, resp)
     for name in ["user_id", "user_email", "click_id"]:
         resp.delete_cookie(name, secure=IS_SECURE_COOKIES, samesite=SAMESITE_POLICY, path="/")
 
 @router.post("/logout")
-async def logout_post():
+async def logout_post(request: Request):
     resp = RedirectResponse("/", status_code=303)
-    _delete_auth_cookies(resp)
+    await _delete_auth_cookies(request, resp)
     return resp
 
 @router.get("/logout")
-async def logout_get():
+async def logout_get(request: Request):
     resp = RedirectResponse("/", status_code=303)
-    _delete_auth_cookies(resp)
+    await _delete_auth_cookies(request, resp)
     return resp
 
 
@@ -129,7 +130,7 @@ def sitemap_head():
 # ---------- Страница /signals и редирект со старого пути ----------
 @router.get("/signals", response_class=HTMLResponse)
 def signals_page(request: Request):
-    return templates.TemplateResponse("signals.html", {"request": request})
+    return cached_page(request, "signals.html")
 
 @router.get("/go-to-signals")
 def go_to_signals():
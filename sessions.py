@@ -0,0 +1,250 @@
+# sessions.py
+"""Подписанные сессии в cookie и deny list отозванных."""
+import logging
+import os
+import secrets
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from http.cookies import SimpleCookie
+from typing import Optional
+
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+from sqlalchemy import delete, select
+from starlette.requests import cookie_parser
+
+from database import APP_WORKERS, AsyncSessionLocal, single_writer
+from models import RevokedSession
+from user_cache import get_funnel_state, user_cache
+import funnel
+
+SESSION_COOKIE = os.getenv("SESSION_COOKIE", "session")
+SESSION_MAX_AGE = int(os.getenv("SESSION_MAX_AGE", str(60 * 60 * 24 * 30)))  # сек
+SESSION_REFRESH = int(os.getenv("SESSION_REFRESH", "900"))  # сек; токен старше — перевыпускаем
+SESSION_CHANGED_SIZE = 100_000  # сколько отметок «пользователь изменился» держать в памяти
+SESSION_EXCLUDE = ("/static", "/postback", "/metrics")
+
+IS_SECURE_COOKIES = os.getenv("ENV", "dev") != "dev"
+SAMESITE_POLICY = "Lax"
+REMEMBER_MAX_AGE = 60 * 60 * 24 * 30
+
+log = logging.getLogger("sessions")
+
+_secret = os.getenv("SESSION_SECRET") or os.getenv("SECRET_KEY")
+if not _secret:
+    if APP_WORKERS > 1:
+        raise RuntimeError("SESSION_SECRET (or SECRET_KEY) must be set when running several workers")
+    log.warning("SESSION_SECRET_MISSING: using a random key, sessions will not survive a restart")
+    _secret = secrets.token_urlsafe(32)
+_serializer = URLSafeTimedSerializer(_secret, salt="session")
+
+
+@dataclass(frozen=True)
+class SessionClaims:
+    user_id: int
+    has_trader: bool
+    verified: bool
+    sid: str
+    remember: bool
+    issued_at: float
+
+    @property
+    def funnel_state(self) -> str:
+        if self.verified:
+            return funnel.VERIFIED
+        return funnel.TRADER_LINKED if self.has_trader else funnel.REGISTERED
+
+
+# --- токены ---
+
+def issue(user_id: int, has_trader: bool, verified: bool, remember: bool = False,
+          sid: Optional[str] = None) -> str:
+    # i — время выдачи в мс: метка itsdangerous секундная, а сброс пароля и новый логин
+    # часто укладываются в одну секунду
+    return _serializer.dumps({"u": user_id, "t": int(has_trader), "v": int(verified),
+                              "s": sid or secrets.token_urlsafe(6), "m": int(remember),
+                              "i": time.time_ns() // 1_000_000})
+
+def issue_for_state(user_id: int, state: str, remember: bool = False, sid: Optional[str] = None) -> str:
+    return issue(user_id, state != funnel.REGISTERED, state == funnel.VERIFIED, remember, sid)
+
+def issue_for(user, remember: bool = False, sid: Optional[str] = None) -> str:
+    return issue_for_state(user.id, user.funnel_state, remember, sid)
+
+def read(token: str) -> Optional[SessionClaims]:
+    try:
+        data, ts = _serializer.loads(token, max_age=SESSION_MAX_AGE, return_timestamp=True)
+        issued_at = data["i"] / 1000 if "i" in data else ts.timestamp()
+        return SessionClaims(user_id=int(data["u"]), has_trader=bool(data["t"]), verified=bool(data["v"]),
+                             sid=str(data["s"]), remember=bool(data.get("m")), issued_at=issued_at)
+    except (BadSignature, KeyError, TypeError, ValueError):
+        return None
+
+
+def _cookie_header(value: str, max_age: Optional[int]) -> bytes:
+    cookie = SimpleCookie()
+    cookie[SESSION_COOKIE] = value
+    morsel = cookie[SESSION_COOKIE]
+    morsel["path"] = "/"
+    morsel["httponly"] = True
+    morsel["samesite"] = SAMESITE_POLICY
+    if IS_SECURE_COOKIES:
+        morsel["secure"] = True
+    if max_age is not None:
+        morsel["max-age"] = max_age
+    return cookie.output(header="").strip().encode("latin-1")
+
+def set_session_cookie(resp, user, remember: bool = False, sid: Optional[str] = None):
+    """Выдать (или перевыпустить с тем же sid) токен на ответе обработчика."""
+    resp.set_cookie(SESSION_COOKIE, issue_for(user, remember, sid), httponly=True,
+                    max_age=REMEMBER_MAX_AGE if remember else None,
+                    secure=IS_SECURE_COOKIES, samesite=SAMESITE_POLICY, path="/")
+
+def clear_session_cookie(resp):
+    resp.delete_cookie(SESSION_COOKIE, secure=IS_SECURE_COOKIES, samesite=SAMESITE_POLICY, path="/")
+
+def current_session(request) -> Optional[SessionClaims]:
+    return request.scope.get("state", {}).get("session")
+
+
+# --- кто изменился после выдачи токена ---
+
+_changed: OrderedDict[int, float] = OrderedDict()  # user_id -> когда изменился
+_changed_all_at = 0.0                               # user_cache.clear(): изменились все
+
+def _on_user_change(user_ids):
+    global _changed_all_at
+    now = time.time()
+    if user_ids is None:
+        _changed_all_at = now
+        _changed.clear()
+        return
+    for user_id in user_ids:
+        _changed[user_id] = now
+        _changed.move_to_end(user_id)
+    while len(_changed) > SESSION_CHANGED_SIZE:
+        _changed.popitem(last=False)
+
+user_cache.subscribe(_on_user_change)
+
+def _stale(claims: SessionClaims) -> bool:
+    # >=: при равенстве меток безопаснее перевыпустить
+    changed_at = max(_changed.get(claims.user_id, 0.0), _changed_all_at)
+    return changed_at >= claims.issued_at or time.time() - claims.issued_at > SESSION_REFRESH
+
+
+# --- deny list ---
+
+class DenyList:
+    def __init__(self):
+        self._sids: dict[str, float] = {}    # sid -> истечение записи (unix)
+        self._users: dict[int, float] = {}   # user_id -> отозваны токены, выданные до этого момента
+
+    def denied(self, claims: SessionClaims) -> bool:
+        if claims.sid in self._sids:
+            return True
+        revoked_at = self._users.get(claims.user_id)
+        return revoked_at is not None and claims.issued_at < revoked_at
+
+    def _add(self, key: str, revoked_at: float, expires_at: float):
+        kind, _, value = key.partition(":")
+        if kind == "s":
+            self._sids[value] = expires_at
+        elif kind == "u":
+            revoked_at = int(revoked_at * 1000) / 1000  # с точностью токена (мс)
+            self._users[int(value)] = max(self._users.get(int(value), 0.0), revoked_at)
+
+    def load(self, db) -> int:
+        """Перечитать неистёкшие записи (db — Session или Connection)."""
+        self._sids, self._users = {}, {}
+        rows = db.execute(select(RevokedSession.key, RevokedSession.revoked_at, RevokedSession.expires_at)
+                          .where(RevokedSession.expires_at > datetime.utcnow())).all()
+        for key, revoked_at, expires_at in rows:
+            self._add(key, _ts(revoked_at), _ts(expires_at))
+        return len(rows)
+
+    def __len__(self):
+        return len(self._sids) + len(self._users)
+
+
+def _ts(dt: datetime) -> float:
+    """naive UTC из БД -> unix-время (как issued_at токена)."""
+    return (dt - datetime(1970, 1, 1)).total_seconds()
+
+deny_list = DenyList()
+
+
+async def refresh_deny_list() -> int:
+    async with AsyncSessionLocal() as db:
+        return await db.run_sync(deny_list.load)
+
+async def revoke(sid: Optional[str] = None, user_id: Optional[int] = None):
+    """Отозвать одну сессию (выход) или все сессии пользователя, выданные до этого момента."""
+    now = datetime.utcnow()
+    key = f"s:{sid}" if sid else f"u:{user_id}"
+    row = RevokedSession(key=key, revoked_at=now, expires_at=now + timedelta(seconds=SESSION_MAX_AGE))
+    async with single_writer():
+        async with AsyncSessionLocal() as db:
+            await db.merge(row)
+            # заодно выметаем истёкшие — токены с ними уже не пройдут проверку срока
+            await db.execute(delete(RevokedSession).where(RevokedSession.expires_at <= now))
+            await db.commit()
+    deny_list._add(key, _ts(now), _ts(row.expires_at))
+
+async def end_session(request, resp):
+    """Выход: отзываем текущую сессию и стираем cookie."""
+    claims = current_session(request)
+    if claims is not None:
+        await revoke(sid=claims.sid)
+    clear_session_cookie(resp)
+
+
+# --- middleware ---
+
+class SessionMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"].startswith(SESSION_EXCLUDE):
+            return await self.app(scope, receive, send)
+
+        token = None
+        for k, v in scope["headers"]:
+            if k == b"cookie":
+                token = cookie_parser(v.decode("latin-1")).get(SESSION_COOKIE)
+                break
+
+        claims = read(token) if token else None
+        set_cookie = None
+        if token and (claims is None or deny_list.denied(claims)):
+            claims, set_cookie = None, _cookie_header("", 0)  # битый, истёкший или отозванный — стираем
+        elif claims is not None and _stale(claims):
+            claims, set_cookie = await self._reissue(claims)
+
+        scope.setdefault("state", {})["session"] = claims
+        if set_cookie is None:
+            return await self.app(scope, receive, send)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                # обработчик мог сам выдать cookie (логин, /check) — его версия главнее
+                if not any(k == b"set-cookie" and v.startswith(SESSION_COOKIE.encode() + b"=")
+                           for k, v in headers):
+                    headers.append((b"set-cookie", set_cookie))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+    @staticmethod
+    async def _reissue(claims: SessionClaims):
+        async with AsyncSessionLocal() as db:
+            state = await get_funnel_state(db, claims.user_id)
+        if state is None:
+            return None, _cookie_header("", 0)
+        token = issue_for_state(claims.user_id, state, claims.remember, claims.sid)
+        fresh = read(token)
+        return fresh, _cookie_header(token, REMEMBER_MAX_AGE if claims.remember else None)
@@ -0,0 +1,19 @@
+// Живое ожидание шага воронки: слушаем /events/funnel (live.py) и уходим дальше,
+// как только постбэк брокера сменит шаг — без перезагрузок страницы по кругу.
+//   data-wait      — шаги (через пробел), на которых страница ещё ждёт: registered trader_linked
+//   data-on-change — "next": перейти на следующий шаг, "reload": перерисовать эту страницу
+(function () {
+  const script = document.currentScript;
+  if (!script || !window.EventSource) return;
+  const waiting = (script.dataset.wait || '').split(' ');
+  const onChange = script.dataset.onChange || 'next';
+
+  const source = new EventSource('/events/funnel');
+  source.addEventListener('funnel', (e) => {
+    const data = JSON.parse(e.data);
+    if (waiting.includes(data.state)) return;
+    source.close();
+    if (onChange === 'reload') location.reload();
+    else location.href = data.next;
+  });
+})();
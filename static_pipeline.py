@@ -0,0 +1,237 @@
+# static_pipeline.py
+"""Сборка статики с хэшами и предсжатием; python static_pipeline.py [--force]."""
+import argparse
+import gzip
+import hashlib
+import io
+import json
+import mimetypes
+import os
+import re
+import tempfile
+from urllib.parse import quote
+
+from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse
+from starlette.staticfiles import NotModifiedResponse
+
+from locks import file_lock
+
+try:
+    import brotli
+except ImportError:  # опционально: без него — только gzip
+    brotli = None
+
+try:
+    from PIL import Image, features as pil_features
+except ImportError:  # опционально: без Pillow — без webp/avif
+    Image = None
+
+STATIC_DIR = "static"
+STATIC_BUILD_DIR = os.getenv("STATIC_BUILD_DIR", "static_build")
+STATIC_PIPELINE = os.getenv("STATIC_PIPELINE", "1") == "1"  # 0 — раздавать static/ как раньше
+STATIC_MAX_AGE = int(os.getenv("STATIC_MAX_AGE", "300"))    # для адресов без хэша
+IMAGE_QUALITY = {"webp": int(os.getenv("WEBP_QUALITY", "80")), "avif": int(os.getenv("AVIF_QUALITY", "60"))}
+
+PIPELINE_VERSION = 1  # менять при изменении формата сборки — форсирует пересборку
+MANIFEST_NAME = "manifest.json"
+COMPRESSIBLE = {".css", ".js", ".svg", ".html", ".json", ".txt", ".xml", ".ico", ".map"}
+RASTER = {".png", ".jpg", ".jpeg"}
+IMMUTABLE = "public, max-age=31536000, immutable"
+# вариант берём, только если он заметно меньше исходника
+MIN_GAIN = 0.9
+
+# (суффикс файла, Content-Encoding) и (суффикс файла, MIME картинки) — в порядке предпочтения
+ENCODINGS = (("br", "br"), ("gz", "gzip"))
+IMAGE_FORMATS = (("avif", "image/avif"), ("webp", "image/webp"))
+
+_CSS_URL_RE = re.compile(r"""url\((['"]?)/static/([^'")?#]+)([^'")]*)\1\)""")
+
+_files: dict = {}  # исходное имя -> {"path": имя с хэшем, "variants": [...]}
+
+
+# --- сборка ---
+
+def _source_files(src: str) -> list[str]:
+    out = []
+    for root, dirs, names in os.walk(src):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        for name in names:
+            if not name.startswith("."):
+                out.append(os.path.relpath(os.path.join(root, name), src).replace(os.sep, "/"))
+    return sorted(out)
+
+def _signature(src: str, rels: list[str]) -> str:
+    h = hashlib.sha1(f"v{PIPELINE_VERSION} br={bool(brotli)} img={bool(Image)}".encode())
+    for rel in rels:
+        st = os.stat(os.path.join(src, rel))
+        h.update(f"{rel}:{st.st_size}:{st.st_mtime_ns}\n".encode())
+    return h.hexdigest()
+
+def _write_atomic(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+def _rewrite_css(data: bytes, files: dict) -> bytes:
+    def repl(m):
+        entry = files.get(m.group(2))
+        if entry is None:
+            return m.group(0)
+        return f"url({m.group(1)}/static/{quote(entry['path'])}{m.group(1)})"
+    return _CSS_URL_RE.sub(repl, data.decode("utf-8")).encode("utf-8")
+
+def _image_renditions(data: bytes) -> dict[str, bytes]:
+    if Image is None:
+        return {}
+    out = {}
+    for fmt, _ in IMAGE_FORMATS:
+        if not pil_features.check(fmt):
+            continue
+        with Image.open(io.BytesIO(data)) as im:
+            if im.mode not in ("RGB", "RGBA"):
+                im = im.convert("RGBA")
+            buf = io.BytesIO()
+            im.save(buf, format=fmt.upper(), quality=IMAGE_QUALITY[fmt])
+        out[fmt] = buf.getvalue()
+    return out
+
+def _build_file(out: str, rel: str, data: bytes) -> dict:
+    stem, ext = os.path.splitext(rel)
+    hashed = f"{stem}.{hashlib.sha256(data).hexdigest()[:12]}{ext}"
+    target = os.path.join(out, hashed)
+    variants = []
+    if os.path.exists(target):
+        # имя — по содержимому: файл уже собран, варианты берём с диска
+        variants = [s for s, _ in ENCODINGS + IMAGE_FORMATS if os.path.exists(f"{target}.{s}")]
+        return {"path": hashed, "variants": variants}
+
+    candidates = {}
+    ext = ext.lower()
+    if ext in COMPRESSIBLE:
+        if brotli is not None:
+            candidates["br"] = brotli.compress(data, quality=11)
+        candidates["gz"] = gzip.compress(data, compresslevel=9, mtime=0)
+    elif ext in RASTER:
+        candidates.update(_image_renditions(data))
+    for suffix, blob in candidates.items():
+        if len(blob) < len(data) * MIN_GAIN:
+            _write_atomic(f"{target}.{suffix}", blob)
+            variants.append(suffix)
+    _write_atomic(target, data)  # основной файл — последним: по нему проверяем готовность
+    return {"path": hashed, "variants": variants}
+
+def build(src: str = STATIC_DIR, out: str = STATIC_BUILD_DIR, force: bool = False) -> dict:
+    """Собирает out из src; возвращает манифест. Без изменений в src — читает готовый."""
+    rels = _source_files(src)
+    signature = _signature(src, rels)
+    manifest_path = os.path.join(out, MANIFEST_NAME)
+    if not force and os.path.exists(manifest_path):
+        with open(manifest_path, encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest.get("signature") == signature:
+            return manifest
+
+    files = {}
+    # CSS — последними: в них переписываются ссылки на уже собранные картинки
+    for rel in sorted(rels, key=lambda r: r.endswith(".css")):
+        with open(os.path.join(src, rel), "rb") as f:
+            data = f.read()
+        if rel.endswith(".css"):
+            data = _rewrite_css(data, files)
+        files[rel] = _build_file(out, rel, data)
+
+    manifest = {"signature": signature, "files": files}
+    _write_atomic(manifest_path, json.dumps(manifest, ensure_ascii=False, indent=1).encode("utf-8"))
+    return manifest
+
+
+def ensure_built() -> bool:
+    """На старте: собрать при необходимости и загрузить манифест. False — pipeline выключен."""
+    global _files
+    if not STATIC_PIPELINE:
+        return False
+    # несколько воркеров стартуют разом: собирает первый, остальные читают его манифест
+    with file_lock(os.path.join(STATIC_BUILD_DIR, ".build.lock")):
+        _files = build()["files"]
+    return True
+
+
+# --- шаблоны ---
+
+def static_url(rel: str) -> str:
+    """Адрес файла из static/ для шаблонов: с хэшем, если он собран."""
+    entry = _files.get(rel)
+    return "/static/" + quote(entry["path"] if entry else rel)
+
+
+# --- раздача ---
+
+def accepts(header: str, token: str) -> bool:
+    for part in header.split(","):
+        name, _, params = part.strip().partition(";")
+        if name.strip().lower() == token:
+            return params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000")
+    return False
+
+
+class AssetFiles(StaticFiles):
+    """StaticFiles над STATIC_BUILD_DIR с выбором предсжатого варианта."""
+
+    def __init__(self, directory: str, files: dict):
+        super().__init__(directory=directory)
+        self.assets = {}
+        for rel, entry in files.items():
+            media_type = mimetypes.guess_type(rel)[0] or "application/octet-stream"
+            asset = (entry["path"], tuple(entry["variants"]), media_type)
+            self.assets[entry["path"]] = asset + (IMMUTABLE,)
+            self.assets.setdefault(rel, asset + (f"public, max-age={STATIC_MAX_AGE}",))
+
+    def _pick(self, path: str, variants: tuple, media_type: str, request_headers: Headers):
+        accept_encoding = request_headers.get("accept-encoding", "")
+        accept = request_headers.get("accept", "")
+        for suffix, encoding in ENCODINGS:
+            if suffix in variants and accepts(accept_encoding, encoding):
+                return f"{path}.{suffix}", media_type, {"Content-Encoding": encoding, "Vary": "Accept-Encoding"}
+        for suffix, image_type in IMAGE_FORMATS:
+            if suffix in variants and accepts(accept, image_type):
+                return f"{path}.{suffix}", image_type, {"Vary": "Accept"}
+        vary = "Accept-Encoding" if any(s in variants for s, _ in ENCODINGS) else \
+               "Accept" if variants else None
+        return path, media_type, ({"Vary": vary} if vary else {})
+
+    async def get_response(self, path: str, scope):
+        asset = self.assets.get(path.replace(os.sep, "/"))
+        if asset is None or scope["method"] not in ("GET", "HEAD"):
+            return await super().get_response(path, scope)
+
+        hashed, variants, media_type, cache_control = asset
+        request_headers = Headers(scope=scope)
+        rel, media_type, headers = self._pick(hashed, variants, media_type, request_headers)
+        full_path = os.path.join(self.directory, rel)
+        headers["Cache-Control"] = cache_control
+        response = FileResponse(full_path, stat_result=os.stat(full_path),
+                                media_type=media_type, headers=headers)
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
+
+
+def static_app():
+    """Приложение для app.mount("/static", ...)."""
+    if ensure_built():
+        return AssetFiles(STATIC_BUILD_DIR, _files)
+    return StaticFiles(directory=STATIC_DIR)
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Сборка статики QOMEX")
+    ap.add_argument("--force", action="store_true", help="пересобрать, даже если исходники не менялись")
+    args = ap.parse_args()
+    manifest = build(force=args.force)
+    total = sum(os.path.getsize(os.path.join(STATIC_BUILD_DIR, e["path"])) for e in manifest["files"].values())
+    print(f"{len(manifest['files'])} files, {total // 1024} KB -> {STATIC_BUILD_DIR}/ "
+          f"(brotli: {'yes' if brotli else 'no'}, images: {'yes' if Image else 'no'})")
@@ -0,0 +1,140 @@
+# templating.py
+"""Общее Jinja-окружение и кэш готовых страниц."""
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from email.utils import formatdate, parsedate_to_datetime
+
+import jinja2
+from fastapi import Request
+from fastapi.responses import HTMLResponse, Response
+from fastapi.templating import Jinja2Templates
+
+import metrics
+from compression import COMPRESSION_ENABLED, COMPRESSION_MIN_SIZE, compress_body, pick_encoding
+from static_pipeline import static_url
+
+TEMPLATES_DIR = "templates"
+TEMPLATES_AUTO_RELOAD = os.getenv("TEMPLATES_AUTO_RELOAD",
+                                  "1" if os.getenv("ENV", "dev") == "dev" else "0") == "1"
+TEMPLATE_BYTECODE_DIR = os.getenv("TEMPLATE_BYTECODE_DIR",
+                                  os.path.join(tempfile.gettempdir(), "qomex-jinja-bytecode"))
+PAGE_CACHE_ENABLED = os.getenv("PAGE_CACHE", "1") == "1"
+
+os.makedirs(TEMPLATE_BYTECODE_DIR, exist_ok=True)
+
+env = jinja2.Environment(
+    loader=jinja2.FileSystemLoader(TEMPLATES_DIR),
+    autoescape=True,  # как у Jinja2Templates по умолчанию
+    auto_reload=TEMPLATES_AUTO_RELOAD,
+    bytecode_cache=jinja2.FileSystemBytecodeCache(TEMPLATE_BYTECODE_DIR),
+    cache_size=-1,  # шаблонов десяток — держим все
+)
+
+env.globals["static_url"] = static_url  # адреса статики с хэшем (static_pipeline.py)
+
+templates = metrics.instrument_templates(Jinja2Templates(env=env))
+
+
+class _Page:
+    __slots__ = ("body", "etag", "last_modified", "mtime", "encoded")
+
+    def __init__(self, body: bytes, mtime: float):
+        self.body = body
+        self.etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        self.last_modified = formatdate(time.time(), usegmt=True)
+        self.mtime = mtime
+        self.encoded: dict[str, bytes] = {}  # сжатые копии тела, по кодировке
+
+    def body_for(self, encoding: str) -> bytes:
+        # сжимаем один раз на страницу, а не на каждый запрос в CompressionMiddleware
+        body = self.encoded.get(encoding)
+        if body is None:
+            body = self.encoded[encoding] = compress_body(self.body, encoding)
+        return body
+
+
+class PageCache:
+    """Отрендеренные страницы по ключу (шаблон, вариант)."""
+
+    def __init__(self):
+        self._pages: dict[tuple, _Page] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _mtime(name: str) -> float:
+        return os.stat(os.path.join(TEMPLATES_DIR, name)).st_mtime if TEMPLATES_AUTO_RELOAD else 0.0
+
+    def _render(self, request: Request, name: str) -> bytes:
+        t0 = time.perf_counter()
+        body = env.get_template(name).render(request=request).encode("utf-8")
+        metrics.template_render_time.observe(time.perf_counter() - t0, name)
+        return body
+
+    def get(self, request: Request, name: str, variant: str = "") -> _Page:
+        key = (name, variant)
+        mtime = self._mtime(name)
+        page = self._pages.get(key)
+        if page is not None and page.mtime == mtime:
+            self.hits += 1
+            return page
+        self.misses += 1
+        page = _Page(self._render(request, name), mtime)
+        with self._lock:
+            self._pages[key] = page
+        return page
+
+    def clear(self):
+        with self._lock:
+            self._pages.clear()
+
+    def stats(self) -> dict:
+        return {"pages": len(self._pages), "hits": self.hits, "misses": self.misses}
+
+
+page_cache = PageCache()
+
+
+def _not_modified(request: Request, page: _Page) -> bool:
+    inm = request.headers.get("if-none-match")
+    if inm is not None:
+        # слабое сравнение: CompressionMiddleware отдаёт сжатую страницу с W/-тегом
+        return page.etag in (t.strip().removeprefix("W/") for t in inm.split(",")) or inm.strip() == "*"
+    ims = request.headers.get("if-modified-since")
+    if ims:
+        try:
+            return parsedate_to_datetime(ims) >= parsedate_to_datetime(page.last_modified)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def cached_page(request: Request, name: str, variant: str = "", vary: str | None = None) -> Response:
+    """Готовая страница из кэша; variant — ключ варианта, vary — заголовок Vary."""
+    if not PAGE_CACHE_ENABLED:
+        return templates.TemplateResponse(name, {"request": request})
+
+    page = page_cache.get(request, name, variant)
+    headers = {"ETag": page.etag, "Last-Modified": page.last_modified, "Cache-Control": "no-cache"}
+    encoding = None
+    if COMPRESSION_ENABLED and len(page.body) >= COMPRESSION_MIN_SIZE:
+        encoding = pick_encoding(request.headers.get("accept-encoding", ""))
+        vary = f"{vary}, Accept-Encoding" if vary else "Accept-Encoding"
+    if vary:
+        headers["Vary"] = vary
+    if _not_modified(request, page):
+        return Response(status_code=304, headers=headers)
+    if encoding is None:
+        return HTMLResponse(page.body, headers=headers)
+    headers["Content-Encoding"] = encoding
+    headers["ETag"] = "W/" + page.etag
+    return HTMLResponse(page.body_for(encoding), headers=headers)
+
+
+def login_variant(request: Request) -> str:
+    """Вариант для страниц, в шапке которых «Профиль» вместо «Зарегистрироваться»."""
+    return "user" if request.cookies.get("user_email") else "guest"
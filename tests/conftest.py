@@ -0,0 +1,77 @@
+# tests/conftest.py
+# Окружение — до импорта модулей приложения: настройки читаются из os.environ при импорте.
+import os
+import sys
+import tempfile
+
+_tmp = tempfile.mkdtemp(prefix="qomex-tests-")
+os.environ.update({
+    "DATABASE_URL": f"sqlite:///{_tmp}/test.db",
+    "LOCK_DIR": _tmp,
+    "APP_LOG_FILE": os.path.join(_tmp, "app.log"),
+    "SESSION_SECRET": "test-secret",
+    "BCRYPT_ROUNDS": "4",
+    "FX_RATES_FILE": "",
+    "FX_REFRESH_INTERVAL": "0",
+    "RECONCILE_INTERVAL": "0",
+    "RATELIMIT_ENABLED": "0",
+    "POSTBACK_SECRET": "test-token",
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from sqlalchemy import delete
+
+import main  # noqa: F401  — применяет миграции к тестовой базе
+from database import Base, SessionLocal, engine
+from fx import fx_rates
+from models import User
+from postback import recent_fingerprints
+from sessions import deny_list
+from user_cache import user_cache
+
+TOKEN = "test-token"
+
+
+@pytest.fixture(scope="session")
+def anyio_backend():
+    # один event loop на всю сессию: движок и пул соединений общие для тестов
+    return "asyncio"
+
+
+@pytest.fixture(autouse=True)
+def clean_db():
+    with engine.begin() as conn:
+        for table in reversed(Base.metadata.sorted_tables):
+            if table.name != "schema_version":
+                conn.execute(delete(table))
+    with engine.connect() as conn:
+        fx_rates.load(conn)
+        deny_list.load(conn)
+    user_cache.clear()
+    recent_fingerprints._items.clear()
+    yield
+
+
+@pytest.fixture
+def make_user():
+    def make(login: str, **fields) -> User:
+        fields.setdefault("email", f"{login}@example.com")
+        fields.setdefault("password", "x")
+        fields.setdefault("click_id", f"click-{login}")
+        with SessionLocal() as db:
+            user = User(login=login, **fields)
+            db.add(user)
+            db.commit()
+            db.refresh(user)
+            db.expunge(user)
+            return user
+    return make
+
+
+@pytest.fixture
+async def client():
+    import httpx
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as c:
+        yield c
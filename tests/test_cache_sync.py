@@ -0,0 +1,56 @@
+# tests/test_cache_sync.py
+import pytest
+from sqlalchemy import insert
+
+from cluster import CacheSync
+from database import SessionLocal, engine
+from models import CacheEvent, User
+from user_cache import user_cache
+
+pytestmark = pytest.mark.anyio
+
+
+def _commit_event(event_id: int, user_id: int):
+    with engine.begin() as conn:
+        conn.execute(insert(CacheEvent).values(id=event_id, cache="users", key=str(user_id)))
+
+
+def _cache(*users):
+    with SessionLocal() as db:
+        for u in users:
+            user_cache.put(db.get(User, u.id))
+
+
+async def test_out_of_order_commit_is_applied(make_user):
+    a, b, c = make_user("a"), make_user("b"), make_user("c")
+    sync = CacheSync()
+    await sync.poll()  # старт с пустой таблицы
+    _cache(a, b, c)
+
+    # id 1 выдан транзакции, которая закоммитилась позже id 2 (Postgres)
+    _commit_event(2, b.id)
+    assert await sync.poll() == 1
+    assert user_cache.get(b.id) is None and user_cache.get(a.id) is not None
+    assert sync.stats()["gaps"] == 1
+
+    _commit_event(1, a.id)
+    _commit_event(3, c.id)
+    assert await sync.poll() == 2
+    assert user_cache.get(a.id) is None and user_cache.get(c.id) is None
+    assert sync.stats() == {"last_id": 3, "gaps": 0, "applied": 3}
+
+    _cache(a, b, c)
+    assert await sync.poll() == 0  # уже применённые события не перечитываются
+    assert all(user_cache.get(u.id) is not None for u in (a, b, c))
+
+
+async def test_gap_is_forgotten_after_timeout(make_user):
+    a = make_user("a")
+    sync = CacheSync(gap_timeout=0)
+    await sync.poll()
+    _commit_event(2, a.id)
+    await sync.poll()
+    await sync.poll()
+    assert sync.stats()["gaps"] == 0
+    _commit_event(1, a.id)  # откаченная транзакция так и не появится; поздний id после таймаута не ждём
+    assert await sync.poll() == 0
@@ -0,0 +1,152 @@
+# tests/test_mailer.py
+import socket
+from datetime import datetime
+
+import pytest
+from aiosmtpd.controller import Controller
+from sqlalchemy import select, update
+
+import mailer
+from database import SessionLocal
+from models import OutboxEmail
+
+pytestmark = pytest.mark.anyio
+
+
+class _Handler:
+    def __init__(self):
+        self.sessions = 0
+        self.delivered: list[str] = []
+        self.temp_fail: set[str] = set()
+
+    async def handle_EHLO(self, server, session, envelope, hostname, responses):
+        self.sessions += 1
+        session.host_name = hostname
+        return responses
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        if address in self.temp_fail:
+            return "451 4.7.1 Try again later"
+        if address.startswith("nobody@"):
+            return "550 5.1.1 No such user"
+        envelope.rcpt_tos.append(address)
+        return "250 OK"
+
+    async def handle_DATA(self, server, session, envelope):
+        self.delivered.extend(envelope.rcpt_tos)
+        return "250 OK"
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture
+def smtp(monkeypatch):
+    handler = _Handler()
+    controller = Controller(handler, hostname="127.0.0.1", port=_free_port())
+    controller.start()
+    monkeypatch.setattr(mailer, "SMTP_SERVER", "127.0.0.1")
+    monkeypatch.setattr(mailer, "SMTP_PORT", controller.port)
+    monkeypatch.setattr(mailer, "SMTP_USE_TLS", False)
+    monkeypatch.setattr(mailer, "SMTP_USE_SSL", False)
+    monkeypatch.setattr(mailer, "SMTP_USERNAME", None)
+    monkeypatch.setattr(mailer, "SMTP_FROM", "noreply@qomex.test")
+    yield handler
+    controller.stop()
+
+
+@pytest.fixture
+def outbox(smtp):
+    box = mailer.Outbox(mailer.SmtpPool(2))
+    yield box
+    box.pool.close()
+
+
+def _enqueue(*addresses: str) -> list[int]:
+    with SessionLocal() as db:
+        rows = [mailer.enqueue(db, addr, "test", "<p>test</p>") for addr in addresses]
+        db.commit()
+        return [row.id for row in rows]
+
+
+def _row(row_id: int) -> OutboxEmail:
+    with SessionLocal() as db:
+        return db.get(OutboxEmail, row_id)
+
+
+def _make_due(*row_ids: int):
+    with SessionLocal() as db:
+        db.execute(update(OutboxEmail).where(OutboxEmail.id.in_(row_ids))
+                   .values(next_attempt_at=datetime.utcnow()))
+        db.commit()
+
+
+def _delay(row: OutboxEmail) -> float:
+    return (row.next_attempt_at - datetime.utcnow()).total_seconds()
+
+
+async def test_temporary_failure_is_retried_with_backoff(smtp, outbox, monkeypatch):
+    monkeypatch.setattr(mailer, "MAIL_MAX_ATTEMPTS", 3)
+    smtp.temp_fail = {"flaky@a.test", "down@a.test"}
+    flaky, down, gone = _enqueue("flaky@a.test", "down@a.test", "nobody@a.test")
+
+    assert await outbox.run_once() == 3
+    row = _row(flaky)
+    assert (row.status, row.attempts) == (mailer.PENDING, 1)
+    assert "451" in row.last_error
+    assert 0.8 * mailer.MAIL_BACKOFF_BASE - 1 <= _delay(row) <= 1.2 * mailer.MAIL_BACKOFF_BASE
+    # 5xx на адрес — сразу failed, без повторов
+    assert (_row(gone).status, _row(gone).attempts) == (mailer.FAILED, 1)
+    assert await outbox.run_once() == 0  # повтор ещё не подошёл
+
+    _make_due(flaky, down)
+    await outbox.run_once()
+    assert 1.6 * mailer.MAIL_BACKOFF_BASE - 1 <= _delay(_row(down)) <= 2.4 * mailer.MAIL_BACKOFF_BASE
+
+    smtp.temp_fail = {"down@a.test"}
+    _make_due(flaky, down)
+    await outbox.run_once()
+    assert _row(flaky).status == mailer.SENT and _row(flaky).last_error is None
+    assert (_row(down).status, _row(down).attempts) == (mailer.FAILED, 3)
+    assert smtp.delivered == ["flaky@a.test"]
+    assert outbox.stats()["failed"] == 2
+
+
+async def test_domain_limit_defers_without_spending_attempts(smtp, monkeypatch):
+    monkeypatch.setattr(mailer, "MAIL_DOMAIN_BURST", 2)
+    monkeypatch.setattr(mailer, "MAIL_DOMAIN_RATE", 1)
+    box = mailer.Outbox(mailer.SmtpPool(2))
+    try:
+        ids = _enqueue(*(f"u{i}@busy.test" for i in range(5)), "solo@other.test")
+        assert await box.run_once() == 6
+    finally:
+        box.pool.close()
+
+    assert sorted(smtp.delivered) == ["solo@other.test", "u0@busy.test", "u1@busy.test"]
+    with SessionLocal() as db:
+        deferred = db.scalars(select(OutboxEmail).where(OutboxEmail.status == mailer.PENDING)).all()
+    assert sorted(r.id for r in deferred) == ids[2:5]
+    assert all(r.attempts == 0 and _delay(r) > 0 for r in deferred)
+    assert box.stats()["deferred"] == 3
+
+
+async def test_pool_reuses_connections(smtp, monkeypatch):
+    box = mailer.Outbox(mailer.SmtpPool(1))
+    try:
+        _enqueue(*(f"user{i}@d{i}.test" for i in range(10)))
+        assert await box.drain() == 10
+        stats = box.stats()
+        assert (stats["sent"], stats["connects"], stats["idle"]) == (10, 1, 1)
+        assert smtp.sessions == 1
+
+        # простоявшее дольше MAIL_SMTP_IDLE соединение закрывается и открывается новое
+        monkeypatch.setattr(mailer, "MAIL_SMTP_IDLE", 0)
+        _enqueue("late@d0.test")
+        await box.drain()
+        assert box.stats()["connects"] == 2 and smtp.sessions == 2
+    finally:
+        box.pool.close()
+    assert len(smtp.delivered) == 11
@@ -0,0 +1,57 @@
+# tests/test_postback_dedup.py
+import pytest
+from sqlalchemy import func, select
+
+import postback
+from conftest import TOKEN
+from database import SessionLocal
+from models import PostbackLog, User
+from postback_dedup import event_fingerprint
+
+pytestmark = pytest.mark.anyio
+
+DEPOSIT = {"token": TOKEN, "event": "deposit", "click_id": "click-d", "amount": "25", "currency": "USD"}
+
+
+def _state(user_id: int) -> tuple[float, int]:
+    with SessionLocal() as db:
+        logs = db.scalar(select(func.count()).select_from(PostbackLog))
+        return db.get(User, user_id).total_deposit, logs
+
+
+def test_fingerprint_only_with_transaction_id():
+    ev = postback._parse_event(dict(DEPOSIT))
+    assert ev["fingerprint"] is None
+    fp = event_fingerprint(postback._parse_event({**DEPOSIT, "txn_id": "42"}))
+    assert fp is not None
+    assert fp == event_fingerprint(postback._parse_event({**DEPOSIT, "txn_id": "42"}))
+    assert fp != event_fingerprint(postback._parse_event({**DEPOSIT, "txn_id": "43"}))
+
+
+async def test_retry_with_transaction_id_is_duplicate(client, make_user):
+    user = make_user("d")
+    params = {**DEPOSIT, "transaction_id": "tx-1"}
+    assert (await client.get("/postback", params=params)).json() == {"status": "ok"}
+    assert (await client.get("/postback", params=params)).json() == {"status": "duplicate"}
+    postback.recent_fingerprints._items.clear()  # LRU забыл — ловит уникальный индекс / exists
+    assert (await client.get("/postback", params=params)).json() == {"status": "duplicate"}
+    assert _state(user.id) == (25.0, 1)
+
+
+async def test_repeat_without_transaction_id_is_counted(client, make_user):
+    user = make_user("d")
+    for _ in range(2):
+        assert (await client.get("/postback", params=DEPOSIT)).json() == {"status": "ok"}
+    assert _state(user.id) == (50.0, 2)
+
+
+async def test_duplicates_inside_one_batch(make_user):
+    user = make_user("d")
+    events = [postback._parse_event(p) for p in (
+        {**DEPOSIT, "transaction_id": "tx-1"},
+        {**DEPOSIT, "transaction_id": "tx-1"},
+        DEPOSIT,
+        DEPOSIT,
+    )]
+    await postback._apply_batch(events)
+    assert _state(user.id) == (75.0, 3)
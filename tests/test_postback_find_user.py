@@ -0,0 +1,33 @@
+# tests/test_postback_find_user.py
+import pytest
+from sqlalchemy import update
+
+import postback
+from database import SessionLocal, engine
+from models import User
+from user_cache import user_cache
+
+
+@pytest.mark.parametrize("key, value", [("click_id", "click-x"), ("trader_id", "777")])
+def test_stale_cache_entry_falls_back_to_query(make_user, key, value):
+    stale = make_user("stale", **{key: value})
+    with SessionLocal() as db:
+        user_cache.put(db.get(User, stale.id))
+    # ключ перешёл к другому пользователю в обход invalidate (другой процесс, ручная правка)
+    with engine.begin() as conn:
+        conn.execute(update(User).where(User.id == stale.id).values({key: f"moved-{value}"}))
+    fresh = make_user("fresh", **{key: value})
+    assert user_cache.resolve_id(key, value) == stale.id
+
+    args = ("", value) if key == "trader_id" else (value, "")
+    with SessionLocal() as db:
+        assert postback._find_user(db, *args).id == fresh.id
+
+
+def test_cached_id_is_used_when_key_matches(make_user):
+    user = make_user("c", trader_id="555")
+    with SessionLocal() as db:
+        user_cache.put(db.get(User, user.id))
+    with SessionLocal() as db:
+        assert postback._find_user(db, "click-c", "").id == user.id
+        assert postback._find_user(db, "", "555").id == user.id
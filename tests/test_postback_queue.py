@@ -0,0 +1,94 @@
+# tests/test_postback_queue.py
+import asyncio
+
+import pytest
+from sqlalchemy import func, select
+
+import postback
+from conftest import TOKEN
+from database import SessionLocal
+from metrics import postback_outcomes
+from models import PostbackLog, User
+from postback_queue import PostbackQueue
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def queue(monkeypatch):
+    q = PostbackQueue(postback._apply_batch, maxsize=2, batch_size=50, batch_ms=10)
+    monkeypatch.setattr(postback, "POSTBACK_INGEST", "queue")
+    monkeypatch.setattr(postback, "ingest_queue", q)
+    await q.start()
+    yield q
+    await q.stop(timeout=5)
+
+
+def _params(n: int, **extra) -> dict:
+    return {"token": TOKEN, "event": "deposit", "click_id": f"c{n}", "amount": "10",
+            "transaction_id": f"t{n}", **extra}
+
+
+def _log_count() -> int:
+    with SessionLocal() as db:
+        return db.scalar(select(func.count()).select_from(PostbackLog))
+
+
+async def test_full_queue_answers_503(client, queue):
+    gate = asyncio.Event()
+    apply_batch = queue.apply_batch
+
+    async def blocked(batch):
+        await gate.wait()
+        await apply_batch(batch)
+    queue.apply_batch = blocked
+
+    assert (await client.get("/postback", params=_params(0))).json() == {"status": "queued"}
+    await asyncio.sleep(0.05)  # воркер забрал первое событие и ждёт gate
+    for n in (1, 2):
+        assert (await client.get("/postback", params=_params(n))).status_code == 200
+    r = await client.get("/postback", params=_params(3))
+    assert r.status_code == 503
+    assert r.json()["detail"] == "queue_full"
+    assert r.headers["retry-after"] == "1"
+
+    gate.set()
+    await queue.stop(timeout=5)
+    assert _log_count() == 3
+
+
+async def test_stop_drains_queue_and_rejects_new_events(client, queue):
+    queue.maxsize = 100
+    await queue.stop()
+    await queue.start()  # с новым размером
+    for n in range(5):
+        assert (await client.get("/postback", params=_params(n))).json() == {"status": "queued"}
+    await queue.stop(timeout=5)
+    assert _log_count() == 5
+    assert (await client.get("/postback", params=_params(9))).status_code == 503
+
+
+async def test_failed_batch_is_retried_one_by_one(make_user, monkeypatch):
+    user = make_user("q", click_id="c1")
+    apply_event = postback._apply_event
+
+    def failing(db, ev):
+        if ev["click_id"] == "boom":
+            raise RuntimeError("broken event")
+        return apply_event(db, ev)
+    monkeypatch.setattr(postback, "_apply_event", failing)
+
+    events = [postback._parse_event(p) for p in (_params(1), _params(2, click_id="boom"), _params(3, click_id="c1"))]
+    for ev in events:
+        postback.recent_fingerprints.add(ev["fingerprint"])
+    errors = postback_outcomes._values.get(("deposit", "error"), 0.0)
+
+    await postback._apply_batch(events)
+
+    assert _log_count() == 2
+    with SessionLocal() as db:
+        assert db.get(User, user.id).total_deposit == 20.0
+    assert postback_outcomes._values[("deposit", "error")] == errors + 1
+    # неприменённое событие не должно отсекаться фильтром на ретрае брокера
+    assert events[1]["fingerprint"] not in postback.recent_fingerprints
+    assert events[0]["fingerprint"] in postback.recent_fingerprints
@@ -0,0 +1,62 @@
+# tests/test_projections.py
+import pytest
+from sqlalchemy import select
+
+import projections
+import reconcile
+from conftest import TOKEN
+from database import SessionLocal, engine
+from fx import fx_rates
+from models import FxRate, PostbackLog, User
+
+pytestmark = pytest.mark.anyio
+
+
+def _balances() -> dict:
+    with engine.connect() as conn:
+        rows = conn.execute(select(User.id, User.first_deposit, User.total_deposit, User.balance_log_id)
+                            .order_by(User.id)).all()
+    return {r.id: (r.first_deposit, r.total_deposit, r.balance_log_id) for r in rows}
+
+
+async def _postback(client, **params):
+    assert (await client.get("/postback", params={"token": TOKEN, **params})).status_code == 200
+
+
+async def test_incremental_projection_matches_rebuild(client, make_user):
+    with SessionLocal() as db:
+        db.add(FxRate(currency="EUR", rate=1.1))
+        db.commit()
+        fx_rates.load(db)
+    a = make_user("a")
+    # депозиты по пользователю: в базовой валюте, с курсом и без курса (amount_base = NULL)
+    await _postback(client, event="deposit", click_id="click-a", amount="10", currency="USD")
+    await _postback(client, event="deposit", click_id="click-a", amount="500", currency="JPY")
+    await _postback(client, event="deposit", click_id="click-a", amount="20", currency="EUR")
+
+    # висящие логи старше контрольной точки: пользователь уже получал события — recompute
+    await _postback(client, event="deposit", trader_id="5005", amount="7", currency="USD")
+    await _postback(client, event="deposit", trader_id="5005", amount="9", currency="RUB")
+    await _postback(client, event="registration", click_id="click-a", trader_id="5005")
+    await _postback(client, event="deposit", click_id="click-a", amount="3", currency="USD")
+
+    # висящие логи пользователя без событий: привязка при регистрации и через reconcile
+    await _postback(client, event="deposit", click_id="click-b", amount="100", currency="RUB")
+    await _postback(client, event="deposit", click_id="click-b", amount="40", currency="USD")
+    client.cookies.set("click_id", "click-b")
+    form = {"login": "b", "email": "b@example.com", "password": "pw", "action": "register"}
+    assert (await client.post("/auth", data=form)).json()["success"]
+    await _postback(client, event="deposit", click_id="click-c", amount="60", currency="JPY")
+    await _postback(client, event="deposit", click_id="click-c", amount="5", currency="EUR")
+    make_user("c")
+    reconcile.reconcile_all()
+
+    with SessionLocal() as db:
+        assert db.scalar(select(PostbackLog.id).where(PostbackLog.processed.is_(False))) is None
+    incremental = _balances()
+    assert incremental[a.id][:2] == (10.0, 10.0 + 22.0 + 7.0 + 3.0)
+    with engine.connect() as conn:
+        assert projections.check(conn) == []
+    with engine.begin() as conn:
+        projections.rebuild(conn)
+    assert _balances() == incremental
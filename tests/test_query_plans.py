@@ -0,0 +1,100 @@
+# tests/test_query_plans.py
+import re
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import event
+
+import projections
+import reconcile
+from conftest import TOKEN
+from database import SessionLocal, async_engine, engine
+from migrations import check_query_plans
+from models import User
+
+pytestmark = pytest.mark.anyio
+
+HOT_TABLES = re.compile(r"\b(users|postbacks_log)\b")
+FULL_SCAN = re.compile(r"^SCAN (users|postbacks_log)\b")
+
+
+@contextmanager
+def captured_sql():
+    seen: dict[str, tuple] = {}
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if executemany:
+            parameters = parameters[0] if parameters else ()
+        seen.setdefault(statement, tuple(parameters or ()))
+
+    targets = (engine, async_engine.sync_engine)
+    for target in targets:
+        event.listen(target, "before_cursor_execute", capture)
+    try:
+        yield seen
+    finally:
+        for target in targets:
+            event.remove(target, "before_cursor_execute", capture)
+
+
+def _full_scans(statements: dict[str, tuple]) -> dict[str, list[str]]:
+    scans = {}
+    with engine.connect() as conn:
+        for sql, params in statements.items():
+            if not HOT_TABLES.search(sql) or not sql.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE")):
+                continue
+            plan = conn.exec_driver_sql("EXPLAIN QUERY PLAN " + sql, params).all()
+            bad = [row[-1] for row in plan if FULL_SCAN.match(row[-1])]
+            if bad:
+                scans[sql] = bad
+    return scans
+
+
+def _postback(client, **params):
+    return client.get("/postback", params={"token": TOKEN, **params})
+
+
+def test_hot_queries_catalogue_uses_indexes():
+    assert check_query_plans(engine) == []
+
+
+async def test_hot_paths_do_not_scan_users_or_postbacks_log(client, make_user):
+    with captured_sql() as seen:
+        # постбэки: висящий, по click_id, по trader_id, дубль по id транзакции
+        await _postback(client, event="registration", click_id="click-new", trader_id="9001")
+        await _postback(client, event="deposit", click_id="click-new", amount="50", currency="USD",
+                        txn_id="tx-1")
+        await _postback(client, event="registration", click_id="unknown", trader_id="9002")
+
+        # регистрация с висящими логами, /check по trader_id, логин и страницы пользователя
+        client.cookies.set("click_id", "click-new")
+        form = {"login": "new", "email": "new@example.com", "password": "pw", "action": "register"}
+        assert (await client.post("/auth", data=form)).json()["success"]
+        await _postback(client, event="deposit", trader_id="9001", amount="20", currency="USD", txn_id="tx-2")
+        await _postback(client, event="deposit", click_id="click-new", amount="50", currency="USD",
+                        txn_id="tx-1")
+        assert (await client.post("/auth", data={**form, "action": "login"})).json()["success"]
+        await client.get("/deposit-check")
+        await client.get("/profile")
+        r = await client.post("/password-reset-request", json={"email": "new@example.com"})
+        assert r.status_code == 200, r.text
+
+        client.cookies.set("click_id", "click-second")
+        second = {"login": "second", "email": "second@example.com", "password": "pw", "action": "register"}
+        assert (await client.post("/auth", data=second)).json()["success"]
+        assert (await client.post("/check", data={"trader_id": "9002"})).status_code in (200, 302)
+
+        # выгрузки и агрегаты
+        await client.get("/users", params={"limit": 10, "has_trader_id": "true", "min_deposit": 10})
+        await client.get("/stats/daily")
+
+        # сверка висящих логов и пересчёт проекций
+        await _postback(client, event="deposit", click_id="click-late", amount="5", currency="USD")
+        late = make_user("late")
+        reconcile.reconcile_all()
+        with SessionLocal() as db:
+            projections.recompute(db, [db.get(User, late.id)])
+            db.commit()
+
+    assert any("postbacks_log" in sql for sql in seen)
+    assert _full_scans(seen) == {}
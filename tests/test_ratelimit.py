@@ -0,0 +1,80 @@
+# tests/test_ratelimit.py
+import pytest
+
+import postback
+import ratelimit
+from conftest import TOKEN
+from metrics import postback_outcomes
+from ratelimit import MemoryStore, SlidingWindow, SqliteStore, TokenBucket, sliding_window
+
+pytestmark = pytest.mark.anyio
+
+T0 = 1_000_020.0  # кратно 60: начало окна SlidingWindow(…, 60)
+
+
+def _run(algo, times, cost=1.0):
+    state, decisions = None, []
+    for now in times:
+        decision, state = algo.hit(state, now, cost)
+        decisions.append(decision)
+    return decisions
+
+
+def test_token_bucket_allows_burst_then_refills():
+    bucket = TokenBucket(3, 30)  # 3 подряд, дальше жетон раз в 10 с
+    d = _run(bucket, [T0] * 4 + [T0 + 5, T0 + 10, T0 + 10])
+    assert [x.allowed for x in d] == [True, True, True, False, False, True, False]
+    assert d[3].retry_after == pytest.approx(10)
+    assert d[4].retry_after == pytest.approx(5)
+    assert d[6].retry_after == pytest.approx(10)
+
+
+def test_sliding_window_weights_previous_window():
+    window = SlidingWindow(4, 60)
+    d = _run(window, [T0, T0 + 1, T0 + 2, T0 + 3, T0 + 30])
+    assert [x.allowed for x in d] == [True, True, True, True, False]
+    assert d[4].retry_after == pytest.approx(30)  # до конца окна
+    # середина следующего окна: вес предыдущего 4 * 0.5 = 2 — проходят ещё два
+    d = _run(window, [T0, T0 + 1, T0 + 2, T0 + 3, T0 + 90, T0 + 90, T0 + 90])
+    assert [x.allowed for x in d[4:]] == [True, True, False]
+    assert d[6].retry_after == pytest.approx(15)  # вес предыдущего окна опустится до 1
+    # пропущено целое окно — предыдущее не учитывается
+    assert all(x.allowed for x in _run(window, [T0] * 4 + [T0 + 125] * 4))
+
+
+@pytest.mark.parametrize("algo", [TokenBucket(3, 30), SlidingWindow(4, 60)], ids=["bucket", "window"])
+async def test_memory_and_sqlite_stores_agree(tmp_path, algo):
+    memory, sqlite = MemoryStore(), SqliteStore(str(tmp_path / "ratelimit.db"))
+    times = [T0 + t for t in (0, 0, 0, 0, 0, 1, 5, 10, 10, 31, 59, 60, 61, 90, 200, 200, 200, 200, 200)]
+    for i, now in enumerate(times):
+        key = "a" if i % 3 else "b"
+        expected = memory.apply(key, algo, now)
+        assert sqlite.apply(key, algo, now) == expected
+    assert sqlite.errors == 0
+
+    async_memory, async_sqlite = MemoryStore(), SqliteStore(str(tmp_path / "async.db"))
+    for now in times:
+        assert await async_sqlite.apply_async("k", algo, now) == await async_memory.apply_async("k", algo, now)
+
+
+@pytest.fixture
+def limits(monkeypatch):
+    monkeypatch.setattr(ratelimit, "RATELIMIT_ENABLED", True)
+    monkeypatch.setattr(postback, "POSTBACK_TOKEN_LIMIT", sliding_window("t_token", "5/60", MemoryStore()))
+    monkeypatch.setattr(postback, "POSTBACK_BAD_TOKEN_LIMIT", sliding_window("t_bad", "2/60", MemoryStore()))
+
+
+async def test_bad_token_is_limited_per_ip_without_touching_valid_token(client, limits):
+    params = {"event": "registration", "click_id": "c"}
+    before = postback_outcomes._values.get(("registration", "rate_limited"), 0)
+    for _ in range(2):
+        assert (await client.get("/postback", params={**params, "token": "wrong"})).status_code == 403
+    r = await client.get("/postback", params={**params, "token": "wrong"})
+    assert r.status_code == 429 and int(r.headers["Retry-After"]) >= 1
+    assert postback_outcomes._values[("registration", "rate_limited")] == before + 1
+
+    # тот же IP с верным токеном не ограничен лимитом чужих токенов
+    for _ in range(5):
+        assert (await client.get("/postback", params={**params, "token": TOKEN})).status_code == 200
+    # а общий лимит на верный токен — свой
+    assert (await client.get("/postback", params={**params, "token": TOKEN})).status_code == 429
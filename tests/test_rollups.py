@@ -0,0 +1,69 @@
+# tests/test_rollups.py
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import select
+
+import reconcile
+import rollups
+from conftest import TOKEN
+from database import SessionLocal, engine
+from fx import fx_rates
+from models import DailyStat, PostbackLog
+
+pytestmark = pytest.mark.anyio
+
+
+def _stats() -> dict:
+    with engine.connect() as conn:
+        rows = conn.execute(select(DailyStat).order_by(DailyStat.day, DailyStat.currency)).all()
+    return {(r.day, r.currency): {name: getattr(r, name) for name in rollups.COUNTERS} for r in rows}
+
+
+def _pending_log(days_ago: int, event: str, amount: float = 0.0, currency: str = "USD", **keys):
+    """Висящий постбэк, принятый days_ago дней назад (с его дельтами в агрегатах того дня)."""
+    created_at = datetime.utcnow() - timedelta(days=days_ago)
+    with SessionLocal() as db:
+        db.add(PostbackLog(event=event, amount=amount, currency=currency, processed=False,
+                           amount_base=fx_rates.to_base(amount, currency), created_at=created_at, **keys))
+        rollups.record_postback(db, event, amount, currency, created_at.date())
+        db.commit()
+
+
+async def _postback(client, **params):
+    assert (await client.get("/postback", params={"token": TOKEN, **params})).status_code == 200
+
+
+async def _register(client, login: str, click_id: str):
+    client.cookies.set("click_id", click_id)
+    form = {"login": login, "email": f"{login}@example.com", "password": "pw", "action": "register"}
+    assert (await client.post("/auth", data=form)).json()["success"]
+
+
+async def test_incremental_rollups_match_backfill(client, make_user):
+    # reconcile: висящие логи за вчера
+    _pending_log(1, "registration", click_id="click-a", trader_id="1001")
+    _pending_log(1, "deposit", 30.0, click_id="click-a")
+    make_user("a")
+    reconcile.reconcile_all()
+
+    # регистрация подтягивает висящие логи трёхдневной давности
+    _pending_log(3, "deposit", 15.0, "EUR", click_id="click-d", trader_id="4004")
+    await _register(client, "d", "click-d")
+
+    # /check: trader_id из висящего лога двухдневной давности
+    _pending_log(2, "deposit", 40.0, trader_id="2002")
+    await _register(client, "b", "click-b")
+    assert (await client.post("/check", data={"trader_id": "2002"})).status_code in (200, 302)
+
+    # постбэк по существующему пользователю: привязка trader_id и первый депозит сегодня
+    make_user("c")
+    await _postback(client, event="registration", click_id="click-c", trader_id="3003")
+    await _postback(client, event="deposit", click_id="click-c", amount="25", currency="USD")
+
+    incremental = _stats()
+    assert sum(row["trader_linked"] for row in incremental.values()) == 4
+    assert sum(row["ftd_count"] for row in incremental.values()) == 3  # EUR без курса — не FTD
+    with engine.begin() as conn:
+        rollups.backfill(conn)
+    assert _stats() == incremental
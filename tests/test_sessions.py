@@ -0,0 +1,38 @@
+# tests/test_sessions.py
+import asyncio
+
+import pytest
+
+import sessions
+from passwords import hash_password
+
+pytestmark = pytest.mark.anyio
+
+
+async def _login(client, password: str) -> str:
+    form = {"login": "s", "password": password, "action": "login"}
+    assert (await client.post("/auth", data=form)).json()["success"]
+    return client.cookies[sessions.SESSION_COOKIE]
+
+
+async def test_reset_then_immediate_relogin_keeps_new_session(client, make_user):
+    make_user("s", password=hash_password("old-password"), reset_token="reset-1")
+    old_token = await _login(client, "old-password")
+
+    r = await client.post("/password-reset", json={"token": "reset-1", "new_password": "new-password"})
+    assert r.json()["success"]
+    new_token = await _login(client, "new-password")
+
+    assert sessions.deny_list.denied(sessions.read(old_token))
+    assert not sessions.deny_list.denied(sessions.read(new_token))
+    r = await client.get("/profile", follow_redirects=False)
+    assert r.status_code == 200
+    assert client.cookies.get(sessions.SESSION_COOKIE)
+
+
+async def test_token_issued_before_revocation_is_denied():
+    token = sessions.issue(42, False, False)
+    await asyncio.sleep(0.005)  # сравнение — с точностью до мс
+    await sessions.revoke(user_id=42)
+    assert sessions.deny_list.denied(sessions.read(token))
+    assert not sessions.deny_list.denied(sessions.read(sessions.issue(42, False, False)))
@@ -0,0 +1,153 @@
+# user_cache.py
+"""Кэш пользователей в памяти процесса (TTL + LRU) по id, click_id и trader_id."""
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import select
+
+from models import User
+
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "30"))  # сек
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "50000"))
+
+
+@dataclass(frozen=True)
+class CachedUser:
+    id: int
+    login: str
+    email: str
+    click_id: Optional[str]
+    trader_id: Optional[str]
+    first_deposit: Optional[float]
+    total_deposit: float
+    deposit_verified: bool
+    funnel_state: str
+    created_at: Optional[datetime]
+
+    @classmethod
+    def from_model(cls, u: User) -> "CachedUser":
+        return cls(
+            id=u.id, login=u.login, email=u.email, click_id=u.click_id, trader_id=u.trader_id,
+            first_deposit=u.first_deposit, total_deposit=u.total_deposit or 0.0,
+            deposit_verified=bool(u.deposit_verified), funnel_state=u.funnel_state, created_at=u.created_at,
+        )
+
+
+class UserCache:
+    def __init__(self, ttl: float = USER_CACHE_TTL, maxsize: int = USER_CACHE_SIZE):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._by_id: OrderedDict[int, tuple[float, CachedUser]] = OrderedDict()
+        self._ids = {"click_id": {}, "trader_id": {}}  # ключ -> user.id
+        # растёт при каждой инвалидации: снимок, прочитанный до неё, в кэш не кладём
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self._listeners = []  # fn(user_ids | None) — кто ещё хочет знать об изменениях (sessions.py)
+
+    def stats(self) -> dict:
+        return {"size": len(self._by_id), "hits": self.hits, "misses": self.misses}
+
+    def get(self, user_id: int) -> Optional[CachedUser]:
+        item = self._by_id.get(user_id)
+        if item is None or item[0] < time.monotonic():
+            if item is not None:
+                self._drop(user_id)
+            self.misses += 1
+            return None
+        self._by_id.move_to_end(user_id)
+        self.hits += 1
+        return item[1]
+
+    def get_by(self, key: str, value: str) -> Optional[CachedUser]:
+        """key — "click_id" | "trader_id"."""
+        user_id = self._ids[key].get(value)
+        if user_id is None:
+            self.misses += 1
+            return None
+        return self.get(user_id)
+
+    def resolve_id(self, key: str, value: str) -> Optional[int]:
+        cu = self.get_by(key, value)
+        return cu.id if cu else None
+
+    def put(self, user: User, generation: Optional[int] = None):
+        if generation is not None and generation != self.generation:
+            return  # пока читали из БД, кого-то инвалидировали — снимок мог устареть
+        cu = CachedUser.from_model(user)
+        self._drop(cu.id)
+        self._by_id[cu.id] = (time.monotonic() + self.ttl, cu)
+        if cu.click_id:
+            self._ids["click_id"][cu.click_id] = cu.id
+        if cu.trader_id:
+            self._ids["trader_id"][cu.trader_id] = cu.id
+        while len(self._by_id) > self.maxsize:
+            self._drop(next(iter(self._by_id)))
+
+    def subscribe(self, listener):
+        self._listeners.append(listener)
+
+    def invalidate(self, *user_ids: Optional[int]):
+        self.generation += 1
+        ids = [user_id for user_id in user_ids if user_id is not None]
+        for user_id in ids:
+            self._drop(user_id)
+        for listener in self._listeners:
+            listener(ids)
+
+    def clear(self):
+        self.generation += 1
+        self._by_id.clear()
+        for index in self._ids.values():
+            index.clear()
+        for listener in self._listeners:
+            listener(None)
+
+    def _drop(self, user_id: int):
+        item = self._by_id.pop(user_id, None)
+        if item is None:
+            return
+        cu = item[1]
+        for key in ("click_id", "trader_id"):
+            value = getattr(cu, key)
+            if value and self._ids[key].get(value) == user_id:
+                del self._ids[key][value]
+
+
+user_cache = UserCache()
+
+
+async def get_user(db, user_id: int) -> Optional[CachedUser]:
+    cu = user_cache.get(user_id)
+    if cu is not None:
+        return cu
+    gen = user_cache.generation
+    user = await db.get(User, user_id)
+    if user is None:
+        return None
+    user_cache.put(user, gen)
+    return CachedUser.from_model(user)
+
+
+async def get_user_by_trader_id(db, trader_id: str) -> Optional[CachedUser]:
+    cu = user_cache.get_by("trader_id", trader_id)
+    if cu is not None:
+        return cu
+    gen = user_cache.generation
+    user = await db.scalar(select(User).where(User.trader_id == trader_id))
+    if user is None:
+        return None
+    user_cache.put(user, gen)
+    return CachedUser.from_model(user)
+
+
+async def get_funnel_state(db, user_id: int) -> Optional[str]:
+    """Шаг воронки (funnel.py): из кэша или одной колонкой по первичному ключу."""
+    cu = user_cache.get(user_id)
+    if cu is not None:
+        return cu.funnel_state
+    return await db.scalar(select(User.funnel_state).where(User.id == user_id))
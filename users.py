@@ -1,41 +1,102 @@
 # users.py
-from fastapi import APIRouter, Depends
-from fastapi.responses import JSONResponse, RedirectResponse
-from sqlalchemy.orm import Session
-from database import SessionLocal
+import csv
+import io
+import json
+from datetime import datetime
+from typing import Literal, Optional
+
+from fastapi import APIRouter, Depends, Query, Request
+from fastapi.responses import JSONResponse, RedirectResponse, StreamingResponse
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import get_db, AsyncSessionLocal
 from models import User
+from sessions import end_session
 
 router = APIRouter()
 
-# Зависимость для работы с БД
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+USERS_PAGE_MAX = 1000
+EXPORT_BATCH = 1000  # строк за одно чтение курсора при выгрузке
+
+# только нужные колонки: без ORM-объектов и без хэшей паролей
+USER_COLUMNS = (User.id, User.login, User.email, User.trader_id, User.first_deposit,
+                User.total_deposit, User.created_at, User.updated_at, User.click_id)
+FIELDS = [c.key for c in USER_COLUMNS]
+
+
+def _users_query(after_id: int, created_from: Optional[datetime], created_to: Optional[datetime],
+                 has_trader_id: Optional[bool], min_deposit: Optional[float], max_deposit: Optional[float]):
+    """Keyset по id: WHERE id > after_id ORDER BY id — без OFFSET, одинаково быстро на любой странице."""
+    stmt = select(*USER_COLUMNS).where(User.id > after_id).order_by(User.id)
+    if created_from is not None:
+        stmt = stmt.where(User.created_at >= created_from)
+    if created_to is not None:
+        stmt = stmt.where(User.created_at < created_to)
+    if has_trader_id is not None:
+        stmt = stmt.where(User.trader_id.is_not(None) if has_trader_id else User.trader_id.is_(None))
+    if min_deposit is not None:
+        stmt = stmt.where(User.total_deposit >= min_deposit)
+    if max_deposit is not None:
+        stmt = stmt.where(User.total_deposit <= max_deposit)
+    return stmt
+
+
+def _row_dict(row) -> dict:
+    d = dict(row._mapping)
+    for key in ("created_at", "updated_at"):
+        d[key] = d[key].isoformat() if d[key] else None
+    return d
+
+
+async def _export_rows(stmt, fmt: str):
+    """Потоковая выгрузка пачками по EXPORT_BATCH в своей сессии."""
+    async with AsyncSessionLocal() as db:
+        result = await db.stream(stmt.execution_options(yield_per=EXPORT_BATCH))
+        if fmt == "csv":
+            buf = io.StringIO()
+            writer = csv.DictWriter(buf, FIELDS)
+            writer.writeheader()
+        async for partition in result.partitions():
+            if fmt == "csv":
+                writer.writerows(_row_dict(r) for r in partition)
+                chunk = buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+            else:
+                chunk = "".join(json.dumps(_row_dict(r), ensure_ascii=False) + "\n" for r in partition)
+            yield chunk.encode("utf-8")
+        if fmt == "csv" and buf.tell():
+            yield buf.getvalue().encode("utf-8")  # только заголовок, если строк нет
+
 
 @router.get("/users")
-async def get_all_users(db: Session = Depends(get_db)):
-    users = db.query(User).all()
-    users_data = [
-        {
-            "id": u.id,
-            "login": u.login,
-            "email": u.email,
-            "trader_id": u.trader_id,
-            "first_deposit": u.first_deposit,
-            "total_deposit": u.total_deposit,
-            "created_at": u.created_at.isoformat() if u.created_at else None,
-            "updated_at": u.updated_at.isoformat() if u.updated_at else None,
-            "click_id": u.click_id
-        }
-        for u in users
-    ]
-    return JSONResponse({"users": users_data})
+async def get_all_users(
+    after_id: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=USERS_PAGE_MAX),
+    format: Literal["json", "ndjson", "csv"] = "json",
+    created_from: Optional[datetime] = None,
+    created_to: Optional[datetime] = None,
+    has_trader_id: Optional[bool] = None,
+    min_deposit: Optional[float] = None,
+    max_deposit: Optional[float] = None,
+    db: AsyncSession = Depends(get_db),
+):
+    """json — страница после after_id; ndjson / csv — потоковая выгрузка всех."""
+    stmt = _users_query(after_id, created_from, created_to, has_trader_id, min_deposit, max_deposit)
+
+    if format != "json":
+        media_type = "text/csv; charset=utf-8" if format == "csv" else "application/x-ndjson"
+        headers = {"Content-Disposition": f'attachment; filename="users.{format}"'}
+        return StreamingResponse(_export_rows(stmt, format), media_type=media_type, headers=headers)
+
+    rows = (await db.execute(stmt.limit(limit))).all()
+    users_data = [_row_dict(r) for r in rows]
+    next_after_id = rows[-1].id if len(rows) == limit else None
+    return JSONResponse({"users": users_data, "next_after_id": next_after_id})
 
 @router.post("/logout")
-async def logout():
+async def logout(request: Request):
     response = RedirectResponse("/", status_code=303)
+    await end_session(request, response)
     response.delete_cookie("user_id")
     return response
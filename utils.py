@@ -2,37 +2,93 @@
 import secrets
 import string
 from datetime import datetime
+from sqlalchemy import and_, case, exists, false, func, or_, select, update
 from models import PostbackLog, User  # импортируем модель
+from user_cache import user_cache
+import rollups
+import projections
 
 def gen_click_id(n: int = 10) -> str:
     alphabet = string.ascii_letters + string.digits + "_-"
     return ''.join(secrets.choice(alphabet) for _ in range(n))
 
-def attach_pending_postbacks(db, user: User):
-    """
-    При связывании пользователя переносит все необработанные постбэки на него.
-    """
-    q = db.query(PostbackLog).filter(PostbackLog.processed == False)
+# суммы пользователя — в базовой валюте; депозиты без курса (amount_base = NULL) не учитываются
+_amount_base = projections.AMOUNT_BASE
+
+def pending_postbacks_filter(user: User, trader_id: str | None = None):
+    """Необработанные логи пользователя по click_id или trader_id (своему или введённому)."""
+    keys = []
+    trader_id = user.trader_id or trader_id
     if user.click_id:
-        q = q.filter(PostbackLog.click_id == user.click_id)
-    elif user.trader_id:
-        q = q.filter(PostbackLog.trader_id == user.trader_id)
-    else:
-        return
+        keys.append(PostbackLog.click_id == user.click_id)
+    if trader_id:
+        keys.append(PostbackLog.trader_id == trader_id)
+    if not keys:
+        return None
+    return and_(PostbackLog.processed == false(), or_(*keys))
+
+def attach_pending_postbacks(db, user: User, trader_id: str | None = None) -> int:
+    """Привязывает висящие постбэки к пользователю; возвращает их число."""
+    pending = pending_postbacks_filter(user, trader_id)
+    if pending is None:
+        return 0
+
+    # частый случай — висящих логов нет: одна проба частичного индекса
+    if not db.execute(select(exists().where(pending))).scalar():
+        return 0
 
-    logs = q.all()
-    if not logs:
-        return
+    is_deposit = projections.IS_DEPOSIT
+    min_id, max_id, deposit_sum, first_deposit_id, first_trader_log_id = db.execute(
+        select(
+            func.min(PostbackLog.id),
+            func.max(PostbackLog.id),
+            func.coalesce(func.sum(case((is_deposit, _amount_base), else_=0.0)), 0.0),
+            func.min(case((is_deposit, PostbackLog.id))),
+            func.min(case((PostbackLog.trader_id.is_not(None), PostbackLog.id))),
+        ).where(pending)
+    ).one()
+    if max_id is None:
+        return 0
 
-    for pb in logs:
-        if pb.event == "deposit" and (pb.amount or 0) > 0:
-            if user.first_deposit is None:
-                user.first_deposit = pb.amount
-            user.total_deposit = (user.total_deposit or 0.0) + (pb.amount or 0.0)
+    # первый депозит и первый trader_id — точечно по id из агрегата
+    firsts = {}
+    wanted = [i for i in (first_deposit_id, first_trader_log_id) if i is not None]
+    if wanted:
+        firsts = {row.id: row for row in db.execute(
+            select(PostbackLog.id, PostbackLog.amount, PostbackLog.currency, _amount_base.label("amount_base"),
+                   PostbackLog.trader_id, PostbackLog.created_at)
+            .where(PostbackLog.id.in_(wanted))
+        )}
 
-        pb.user_id = user.id
-        pb.processed = True
-        pb.processed_at = datetime.utcnow()
+    # баланс — через projections: логи новее контрольной точки применяем агрегатом,
+    # иначе после привязки пересчитываем пользователя из его логов
+    first = firsts.get(first_deposit_id)
+    had_first = user.first_deposit is not None
+    in_order = projections.apply(user, min_id, max_id, deposit_sum, first.amount_base if first else None)
+    if in_order and first is not None and not had_first:
+        rollups.record_ftd(db, first.amount, first.currency, rollups.log_day(first.created_at))
+
+    if not user.trader_id and first_trader_log_id in firsts:
+        tid = firsts[first_trader_log_id].trader_id
+        # trader_id уникален: чужой не забираем
+        if tid.isdigit() and not db.execute(select(exists().where(User.trader_id == tid))).scalar():
+            user.trader_id = tid
+            rollups.record_trader_linked(db, rollups.log_day(firsts[first_trader_log_id].created_at))
+
+    # id <= max_id: логи, пришедшие после агрегата, остаются до следующего раза
+    now = datetime.utcnow()
+    stmt = (update(PostbackLog)
+            .where(pending, PostbackLog.id <= max_id)
+            .values(processed=True, user_id=user.id, processed_at=now)
+            .execution_options(synchronize_session=False))
+    if db.get_bind().dialect.update_returning:
+        attached = len(db.execute(stmt.returning(PostbackLog.id)).all())
+    else:
+        attached = db.execute(stmt).rowcount
+    if not in_order:
+        projections.recompute(db, [user])
 
-    user.updated_at = datetime.utcnow()
+    user.updated_at = now
     db.commit()
+    user_cache.invalidate(user.id)
+    return attached